@@ -1,3 +1,38 @@
+import sys
+from importlib import import_module
+
 from ._version import __version__, VERSION
-from .exceptions import (MandrillAPIError, MandrillRecipientsRefused,
-                         NotSerializableForMandrillError, NotSupportedByMandrillError)
+from .exceptions import (MandrillAPIError, MandrillRecipientsRefused, MandrillTemplateError, MandrillTemplateWarning,
+                         MandrillUnavailableError, NotSerializableForMandrillError, NotSupportedByMandrillError)
+
+# These are imported from their modules when they're first used, to keep `import djrill`
+# fast (djrill.prototype imports django.core.mail, for example):
+_LAZY_ATTRS = {
+    'MandrillSendResult': 'send_result',
+    'MessagePrototype': 'prototype',
+    'RecipientData': 'recipient_data',
+}
+
+
+def __getattr__(name):
+    # (PEP 562 module __getattr__, in Python 3.7+; see _LazyModule for earlier versions)
+    try:
+        module_name = _LAZY_ATTRS[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(import_module("." + module_name, __name__), name)
+    globals()[name] = value  # (later lookups won't need __getattr__)
+    return value
+
+
+if sys.version_info < (3, 7):
+    class _LazyModule(type(sys)):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+    try:
+        sys.modules[__name__].__class__ = _LazyModule
+    except TypeError:  # Python 2 (and 3 before 3.5) can't change a module's class
+        from .prototype import MessagePrototype
+        from .recipient_data import RecipientData
+        from .send_result import MandrillSendResult
@@ -0,0 +1,318 @@
+"""Streaming bulk sends, with per-recipient results and resumable checkpoints
+
+BulkSender reads recipients from a CSV or JSONL file, a batch at a time, and
+sends each batch as one Mandrill API call (with per-recipient merge vars).
+Payloads are built in a process pool (with DjrillBackend.build_send_payload),
+and sent by a bounded number of threads.
+
+The results file is both the output and the checkpoint: an append-only JSONL
+log, with a line when each batch is started, a line for each recipient's
+result, and a line when the batch is finished (or failed). Running again with
+the same results file skips the batches it records as sent. A batch that was
+started but never finished (e.g., the process was killed mid-call) may or may
+not have been sent, so it's skipped too, unless retry_unconfirmed is set.
+
+The djrill_bulk_send management command runs a BulkSender.
+"""
+
+import csv
+import io
+import json
+import logging
+import sys
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import requests
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from .exceptions import DjrillError, MandrillAPIError, MandrillUnavailableError, NotSerializableForMandrillError
+from .send_result import MandrillSendResult
+
+
+logger = logging.getLogger(__name__)
+
+
+RECIPIENT_FIELDS = ('email', 'name', 'merge_vars', 'metadata')
+
+
+def read_recipients(path, format=None):
+    """Yield a dict for each recipient in a CSV or JSONL file (format defaults from the file extension)
+
+    Each dict has "email", and optional "name", "merge_vars" and "metadata".
+    CSV files need a header row; columns other than email and name are merge vars.
+    JSONL lines can have merge_vars and metadata dicts, or extra keys as merge vars.
+    """
+    if format is None:
+        format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    if format == "csv":
+        with _open_csv(path) as f:
+            reader = csv.DictReader(f)
+            if "email" not in (reader.fieldnames or ()):
+                raise ValueError("%s has no email column" % path)
+            for row in reader:
+                recipient = {"email": row.pop("email"), "name": row.pop("name", None) or None}
+                recipient["merge_vars"] = dict((key, value) for key, value in row.items() if key)
+                yield recipient
+    elif format == "jsonl":
+        with io.open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    recipient = dict((field, item.pop(field)) for field in RECIPIENT_FIELDS if field in item)
+                    if item:
+                        recipient.setdefault("merge_vars", {}).update(item)
+                    yield recipient
+    else:
+        raise ValueError("Unknown recipients format '%s' (use csv or jsonl)" % format)
+
+
+def _open_csv(path):
+    # (python 2's csv module reads bytes; python 3's reads text opened with newline="")
+    if sys.version_info < (3,):
+        return open(path, "rb")
+    return io.open(path, newline="", encoding="utf-8")
+
+
+def batched(items, size):
+    """Yield (index, list) for successive lists of up to size items"""
+    batch = []
+    index = 0
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield index, batch
+            index += 1
+            batch = []
+    if batch:
+        yield index, batch
+
+
+def build_batch_payload(message_options, batch):
+    """Return the Mandrill send payload for a batch of recipients (in a process pool worker)
+
+    message_options are EmailMessage args and Mandrill attributes: subject, body,
+    from_email, html, template_name, tags, global_merge_vars, and so on.
+    """
+    index, recipients = batch
+    options = dict(message_options)
+    message = EmailMultiAlternatives(
+        subject=options.pop('subject', ""), body=options.pop('body', ""), from_email=options.pop('from_email', None),
+        to=["%s <%s>" % (recipient['name'], recipient['email']) if recipient.get('name') else recipient['email']
+            for recipient in recipients])
+    html = options.pop('html', None)
+    if html:
+        message.attach_alternative(html, "text/html")
+    for attr, value in options.items():
+        setattr(message, attr, value)
+    message.preserve_recipients = False  # each recipient gets their own copy
+    message.merge_vars = dict((recipient['email'], recipient['merge_vars'])
+                              for recipient in recipients if recipient.get('merge_vars'))
+    message.recipient_metadata = dict((recipient['email'], recipient['metadata'])
+                                      for recipient in recipients if recipient.get('metadata'))
+    backend = get_connection('djrill.mail.backends.djrill.DjrillBackend')
+    payload = backend.get_base_payload()
+    backend.build_send_payload(payload, message)
+    return index, payload
+
+
+class BulkSendLog(object):
+    """The results file: records each batch's progress and results, and reads them back to resume"""
+
+    def __init__(self, path, batch_size):
+        self.path = path
+        self.states = {}  # batch index: its latest state ("started", "done" or "failed")
+        self._lock = threading.Lock()
+        try:
+            with io.open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a partial last line, from a crash
+                    if "batch_size" in entry and entry["batch_size"] != batch_size:
+                        raise ValueError("%s was written with batch size %d; resume with the same batch size"
+                                         % (path, entry["batch_size"]))
+                    if "state" in entry and self.states.get(entry["batch"]) != "done":
+                        self.states[entry["batch"]] = entry["state"]
+            new_file = False
+        except IOError:
+            new_file = True
+        self._file = io.open(path, "a", encoding="utf-8")
+        if new_file:
+            self._write([{"batch_size": batch_size}])
+
+    def should_send(self, index, retry_unconfirmed=False):
+        """Return True if batch index hasn't been sent (or might not have been, with retry_unconfirmed)"""
+        state = self.states.get(index)
+        if state == "started":
+            return retry_unconfirmed  # unconfirmed: started, but no record of the outcome
+        return state != "done"
+
+    def start(self, index):
+        self._write([{"batch": index, "state": "started"}])
+
+    def finish(self, index, send_result):
+        entries = [{"batch": index, "email": email, "status": status, "_id": mandrill_id,
+                    "reject_reason": send_result.reject_reasons.get(email)}
+                   for email, status, mandrill_id in zip(send_result.emails, send_result.statuses, send_result.ids)]
+        entries.append({"batch": index, "state": "done"})
+        self._write(entries)
+
+    def fail(self, index, error):
+        self._write([{"batch": index, "state": "failed", "error": "%s" % error}])
+
+    def _write(self, entries):
+        # one write (and flush) per call, so a crash can only leave a partial last line
+        data = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with self._lock:
+            self._file.write(data if isinstance(data, type(u"")) else data.decode("utf-8"))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class BulkSender(object):
+    """Sends recipients in batches, logging progress to a results file"""
+
+    def __init__(self, results_path, message_options, batch_size=500, processes=1, concurrency=4,
+                 retry_unconfirmed=False, connection=None):
+        self.results_path = results_path
+        self.message_options = message_options
+        self.batch_size = batch_size
+        self.processes = processes
+        self.concurrency = concurrency
+        self.retry_unconfirmed = retry_unconfirmed
+        self.connection = connection or get_connection('djrill.mail.backends.djrill.DjrillBackend')
+
+    def run(self, recipients):
+        """Send recipients (an iterable of dicts, like read_recipients yields), and return a summary dict"""
+        log = BulkSendLog(self.results_path, self.batch_size)
+        build_pool = Pool(self.processes) if self.processes > 1 else None
+        try:
+            return self.send_logged(log, self._build_payloads(recipients, log, build_pool))
+        finally:
+            if build_pool is not None:
+                build_pool.close()
+                build_pool.join()
+            log.close()
+
+    def send_logged(self, log, payloads):
+        """Send (index, payload) items with up to self.concurrency at once, recording them in log
+
+        Returns a summary dict. Any batches_skipped or batches_unconfirmed counted
+        while iterating over payloads are included.
+        """
+        summary = self.summary = {"batches_sent": 0, "batches_failed": 0, "batches_skipped": 0,
+                                  "batches_unconfirmed": 0, "status_counts": {}}
+        in_flight = threading.BoundedSemaphore(self.concurrency * 2)
+        summary_lock = threading.Lock()
+        send_pool = ThreadPool(self.concurrency)
+        created_session = self.connection.open()
+
+        def send(index, payload):
+            try:
+                response = self.post(payload)
+                return index, self.connection.parse_response(response, payload, None), None
+            except (DjrillError, requests.RequestException) as err:
+                return index, None, err
+            except Exception:
+                # a bug, not a send problem: stop the whole run (sent isn't called for this batch)
+                logger.exception("Unexpected error sending batch %d", index)
+                in_flight.release()
+                raise
+
+        def sent(outcome):
+            index, send_result, err = outcome
+            try:
+                with summary_lock:
+                    if isinstance(send_result, MandrillSendResult):
+                        log.finish(index, send_result)
+                        if self.connection.send_record_writer is not None:
+                            self.connection.send_record_writer.add_result(send_result, self.reference)
+                        summary["batches_sent"] += 1
+                        for status, count in send_result.status_counts.items():
+                            summary["status_counts"][status] = summary["status_counts"].get(status, 0) + count
+                    elif was_not_sent(err):
+                        log.fail(index, err)
+                        summary["batches_failed"] += 1
+                    else:
+                        # no usable response (e.g., a timeout), so it may or may not have been sent
+                        summary["batches_unconfirmed"] += 1
+            finally:
+                in_flight.release()
+
+        try:
+            pending = []
+            for index, payload in payloads:
+                in_flight.acquire()
+                log.start(index)
+                pending.append(send_pool.apply_async(send, (index, payload), callback=sent))
+                for result in [result for result in pending if result.ready()]:
+                    result.get()  # (re-raises any unexpected error from send)
+                    pending.remove(result)
+            for result in pending:
+                result.get()
+        finally:
+            send_pool.close()
+            send_pool.join()
+            if created_session:
+                self.connection.close()
+        return summary
+
+    def post(self, payload):
+        """Post one batch's payload to Mandrill, and return the response"""
+        return self.connection.post_with_pool_key(payload, None)
+
+    @property
+    def reference(self):
+        return self.message_options.get('mandrill_reference', "")
+
+    def _build_payloads(self, recipients, log, build_pool):
+        for window in _windows(self._batches_to_send(recipients, log), self.processes * 4):
+            if build_pool is not None:
+                built = build_pool.map(_build_batch_payload, [(self.message_options, batch) for batch in window])
+            else:
+                built = [build_batch_payload(self.message_options, batch) for batch in window]
+            for index, payload in built:
+                yield index, payload
+
+    def _batches_to_send(self, recipients, log):
+        for index, batch in batched(recipients, self.batch_size):
+            if self.should_send(log, index):
+                yield index, batch
+
+    def should_send(self, log, index):
+        """Return True if batch index needs sending (else count it as skipped or unconfirmed)"""
+        if log.should_send(index, self.retry_unconfirmed):
+            return True
+        if log.states[index] == "done":
+            self.summary["batches_skipped"] += 1
+        else:
+            self.summary["batches_unconfirmed"] += 1
+        return False
+
+
+def was_not_sent(err):
+    """Return True if err (from sending a batch) means Mandrill definitely didn't send it"""
+    if isinstance(err, (MandrillUnavailableError, NotSerializableForMandrillError)):
+        return True
+    response = getattr(err, 'response', None)
+    return isinstance(err, MandrillAPIError) and response is not None and response.status_code != 200
+
+
+def _build_batch_payload(args):
+    return build_batch_payload(*args)
+
+
+def _windows(items, size):
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
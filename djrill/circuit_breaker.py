@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import deque
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """Stops calling the Mandrill API while it's failing.
+
+    Tracks the outcome of API calls over the last window seconds. Once at least
+    min_calls have been made and failure_rate of them have failed (or taken longer
+    than slow_call seconds), the breaker opens, and calls are refused without
+    trying the API. After reset_timeout seconds, it half-opens, letting one probe
+    call through: if that succeeds the breaker closes, and if not it opens again.
+    """
+
+    def __init__(self, failure_rate=0.5, min_calls=10, window=60, slow_call=None, reset_timeout=30):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._calls = deque()  # (time, failed)
+        self._failures = 0
+        self.state = CLOSED
+        self.opened_at = None
+        self.trips = 0  # number of times the breaker has opened
+        self._probe_started_at = None
+
+    def allow(self):
+        """Return True if an API call should be attempted now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            if self.state == OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+            # half-open: allow a single probe (or another, if the last one never reported back)
+            if self._probe_started_at is None or now - self._probe_started_at >= self.reset_timeout:
+                self._probe_started_at = now
+                return True
+            return False
+
+    def record(self, failed, duration=0, started=None):
+        """Record the outcome of an API call (which started at time started, if known)
+
+        While the breaker is open, outcomes are ignored: they're from calls that
+        started before it opened. While it's half-open, only the probe's outcome counts.
+        """
+        if self.slow_call is not None and duration > self.slow_call:
+            failed = True
+        with self._lock:
+            now = time.time()
+            if started is None:
+                started = now - duration
+            if self.state == OPEN:
+                return
+            if self.state == HALF_OPEN:
+                if self._probe_started_at is None or started < self._probe_started_at:
+                    return  # (not the probe)
+                self._probe_started_at = None
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = CLOSED
+                    self._calls.clear()
+                    self._failures = 0
+                return
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._failures -= self._calls.popleft()[1]
+            if len(self._calls) >= self.min_calls and self._failures >= self.failure_rate * len(self._calls):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._calls.clear()
+        self._failures = 0
+
+    def status(self):
+        """Return a dict describing the breaker's state, for monitoring"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "opened_at": self.opened_at if self.state != CLOSED else None,
+                "recent_calls": len(self._calls),
+                "recent_failures": self._failures,
+                "trips": self.trips,
+            }
+
+
+_breakers = {}  # api_url: CircuitBreaker
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(api_url, options):
+    """Return the shared CircuitBreaker for api_url, creating it with options (a dict) if needed"""
+    with _breakers_lock:
+        try:
+            return _breakers[api_url]
+        except KeyError:
+            breaker = _breakers[api_url] = CircuitBreaker(**options)
+            return breaker
+
+
+def circuit_breaker_status():
+    """Return {api_url: status dict} for every circuit breaker in use in this process"""
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    return dict((api_url, breaker.status()) for api_url, breaker in breakers)
@@ -0,0 +1,139 @@
+"""Compiling sends to a file of Mandrill payloads, and replaying them later
+
+DjrillDryRunBackend does all the work of sending (building, validating and
+serializing each message's payload) except calling the Mandrill API. Instead, it
+writes each payload to a JSONL file, one line per API call:
+
+    {"api_method": "messages/send.json", "payload": {...}}
+
+The payloads don't include your API key. PayloadReplayer (and the djrill_replay
+management command) sends a payloads file later, possibly from another machine,
+with many calls at once. Like djrill_bulk_send, it records each recipient's
+result in a results file, which also lets an interrupted replay resume.
+"""
+
+import io
+import json
+import threading
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .bulk_send import BulkSender, BulkSendLog
+from .mail.backends.djrill import DjrillBackend
+
+try:
+    from urlparse import urljoin  # python 2
+except ImportError:
+    from urllib.parse import urljoin  # python 3
+
+
+class DjrillDryRunBackend(DjrillBackend):
+    """DjrillBackend that writes the Mandrill payloads for its sends to a file, rather than posting them
+
+    The file is path (or the MANDRILL_DRY_RUN_FILE setting), appended to;
+    or pass a text stream instead. Each message's mandrill_response reports
+    "queued" for its recipients. The local scheduler (MANDRILL_SCHEDULER_DB) isn't
+    used: payloads with a send_at are written like any other.
+    """
+
+    def __init__(self, path=None, stream=None, **kwargs):
+        super(DjrillDryRunBackend, self).__init__(**kwargs)
+        self.path = path or getattr(settings, "MANDRILL_DRY_RUN_FILE", None)
+        if self.path is None and stream is None:
+            raise ImproperlyConfigured("Set MANDRILL_DRY_RUN_FILE in settings.py to use DjrillDryRunBackend")
+        self.stream = stream
+        self._opened_stream = False
+        self._write_lock = threading.Lock()
+
+    def load_settings(self):
+        super(DjrillDryRunBackend, self).load_settings()
+        self.scheduler = None
+
+    def post_to_mandrill(self, payload, message):
+        payload = dict(payload)
+        payload.pop('key', None)  # the replayer supplies its own
+        return super(DjrillDryRunBackend, self).post_to_mandrill(payload, message)
+
+    def post_json_to_mandrill(self, api_url, json_payload, payload=None, message=None):
+        # (json.dumps only puts newlines between tokens, never inside strings)
+        line = '{"api_method": %s, "payload": %s}\n' % (
+            json.dumps(self._api_method(api_url)), json_payload.replace("\n", " "))
+        with self._write_lock:
+            if self.stream is None:
+                self.stream = io.open(self.path, "a", encoding="utf-8")
+                self._opened_stream = True
+            self.stream.write(line if isinstance(line, type(u"")) else line.decode("utf-8"))
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = "utf-8"
+        response._content = json.dumps([
+            {"email": to['email'], "status": "queued", "_id": None, "reject_reason": None}
+            for to in payload['message'].get('to', [])]).encode("utf-8")
+        return response
+
+    def close(self):
+        super(DjrillDryRunBackend, self).close()
+        with self._write_lock:
+            if self._opened_stream:
+                self.stream.close()
+                self.stream = None
+                self._opened_stream = False
+            elif self.stream is not None:
+                self.stream.flush()
+
+
+def read_payloads(path):
+    """Yield (api_method, json payload str) for each line in a DjrillDryRunBackend payloads file
+
+    Raises ValueError for a line DjrillDryRunBackend didn't write.
+    """
+    with io.open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                # rather than re-serializing the payload, slice it out of the line
+                prefix, separator, json_payload = line.partition(', "payload": ')
+                json_payload = json_payload.rstrip()[:-1].rstrip()
+                try:
+                    api_method = json.loads(prefix + "}")["api_method"] if separator else None
+                except (KeyError, TypeError, ValueError):
+                    api_method = None
+                if not api_method or not (json_payload.startswith("{") and json_payload.endswith("}")):
+                    raise ValueError("%s line %d isn't a DjrillDryRunBackend payload" % (path, line_number))
+                yield api_method, json_payload
+
+
+class PayloadReplayer(BulkSender):
+    """Sends the payloads from a DjrillDryRunBackend file, logging results to a results file
+
+    Each payload is one "batch" in the results file (see djrill.bulk_send.BulkSendLog),
+    so running again with the same results file skips the ones already sent.
+    """
+
+    def __init__(self, results_path, concurrency=16, retry_unconfirmed=False, connection=None):
+        super(PayloadReplayer, self).__init__(results_path, {}, batch_size=1, concurrency=concurrency,
+                                              retry_unconfirmed=retry_unconfirmed, connection=connection)
+
+    def run(self, payloads):
+        """Send payloads (an iterable of (api_method, json payload str), like read_payloads yields)"""
+        log = BulkSendLog(self.results_path, self.batch_size)
+        try:
+            return self.send_logged(log, ((index, payload) for index, payload in enumerate(payloads)
+                                          if self.should_send(log, index)))
+        finally:
+            log.close()
+
+    def post(self, payload):
+        api_method, json_payload = payload
+        connection = self.connection
+        if connection.key_pool is not None:
+            payload = json.loads(json_payload)
+            connection.use_pool_key(payload, None)
+            json_payload = connection.serialize_payload(payload, None)
+        else:
+            payload = None
+            rest = json_payload.lstrip()[1:].lstrip()  # (after the opening brace)
+            separator = "" if rest.startswith("}") else ", "
+            json_payload = '{"key": %s%s%s' % (json.dumps(connection.api_key), separator, rest)
+        return connection.post_json_to_mandrill(urljoin(connection.api_url, api_method), json_payload, payload)
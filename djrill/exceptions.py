@@ -1,14 +1,25 @@
+import copy
 import json
 from requests import HTTPError
 
+from django.conf import settings
+
 
 class DjrillError(Exception):
     """Base class for exceptions raised by Djrill
 
     Overrides __str__ to provide additional information about
     Mandrill API call and response.
+
+    To avoid holding on to large sends (e.g., attachments) for as long as
+    the exception is around, the exception keeps only a summary of the
+    payload unless MANDRILL_RETAIN_ERROR_PAYLOAD is set. (Its response is
+    then detached from the request, whose body is the whole serialized payload.)
     """
 
+    # Number of recipients (and recipient statuses) to include in descriptions
+    max_described_recipients = 10
+
     def __init__(self, *args, **kwargs):
         """
         Optional kwargs:
@@ -17,36 +28,69 @@ class DjrillError(Exception):
           response: requests.Response from the send call
         """
         self.email_message = kwargs.pop('email_message', None)
-        self.payload = kwargs.pop('payload', None)
+        payload = kwargs.pop('payload', None)
+        self.send_summary = self.summarize_payload(payload)
+        if getattr(settings, 'MANDRILL_RETAIN_ERROR_PAYLOAD', False):
+            self.payload = payload
+        else:
+            self.payload = None
+            if kwargs.get('response') is not None:
+                kwargs['response'] = _without_request(kwargs['response'])
         if isinstance(self, HTTPError):
             # must leave response in kwargs for HTTPError
             self.response = kwargs.get('response', None)
         else:
             self.response = kwargs.pop('response', None)
+        self._description = None
         super(DjrillError, self).__init__(*args, **kwargs)
 
     def __str__(self):
-        parts = [
-            " ".join([str(arg) for arg in self.args]),
-            self.describe_send(),
-            self.describe_response(),
-        ]
-        return "\n".join(filter(None, parts))
+        if self._description is None:
+            parts = [
+                " ".join([str(arg) for arg in self.args]),
+                self.describe_send(),
+                self.describe_response(),
+            ]
+            self._description = "\n".join(filter(None, parts))
+        return self._description
+
+    def summarize_payload(self, payload):
+        """Return a compact dict describing the Mandrill send payload, or None"""
+        if payload is None:
+            return None
+        try:
+            msg_dict = payload['message']
+        except (KeyError, TypeError):
+            return {}
+        to_list = msg_dict.get('to', [])
+        attachments = msg_dict.get('attachments', []) + msg_dict.get('images', [])
+        return {
+            'to': [to.get('email') for to in to_list[:self.max_described_recipients]],
+            'recipient_count': len(to_list),
+            'from_email': msg_dict.get('from_email'),
+            'template_name': payload.get('template_name'),
+            # (approximate decoded size from base64 length)
+            'attachments': [(att.get('name'), len(att.get('content', "")) * 3 // 4) for att in attachments],
+        }
 
     def describe_send(self):
-        """Return a string describing the Mandrill send in self.payload, or None"""
-        if self.payload is None:
+        """Return a string describing the Mandrill send summarized in self.send_summary, or None"""
+        if self.send_summary is None:
             return None
         description = "Sending a message"
-        try:
-            to_emails = [to['email'] for to in self.payload['message']['to']]
-            description += " to %s" % ','.join(to_emails)
-        except KeyError:
-            pass
-        try:
-            description += " from %s" % self.payload['message']['from_email']
-        except KeyError:
-            pass
+        summary = self.send_summary
+        if summary.get('to'):
+            description += " to %s" % ','.join(summary['to'])
+            more = summary['recipient_count'] - len(summary['to'])
+            if more > 0:
+                description += " (and %d more)" % more
+        if summary.get('from_email'):
+            description += " from %s" % summary['from_email']
+        if summary.get('template_name'):
+            description += " using template %s" % summary['template_name']
+        if summary.get('attachments'):
+            description += " with attachments %s" % ', '.join(
+                "%s (%d bytes)" % (name or "(unnamed)", size) for name, size in summary['attachments'])
         return description
 
     def describe_response(self):
@@ -56,7 +100,18 @@ class DjrillError(Exception):
         description = "Mandrill API response %d:" % self.response.status_code
         try:
             json_response = self.response.json()
-            description += "\n" + json.dumps(json_response, indent=2)
+            if isinstance(json_response, list) and len(json_response) > self.max_described_recipients:
+                # Summarize large per-recipient responses
+                status_counts = {}
+                for item in json_response:
+                    status = item.get('status') if isinstance(item, dict) else None
+                    status_counts[status] = status_counts.get(status, 0) + 1
+                description += " %s" % ", ".join(
+                    "%d %s" % (count, status) for status, count in sorted(status_counts.items(), key=str))
+                description += "\n" + json.dumps(json_response[:self.max_described_recipients], indent=2)
+                description += "\n(and %d more)" % (len(json_response) - self.max_described_recipients)
+            else:
+                description += "\n" + json.dumps(json_response, indent=2)
         except (AttributeError, KeyError, ValueError):  # not JSON = ValueError
             try:
                 description += " " + self.response.text
@@ -65,6 +120,16 @@ class DjrillError(Exception):
         return description
 
 
+def _without_request(response):
+    """Return a copy of requests.Response response that doesn't refer to its request (or redirect history)"""
+    if getattr(response, 'request', None) is None and not getattr(response, 'history', None):
+        return response
+    response = copy.copy(response)  # (requests.Response copies its already-read content, and not its raw stream)
+    response.request = None
+    response.history = []
+    return response
+
+
 class MandrillAPIError(DjrillError, HTTPError):
     """Exception for unsuccessful response from Mandrill API."""
 
@@ -74,6 +139,19 @@ class MandrillAPIError(DjrillError, HTTPError):
             self.status_code = self.response.status_code
 
 
+class MandrillUnavailableError(MandrillAPIError):
+    """Exception for a send refused without calling Mandrill, because the API is failing.
+
+    This is only raised if you've enabled MANDRILL_CIRCUIT_BREAKER (and haven't
+    set a MANDRILL_FALLBACK_BACKEND), while the circuit breaker is open.
+    """
+
+    def __init__(self, message=None, *args, **kwargs):
+        if message is None:
+            message = "Mandrill API calls are failing; not trying again yet"
+        super(MandrillUnavailableError, self).__init__(message, *args, **kwargs)
+
+
 class MandrillRecipientsRefused(DjrillError):
     """Exception for send where all recipients are invalid or rejected."""
 
@@ -83,6 +161,23 @@ class MandrillRecipientsRefused(DjrillError):
         super(MandrillRecipientsRefused, self).__init__(message, *args, **kwargs)
 
 
+class MandrillTemplateError(DjrillError, ValueError):
+    """Exception for a template send that doesn't match the Mandrill template.
+
+    This is only raised if you've enabled MANDRILL_TEMPLATE_VALIDATION,
+    which checks template sends against a cached copy of the template
+    before calling Mandrill's send-template API.
+    """
+
+
+class MandrillTemplateWarning(UserWarning):
+    """Warning for a template send with merge vars that the Mandrill template doesn't use.
+
+    Like MandrillTemplateError, this is only issued if you've enabled
+    MANDRILL_TEMPLATE_VALIDATION. The message is still sent.
+    """
+
+
 class NotSupportedByMandrillError(DjrillError, ValueError):
     """Exception for email features that Mandrill doesn't support.
 
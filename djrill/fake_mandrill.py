@@ -0,0 +1,301 @@
+"""An in-process imitation of the Mandrill API, for offline testing and load testing
+
+FakeMandrill implements the Mandrill API calls Djrill uses (and a few others),
+with configurable latency, error rates and rate limiting. There are three ways
+to put it in front of Djrill, all of which exercise the real send path,
+including the requests HTTP machinery:
+
+* Use FakeMandrillBackend as your EMAIL_BACKEND. It mounts a FakeMandrillAdapter
+  (a requests transport adapter) on its session, so nothing goes over the network.
+* Mount a FakeMandrillAdapter on your own requests session.
+* Run a FakeMandrillServer (a local HTTP server), and point MANDRILL_API_URL at it.
+"""
+
+import errno
+import itertools
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from io import BytesIO
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # python 2
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # python 3
+    from socketserver import ThreadingMixIn
+
+from .mail.backends.djrill import DjrillBackend
+
+
+class FakeMandrill(object):
+    """Imitation Mandrill API.
+
+    Options (all can also be changed later with configure):
+      latency: seconds to wait before responding, or a (min, max) range
+      error_rate: fraction of calls that fail with a 500 GeneralError
+      rate_limit_rate: fraction of calls that fail with a 429 rate-limit error
+      rejects: email addresses to report as rejected (as if on the blacklist)
+      templates: dict of template name: templates/info response
+      api_key: if set, calls with any other key fail with Invalid_Key
+      seed: random seed, for reproducible errors
+    """
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.latency = 0
+        self.error_rate = 0
+        self.rate_limit_rate = 0
+        self.rejects = set()
+        self.templates = {}
+        self.api_key = None
+        self.random = random.Random()
+        self.configure(**options)
+        self.reset()
+
+    def configure(self, latency=None, error_rate=None, rate_limit_rate=None,
+                  rejects=None, templates=None, api_key=None, seed=None):
+        if latency is not None:
+            self.latency = latency
+        if error_rate is not None:
+            self.error_rate = error_rate
+        if rate_limit_rate is not None:
+            self.rate_limit_rate = rate_limit_rate
+        if rejects is not None:
+            self.rejects = set(email.lower() for email in rejects)
+        if templates is not None:
+            self.templates = dict(templates)
+        if api_key is not None:
+            self.api_key = api_key
+        if seed is not None:
+            self.random.seed(seed)
+
+    def reset(self):
+        """Clear the call and recipient counters"""
+        with self._lock:
+            self.call_counts = {}  # api_method: number of calls
+            self.status_counts = {}  # http status: number of responses
+            self.recipient_count = 0  # recipients in successful sends
+
+    def call(self, api_method, body):
+        """Handle a Mandrill API call. Returns (http status, response data)."""
+        self._wait()
+        status, data = self._respond(api_method, body)
+        with self._lock:
+            self.call_counts[api_method] = self.call_counts.get(api_method, 0) + 1
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            if status == 200 and api_method.startswith("messages/send"):
+                self.recipient_count += len(data)
+        return status, data
+
+    def _wait(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self.random.uniform(*latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _respond(self, api_method, body):
+        if self.rate_limit_rate and self.random.random() < self.rate_limit_rate:
+            return 429, error_response("Too_Many_Requests", "Rate limit exceeded (fake)")
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, error_response("GeneralError", "Simulated error (fake)")
+        try:
+            params = json.loads(body.decode('utf-8') if isinstance(body, bytes) else body)
+        except (AttributeError, TypeError, ValueError):
+            return 500, error_response("ValidationError", "You must specify a key value")
+        if not isinstance(params, dict) or not params.get('key'):
+            return 500, error_response("ValidationError", "You must specify a key value")
+        if self.api_key is not None and params['key'] != self.api_key:
+            return 500, error_response("Invalid_Key", "Invalid API key", code=-1)
+
+        handler = self.handlers.get(api_method)
+        if handler is None:
+            return 500, error_response("ValidationError", "Unknown API method %s" % api_method)
+        return handler(self, params)
+
+    #
+    # API methods
+    #
+
+    def send(self, params):
+        try:
+            to_list = params['message']['to']
+        except (KeyError, TypeError):
+            return 500, error_response("ValidationError", "Validation error: message.to is required")
+        return 200, [self._recipient_status(to.get('email', ""), params.get('async')) for to in to_list]
+
+    def send_template(self, params):
+        name = params.get('template_name')
+        if self.templates and name not in self.templates:
+            return 500, error_response("Unknown_Template", "No such template \"%s\"" % name, code=5)
+        return self.send(params)
+
+    def send_raw(self, params):
+        to_list = params.get('to') or []
+        return 200, [self._recipient_status(email, params.get('async')) for email in to_list]
+
+    def ping(self, params):
+        return 200, "PONG!"
+
+    def ping2(self, params):
+        return 200, {"PING": "PONG!"}
+
+    def rejects_list(self, params):
+        email = params.get('email')
+        return 200, [{"email": reject, "reason": "hard-bounce", "expired": False}
+                     for reject in sorted(self.rejects) if email is None or reject == email.lower()][:1000]
+
+    def templates_info(self, params):
+        try:
+            return 200, self.templates[params.get('name')]
+        except KeyError:
+            return 500, error_response("Unknown_Template", "No such template \"%s\"" % params.get('name'), code=5)
+
+    handlers = {
+        "messages/send.json": send,
+        "messages/send-template.json": send_template,
+        "messages/send-raw.json": send_raw,
+        "users/ping.json": ping,
+        "users/ping2.json": ping2,
+        "rejects/list.json": rejects_list,
+        "templates/info.json": templates_info,
+    }
+
+    def _recipient_status(self, email, async_send=False):
+        if "@" not in email:
+            status, reject_reason = "invalid", None
+        elif email.lower() in self.rejects:
+            status, reject_reason = "rejected", "hard-bounce"
+        else:
+            status, reject_reason = "queued" if async_send else "sent", None
+        return {"email": email, "status": status, "reject_reason": reject_reason,
+                "_id": "%032x" % next(self._ids)}
+
+
+def error_response(name, message, code=-2):
+    return {"status": "error", "code": code, "name": name, "message": message}
+
+
+def api_method_from_path(path):
+    """Return the Mandrill API method (e.g., "messages/send.json") from a url path"""
+    path = path.split('?', 1)[0]
+    try:
+        return path.split("/api/1.0/", 1)[1]
+    except IndexError:
+        return path.lstrip("/")
+
+
+class FakeMandrillAdapter(BaseAdapter):
+    """requests transport adapter that answers Mandrill API calls from a FakeMandrill"""
+
+    def __init__(self, fake=None):
+        super(FakeMandrillAdapter, self).__init__()
+        self.fake = fake if fake is not None else fake_mandrill
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        status, data = self.fake.call(api_method_from_path(request.path_url), request.body)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json; charset=utf-8"})
+        response.raw = BytesIO(json.dumps(data).encode('utf-8'))
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeMandrillBackend(DjrillBackend):
+    """DjrillBackend that sends to the shared in-process fake_mandrill, rather than the Mandrill API"""
+
+    def load_settings(self):
+        super(FakeMandrillBackend, self).load_settings()
+        self.session_class = requests.Session  # (whatever MANDRILL_TRANSPORT says: the adapter needs requests)
+
+    def open(self):
+        created_session = super(FakeMandrillBackend, self).open()
+        if created_session:
+            self.session.mount(self.api_url, FakeMandrillAdapter(fake_mandrill))
+        return created_session
+
+
+class FakeMandrillServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP server that answers Mandrill API calls from a FakeMandrill.
+
+    Usage:
+        with FakeMandrillServer() as server:
+            # set MANDRILL_API_URL = server.api_url
+            ...
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fake=None, host="127.0.0.1", port=0):
+        HTTPServer.__init__(self, (host, port), FakeMandrillRequestHandler)
+        self.fake = fake if fake is not None else fake_mandrill
+        self._thread = None
+
+    @property
+    def api_url(self):
+        return "http://%s:%d/api/1.0" % self.server_address[:2]
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def handle_error(self, request, client_address):
+        # A client that hung up before its response was written (e.g., after a
+        # read timeout) isn't a server error worth printing a traceback for
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error) and err.errno in (errno.EPIPE, errno.ECONNRESET):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class FakeMandrillRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # else each keep-alive response waits out a delayed ack
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        status, data = self.server.fake.call(api_method_from_path(self.path), body)
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # load tests generate far too much to log
+
+
+fake_mandrill = FakeMandrill()
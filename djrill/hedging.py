@@ -0,0 +1,137 @@
+"""Hedged requests for idempotent (read-only) Mandrill API calls
+
+If a read-only API call (like templates/info or rejects/list) hasn't
+answered within the recent 95th percentile latency, a second, identical
+call is started, and whichever answers first is used.
+
+Sends are never hedged: Mandrill's send APIs have no idempotency key,
+so a hedged send could deliver the message twice.
+"""
+
+import threading
+import time
+from collections import deque
+try:
+    from Queue import Queue, Empty  # python 2
+except ImportError:
+    from queue import Queue, Empty  # python 3
+
+from .metrics import metrics
+
+
+# Mandrill API methods that are safe to call twice
+IDEMPOTENT_API_METHODS = frozenset([
+    "rejects/list.json",
+    "senders/info.json",
+    "subaccounts/info.json",
+    "templates/info.json",
+    "templates/list.json",
+    "users/info.json",
+    "users/ping.json",
+    "users/ping2.json",
+])
+
+
+class Hedger(object):
+    """Runs calls with a hedge after the recent percentile latency, and keeps hedging stats"""
+
+    idempotent_api_methods = IDEMPOTENT_API_METHODS
+
+    def __init__(self, percentile=0.95, initial_delay=1.0, min_delay=0.05, samples=200, min_samples=20):
+        self.percentile = percentile
+        self.initial_delay = initial_delay  # until there are min_samples latencies
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self):
+        """Return how long to wait for a call before hedging it"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        return max(latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)], self.min_delay)
+
+    def call(self, func):
+        """Return func(), calling it a second time in parallel if the first call is slow
+
+        If the first call to finish raises an exception, and the other is still
+        running, its result is used instead.
+        """
+        results = Queue()
+
+        def run(is_hedge):
+            try:
+                results.put((is_hedge, func(), None))
+            except Exception as err:
+                results.put((is_hedge, None, err))
+
+        started = time.time()
+        self._start(run, False)
+        try:
+            result = results.get(timeout=self.hedge_delay())
+            hedged = False
+        except Empty:
+            self._start(run, True)
+            result = results.get()
+            hedged = True
+            if result[2] is not None:
+                result = results.get()  # try the other call
+
+        is_hedge, value, err = result
+        hedge_won = hedged and is_hedge and err is None
+        with self._lock:
+            self.calls += 1
+            if hedged:
+                self.hedged += 1
+                if hedge_won:
+                    self.hedge_wins += 1
+            if err is None:
+                self._latencies.append(time.time() - started)  # as observed by the caller
+        metrics.inc("djrill_hedged_calls_total",
+                    outcome="hedge_won" if hedge_won else "first_won" if hedged else "not_hedged")
+        if err is not None:
+            raise err
+        return value
+
+    @staticmethod
+    def _start(run, is_hedge):
+        thread = threading.Thread(target=run, args=(is_hedge,))
+        thread.daemon = True
+        thread.start()
+
+    def stats(self):
+        """Return a dict of hedging counts and rates"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": float(self.hedged) / self.calls if self.calls else 0.0,
+                "win_rate": float(self.hedge_wins) / self.hedged if self.hedged else 0.0,
+            }
+
+
+_hedgers = {}  # api_url: Hedger
+_hedgers_lock = threading.Lock()
+
+
+def get_hedger(api_url, options):
+    """Return the shared Hedger for api_url, creating it with options (a dict) if needed"""
+    with _hedgers_lock:
+        try:
+            return _hedgers[api_url]
+        except KeyError:
+            hedger = _hedgers[api_url] = Hedger(**options)
+            return hedger
+
+
+def hedge_stats():
+    """Return {api_url: stats dict} for every Hedger in use in this process"""
+    with _hedgers_lock:
+        hedgers = list(_hedgers.items())
+    return dict((api_url, hedger.stats()) for api_url, hedger in hedgers)
@@ -0,0 +1,212 @@
+"""Spread sends across several Mandrill API keys and/or subaccounts
+
+Configured with the MANDRILL_API_KEYS setting, a list of dicts like:
+    {"key": "...", "subaccount": "tenant-a", "weight": 2, "rate_limit": 20, "name": "tenant-a"}
+where everything but "key" is optional ("rate_limit" is messages per second).
+A plain API key string is also allowed in the list.
+
+Each message is routed by the optional MANDRILL_KEY_FUNCTION, which takes the
+EmailMessage and returns a routing value (e.g., a tenant id, tag, or domain):
+  * a value that matches a pool entry's name is sent with that entry
+  * any other value is consistently hashed to an entry (in proportion to the weights)
+  * None (or no key function) spreads messages over the entries by weight
+
+Rate limits are enforced by waiting: a send routed to an entry that's over its
+rate_limit (or an unrouted send when every entry is) sleeps in the sending
+thread until the entry has capacity again.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from importlib import import_module
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+class PoolKey(object):
+    """One API key (and/or subaccount) in a KeyPool, with its rate limit and counters"""
+
+    def __init__(self, key, subaccount=None, weight=1, rate_limit=None, name=None):
+        if weight <= 0:
+            raise ImproperlyConfigured("MANDRILL_API_KEYS weight must be positive")
+        self.key = key
+        self.subaccount = subaccount
+        self.weight = weight
+        self.rate_limit = rate_limit
+        self.name = name or subaccount or "...%s" % key[-4:]
+        self._lock = threading.Lock()
+        # token bucket (allows bursts of up to one second's worth of sends):
+        self._tokens = self._capacity
+        self._refilled_at = time.time()
+        self.messages = 0
+        self.recipients = 0
+        self.errors = 0
+        self.throttled = 0
+
+    @property
+    def _capacity(self):
+        return max(self.rate_limit, 1) if self.rate_limit else None
+
+    def try_acquire(self):
+        """Take a send token if one's available. Returns 0 if so, else seconds until there will be one."""
+        if not self.rate_limit:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._capacity, self._tokens + (now - self._refilled_at) * float(self.rate_limit))
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / float(self.rate_limit)
+
+    def acquire(self):
+        """Wait for a send token"""
+        wait = self.try_acquire()
+        if wait:
+            with self._lock:
+                self.throttled += 1
+            while wait:
+                time.sleep(wait)
+                wait = self.try_acquire()
+
+    def count_send(self, recipients):
+        with self._lock:
+            self.messages += 1
+            self.recipients += recipients
+
+    def count_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def stats(self):
+        """Return a dict of this key's settings and counters (without the key itself)"""
+        return {
+            "name": self.name, "subaccount": self.subaccount,
+            "weight": self.weight, "rate_limit": self.rate_limit,
+            "messages": self.messages, "recipients": self.recipients,
+            "errors": self.errors, "throttled": self.throttled,
+        }
+
+
+class KeyPool(object):
+    """Routes messages to PoolKeys"""
+
+    def __init__(self, keys):
+        self.keys = []
+        for entry in keys:
+            if not isinstance(entry, dict):
+                entry = {"key": entry}
+            try:
+                self.keys.append(PoolKey(**entry))
+            except TypeError:
+                raise ImproperlyConfigured(
+                    "MANDRILL_API_KEYS entries must be API key strings or dicts with a 'key' "
+                    "and optional 'subaccount', 'weight', 'rate_limit' and 'name'")
+        if not self.keys:
+            raise ImproperlyConfigured("MANDRILL_API_KEYS must not be empty")
+        names = [pool_key.name for pool_key in self.keys]
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        if duplicates:
+            raise ImproperlyConfigured(
+                "MANDRILL_API_KEYS has more than one entry named %s; give each entry a distinct 'name'"
+                % ", ".join("'%s'" % name for name in duplicates))
+        self._by_name = dict((pool_key.name, pool_key) for pool_key in self.keys)
+        self._lock = threading.Lock()
+        self._current_weights = [0] * len(self.keys)
+
+    def select(self, route=None):
+        """Return the PoolKey to use for a message with routing value route, waiting out its rate limit
+
+        (This blocks the calling thread, with time.sleep, while the chosen key is over its rate limit.)
+        """
+        if route is not None:
+            pool_key = self.routed(route)
+            pool_key.acquire()
+            return pool_key
+
+        # Unrouted: use the next key in weighted order, or if that's over
+        # its rate limit, the next key after it that isn't
+        pool_key = self._next_weighted()
+        if pool_key.try_acquire() == 0:
+            return pool_key
+        start = self.keys.index(pool_key)
+        for other in self.keys[start + 1:] + self.keys[:start]:
+            if other.try_acquire() == 0:
+                with pool_key._lock:
+                    pool_key.throttled += 1
+                return other
+        pool_key.acquire()  # they're all busy
+        return pool_key
+
+    def routed(self, route):
+        """Return the PoolKey that (non-None) routing value route always uses, without waiting"""
+        pool_key = self._by_name.get(route)
+        if pool_key is None:
+            pool_key = self._hashed(route)
+        return pool_key
+
+    def _next_weighted(self):
+        # "Smooth" weighted round robin: spreads each key's sends evenly over the cycle
+        with self._lock:
+            total = 0
+            best = None
+            for i, pool_key in enumerate(self.keys):
+                self._current_weights[i] += pool_key.weight
+                total += pool_key.weight
+                if best is None or self._current_weights[i] > self._current_weights[best]:
+                    best = i
+            self._current_weights[best] -= total
+            return self.keys[best]
+
+    def _hashed(self, route):
+        # Weighted rendezvous hashing: consistent for each route, and adding
+        # or removing a key only moves the routes that hashed to that key
+        def score(pool_key):
+            digest = hashlib.md5(("%s:%s" % (pool_key.name, route)).encode('utf-8')).hexdigest()
+            fraction = (int(digest[:13], 16) + 1) / float(16 ** 13 + 1)  # in (0, 1)
+            return -pool_key.weight / math.log(fraction)
+        return max(self.keys, key=score)
+
+    def stats(self):
+        """Return a list of the stats dict for each key in the pool"""
+        return [pool_key.stats() for pool_key in self.keys]
+
+
+_pools = {}  # repr(MANDRILL_API_KEYS): KeyPool
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(keys):
+    """Return the shared KeyPool for the MANDRILL_API_KEYS setting keys
+
+    (The pool is shared by all backend instances with the same setting, so its
+    rate limits and counters cover every send in the process.)
+    """
+    config = repr(keys)
+    with _pools_lock:
+        try:
+            return _pools[config]
+        except KeyError:
+            pool = _pools[config] = KeyPool(keys)
+            return pool
+
+
+def key_pool_stats():
+    """Return {pool entry name: stats dict} for every key in use in this process"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return dict((stats["name"], stats) for pool in pools for stats in pool.stats())
+
+
+def get_key_function(key_function):
+    """Return the MANDRILL_KEY_FUNCTION callable, importing it if it's a dotted path string"""
+    if key_function is None or callable(key_function):
+        return key_function
+    try:
+        module_name, attr = key_function.rsplit('.', 1)
+        return getattr(import_module(module_name), attr)
+    except (AttributeError, ImportError, ValueError):
+        raise ImproperlyConfigured("MANDRILL_KEY_FUNCTION '%s' could not be imported" % key_function)
@@ -1,7 +1,12 @@
 import json
 import mimetypes
+import re
 import requests
+import threading
+import time
+import warnings
 from base64 import b64encode
+from collections import OrderedDict
 from datetime import date, datetime
 from email.mime.base import MIMEBase
 from email.utils import parseaddr
@@ -12,12 +17,30 @@ except ImportError:
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.message import sanitize_address, DEFAULT_ATTACHMENT_MIME_TYPE
 
+from django.dispatch import receiver
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed  # Django < 1.8
+
 from ..._version import __version__
-from ...exceptions import (DjrillError, MandrillAPIError, MandrillRecipientsRefused,
-                           NotSerializableForMandrillError, NotSupportedByMandrillError)
+from ...exceptions import (DjrillError, MandrillAPIError, MandrillRecipientsRefused, MandrillTemplateError,
+                           MandrillTemplateWarning, MandrillUnavailableError, NotSerializableForMandrillError,
+                           NotSupportedByMandrillError)
+from ...metrics import count_recipient_statuses, metrics
+from ...recipient_data import RecipientData
+from ...send_result import RESENDABLE_REJECT_REASONS, MandrillSendResult
+from ...tracing import get_tracer
+# Optional features (circuit_breaker, hedging, key_pool, rejects, scheduler, send_records, template_cache,
+# transports) are imported only when they're used, to keep importing the backend fast.
+
+# Default MANDRILL_API_TIMEOUT (connect, read) seconds: the read timeout is generous,
+# because Mandrill can take a while to accept a send with many recipients or attachments
+DEFAULT_API_TIMEOUT = (10, 120)
 
 
 class DjrillBackend(BaseEmailBackend):
@@ -29,10 +52,40 @@ class DjrillBackend(BaseEmailBackend):
         """Init options from Django settings"""
         super(DjrillBackend, self).__init__(**kwargs)
 
+        # Django constructs a new backend for every send_mail, so load_settings
+        # only runs once (per backend class) until the settings change
+        config = _settings_cache.get(type(self))
+        if config is None:
+            before = set(vars(self))
+            self.load_settings()
+            config = _settings_cache[type(self)] = dict(
+                (attr, value) for attr, value in vars(self).items() if attr not in before)
+        else:
+            self.__dict__.update(config)
+        self.session = None
+
+    def load_settings(self):
+        """Set the backend's options from Django settings
+
+        The resulting attributes are cached and shared by later instances (until a
+        Mandrill setting changes), so must not be modified after this returns.
+        """
+        api_keys = getattr(settings, "MANDRILL_API_KEYS", None)
+        if api_keys:
+            from ...key_pool import get_key_function, get_key_pool
+            self.key_pool = get_key_pool(api_keys)
+            self.key_function = get_key_function(getattr(settings, "MANDRILL_KEY_FUNCTION", None))
+        else:
+            self.key_pool = None
+            self.key_function = None
+
         try:
             self.api_key = settings.MANDRILL_API_KEY
         except AttributeError:
-            raise ImproperlyConfigured("Set MANDRILL_API_KEY in settings.py to use Djrill")
+            if self.key_pool is None:
+                raise ImproperlyConfigured("Set MANDRILL_API_KEY in settings.py to use Djrill")
+            # use the pool's first key for API calls other than sending
+            self.api_key = self.key_pool.keys[0].key
 
         self.api_url = getattr(settings, "MANDRILL_API_URL", "https://mandrillapp.com/api/1.0")
         if not self.api_url.endswith("/"):
@@ -52,18 +105,73 @@ class DjrillBackend(BaseEmailBackend):
             pass  # no MANDRILL_SUBACCOUNT setting
 
         self.ignore_recipient_status = getattr(settings, "MANDRILL_IGNORE_RECIPIENT_STATUS", False)
-        self.session = None
+        self.reject_filter = getattr(settings, "MANDRILL_REJECT_FILTER", False)
+        self.reject_list_max_age = getattr(settings, "MANDRILL_REJECT_LIST_MAX_AGE", 3600)
+        self.template_validation = getattr(settings, "MANDRILL_TEMPLATE_VALIDATION", False)
+        self.template_cache_ttl = getattr(settings, "MANDRILL_TEMPLATE_CACHE_TTL", 300)
+        self.render_templates_locally = getattr(settings, "MANDRILL_RENDER_TEMPLATES_LOCALLY", False)
+        self.sort_recipient_data = getattr(settings, "MANDRILL_SORT_RECIPIENT_DATA", True)
+        self.max_recipients_per_send = getattr(settings, "MANDRILL_MAX_RECIPIENTS_PER_SEND", None)
+        self.send_threads = getattr(settings, "MANDRILL_SEND_THREADS", 4)
+        scheduler_db = getattr(settings, "MANDRILL_SCHEDULER_DB", None)
+        if scheduler_db:
+            from ...scheduler import get_scheduler
+            self.scheduler = get_scheduler(scheduler_db)
+        else:
+            self.scheduler = None
+
+        circuit_breaker = getattr(settings, "MANDRILL_CIRCUIT_BREAKER", False)
+        if circuit_breaker:
+            from ...circuit_breaker import get_circuit_breaker
+            try:
+                self.circuit_breaker = get_circuit_breaker(
+                    self.api_url, circuit_breaker if isinstance(circuit_breaker, dict) else {})
+            except TypeError:
+                raise ImproperlyConfigured("MANDRILL_CIRCUIT_BREAKER must be True or a dict of CircuitBreaker options")
+        else:
+            self.circuit_breaker = None
+        self.fallback_backend = getattr(settings, "MANDRILL_FALLBACK_BACKEND", None)
+
+        transport = getattr(settings, "MANDRILL_TRANSPORT", "requests")
+        if transport == "requests":
+            self.session_class = requests.Session
+        else:
+            from ...transports import get_session_class
+            self.session_class = get_session_class(transport)
+        self.timeout = getattr(settings, "MANDRILL_API_TIMEOUT", DEFAULT_API_TIMEOUT)
+        if isinstance(self.timeout, list):
+            self.timeout = tuple(self.timeout)  # requests wants a (connect, read) tuple
+        hedge_reads = getattr(settings, "MANDRILL_HEDGE_READS", False)
+        if hedge_reads:
+            from ...hedging import get_hedger
+            try:
+                self.hedger = get_hedger(self.api_url, hedge_reads if isinstance(hedge_reads, dict) else {})
+            except TypeError:
+                raise ImproperlyConfigured("MANDRILL_HEDGE_READS must be True or a dict of Hedger options")
+        else:
+            self.hedger = None
+        self.tracer = get_tracer(getattr(settings, "MANDRILL_TRACING", False))
+        record_sends = getattr(settings, "MANDRILL_RECORD_SENDS", False)
+        if record_sends:
+            from ...send_records import get_send_record_writer
+            try:
+                self.send_record_writer = get_send_record_writer(
+                    record_sends if isinstance(record_sends, dict) else {})
+            except TypeError:
+                raise ImproperlyConfigured("MANDRILL_RECORD_SENDS must be True or a dict of SendRecordWriter options")
+        else:
+            self.send_record_writer = None
 
     def open(self):
         """
-        Ensure we have a requests Session to connect to the Mandrill API.
+        Ensure we have a session (see MANDRILL_TRANSPORT) to connect to the Mandrill API.
         Returns True if a new session was created (and the caller must close it).
         """
         if self.session:
             return False  # already exists
 
         try:
-            self.session = requests.Session()
+            self.session = self.session_class()
         except requests.RequestException:
             if not self.fail_silently:
                 raise
@@ -103,10 +211,12 @@ class DjrillBackend(BaseEmailBackend):
 
         num_sent = 0
         try:
-            for message in email_messages:
-                sent = self._send(message)
-                if sent:
-                    num_sent += 1
+            with self.tracer.span("djrill.send_messages", {"djrill.messages": len(email_messages)}):
+                for message in email_messages:
+                    with self.tracer.span("djrill.send"):
+                        sent = self._send(message)
+                    if sent:
+                        num_sent += 1
         finally:
             if created_session:
                 self.close()
@@ -119,21 +229,64 @@ class DjrillBackend(BaseEmailBackend):
             return False
 
         try:
-            payload = self.get_base_payload()
-            self.build_send_payload(payload, message)
-            response = self.post_to_mandrill(payload, message)
+            with self.tracer.span("djrill.build_payload"):
+                payload = self.get_base_payload()
+                self.build_send_payload(payload, message)
+                if self.template_validation and 'template_name' in payload:
+                    self.validate_template(payload, message)
+                locally_rejected = []
+                if self.reject_filter:
+                    locally_rejected = self.remove_rejected_recipients(payload, message)
+
+            result = "sent"
+            if locally_rejected and not payload['message']['to']:
+                # every recipient is on the local reject list, so don't bother calling Mandrill
+                response = None
+                parsed_response = MandrillSendResult([])
+            elif self.scheduler is not None and self._is_due_later(payload):
+                response = None
+                parsed_response = self.schedule_send(payload, message)
+                result = "scheduled"
+            else:
+                chunks = None
+                if self.max_recipients_per_send and not payload['message'].get('preserve_recipients'):
+                    chunks = self.split_payload(payload, self.max_recipients_per_send)
+                try:
+                    if chunks is not None and len(chunks) > 1:
+                        response = None
+                        parsed_response = self.send_chunks(chunks, message)
+                    else:
+                        response = self.post_with_pool_key(payload, message)
+                        with self.tracer.span("djrill.parse_response"):
+                            parsed_response = self.parse_response(response, payload, message)
+                except MandrillUnavailableError:
+                    if self.fallback_backend is None or message.mandrill_response is not None:
+                        raise  # (or some chunks have already been sent)
+                    metrics.inc("djrill_messages_total", result="fallback")
+                    return self.send_with_fallback(message)
+            if locally_rejected:
+                if isinstance(parsed_response, MandrillSendResult):
+                    parsed_response.extend(locally_rejected)
+                else:
+                    parsed_response = list(parsed_response) + locally_rejected
 
             # add the response from mandrill to the EmailMessage so callers can inspect it
-            message.mandrill_response = self.parse_response(response, payload, message)
-            self.validate_response(message.mandrill_response, response, payload, message)
+            message.mandrill_response = parsed_response
+            count_recipient_statuses(parsed_response)
+            if self.send_record_writer is not None and isinstance(parsed_response, MandrillSendResult):
+                self.send_record_writer.add_result(parsed_response, getattr(message, 'mandrill_reference', ""))
+            with self.tracer.span("djrill.validate_response"):
+                self.validate_response(message.mandrill_response, response, payload, message)
 
         except DjrillError:
+            metrics.inc("djrill_messages_total", result="failed")
             # every *expected* error is derived from DjrillError;
             # we deliberately don't silence unexpected errors
             if not self.fail_silently:
                 raise
             return False
 
+        metrics.inc("djrill_messages_total", result=result)
         return True
 
     def get_base_payload(self):
@@ -155,6 +308,11 @@ class DjrillBackend(BaseEmailBackend):
 
         Can raise NotSupportedByMandrillError for unsupported options in message.
         """
+        prototype = getattr(message, 'mandrill_prototype', None)
+        if prototype is not None:
+            # a djrill.prototype.PrototypeVariant: most of the payload is already built
+            prototype.build_payload(self, payload, message)
+            return
         msg_dict = self._build_standard_message_dict(message)
         self._add_mandrill_options(message, msg_dict)
         if getattr(message, 'alternatives', None):
@@ -162,11 +320,175 @@ class DjrillBackend(BaseEmailBackend):
         self._add_attachments(message, msg_dict)
         payload.setdefault('message', {}).update(msg_dict)
         if hasattr(message, 'template_name'):
-            payload['template_name'] = message.template_name
-            payload['template_content'] = \
-                self._expand_merge_vars(getattr(message, 'template_content', {}))
+            if self.render_templates_locally:
+                self._render_template(message, payload['message'])
+            else:
+                payload['template_name'] = message.template_name
+                payload['template_content'] = \
+                    self._expand_merge_vars(getattr(message, 'template_content', {}))
         self._add_mandrill_toplevel_options(message, payload)
 
+    def use_pool_key(self, payload, message, route=None):
+        """Set payload's API key (and subaccount) from the MANDRILL_API_KEYS pool, and return the PoolKey.
+
+        The key is chosen by MANDRILL_KEY_FUNCTION's routing value for message
+        (or by route, if message is None). If the key is over its rate limit, this blocks
+        the calling thread until it isn't. An explicit subaccount on message overrides the
+        pool key's subaccount.
+        """
+        if message is not None:
+            route = self._get_route(message)
+        pool_key = self.key_pool.select(route)
+        payload['key'] = pool_key.key
+        if pool_key.subaccount is not None and not hasattr(message, 'subaccount'):
+            payload['message']['subaccount'] = pool_key.subaccount
+        pool_key.count_send(len(payload['message']['to']))
+        return pool_key
+
+    def _get_route(self, message):
+        return self.key_function(message) if self.key_function is not None else None
+
+    def post_with_pool_key(self, payload, message):
+        """Post payload like post_to_mandrill, first setting its API key from the MANDRILL_API_KEYS pool (if any)
+
+        Errors are counted against the pool key. Returns the requests.Response.
+        """
+        pool_key = self.use_pool_key(payload, message) if self.key_pool is not None else None
+        try:
+            return self.post_to_mandrill(payload, message)
+        except MandrillAPIError:
+            if pool_key is not None:
+                pool_key.count_error()
+            raise
+
+    def split_payload(self, payload, max_recipients):
+        """Return a list of copies of payload, each with at most max_recipients of its recipients.
+
+        Each copy has only the merge_vars and recipient_metadata for its own recipients.
+        (The rest of the payload is shared between the copies, not copied.)
+        """
+        msg_dict = payload['message']
+        to_list = msg_dict['to']
+        if len(to_list) <= max_recipients:
+            return [payload]
+        recipient_data = {}  # field: {lowercased rcpt: [items]}
+        for field in ('merge_vars', 'recipient_metadata'):
+            if field in msg_dict:
+                items_by_rcpt = recipient_data[field] = {}
+                for item in msg_dict[field]:
+                    items_by_rcpt.setdefault(item['rcpt'].lower(), []).append(item)
+        chunks = []
+        for start in range(0, len(to_list), max_recipients):
+            chunk_to = to_list[start:start + max_recipients]
+            chunk_msg_dict = dict(msg_dict, to=chunk_to)
+            if recipient_data:
+                emails = list(OrderedDict((to['email'].lower(), None) for to in chunk_to))
+                for field, items_by_rcpt in recipient_data.items():
+                    chunk_msg_dict[field] = [item for email in emails for item in items_by_rcpt.get(email, ())]
+            chunks.append(dict(payload, message=chunk_msg_dict))
+        return chunks
+
+    def send_chunks(self, chunks, message):
+        """Send the payloads from split_payload in parallel, and return their combined MandrillSendResult.
+
+        Up to MANDRILL_SEND_THREADS chunks are sent at once. If any chunk fails, its error is raised
+        once the others have finished, and message.mandrill_response has the results of the chunks
+        that were sent. (MANDRILL_FALLBACK_BACKEND is only used if none of the chunks were sent.)
+        """
+        from multiprocessing.pool import ThreadPool
+
+        if self.key_pool is not None:
+            # choose the keys (and wait out their rate limits) here, rather than in the threads
+            pool_keys = [self.use_pool_key(chunk, message) for chunk in chunks]
+        else:
+            pool_keys = [None] * len(chunks)
+
+        def send_chunk(chunk):
+            try:
+                response = self.post_to_mandrill(chunk, message)
+                return self.parse_response(response, chunk, message), None
+            except Exception as err:
+                return None, err
+
+        thread_pool = ThreadPool(max(1, min(self.send_threads, len(chunks))))
+        try:
+            outcomes = thread_pool.map(send_chunk, chunks, chunksize=1)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+        result = MandrillSendResult([])
+        errors = []
+        for chunk, pool_key, (parsed_response, err) in zip(chunks, pool_keys, outcomes):
+            if err is not None:
+                if pool_key is not None and isinstance(err, MandrillAPIError):
+                    pool_key.count_error()
+                errors.append(err)
+            elif isinstance(parsed_response, MandrillSendResult):
+                result.extend(parsed_response)
+            else:
+                errors.append(MandrillAPIError("Invalid Mandrill API response format",
+                                               email_message=message, payload=chunk))
+        if errors:
+            if len(result):
+                message.mandrill_response = result  # (which also prevents sending with the fallback)
+            raise errors[0]
+        return result
+
+    def build_resend_payload(self, message, emails):
+        """Return the send payload for message, with just the recipients in emails.
+
+        Each of those recipients keeps its own merge_vars and recipient_metadata.
+        """
+        payload = self.get_base_payload()
+        self.build_send_payload(payload, message)
+        self._restrict_payload_recipients(payload, emails)
+        return payload
+
+    def resend_failed(self, message, statuses=("rejected",), reject_reasons=RESENDABLE_REJECT_REASONS):
+        """Send message again to just the recipients it failed for, and return their new MandrillSendResult.
+
+        A recipient is resent if its status in message.mandrill_response is any of statuses
+        and, if it was rejected, its reject_reason is in reject_reasons (or reject_reasons is None).
+        The resent recipients' entries in message.mandrill_response are replaced with the new results.
+
+        Returns None if no recipients needed resending (or the resend failed with fail_silently).
+        """
+        result = getattr(message, 'mandrill_response', None)
+        if not isinstance(result, MandrillSendResult):
+            return None  # (not sent, or not sent with Djrill)
+        emails = [failure['email'] for failure in result.failures(statuses)
+                  if failure['status'] != "rejected" or reject_reasons is None
+                  or failure['reject_reason'] in reject_reasons]
+        if not emails:
+            return None
+
+        created_session = self.open()
+        if not self.session:
+            return None  # exception in self.open with fail_silently
+        try:
+            payload = self.build_resend_payload(message, emails)
+            response = self.post_with_pool_key(payload, message)
+            resent = self.parse_response(response, payload, message)
+            if isinstance(resent, MandrillSendResult):
+                resent_emails = set(email.lower() for email in emails)
+                combined = MandrillSendResult(
+                    [item for item in result if item.get('email', "").lower() not in resent_emails])
+                combined.extend(resent)
+                message.mandrill_response = combined
+                count_recipient_statuses(resent)
+                if self.send_record_writer is not None:
+                    self.send_record_writer.add_result(resent, getattr(message, 'mandrill_reference', ""))
+            self.validate_response(resent, response, payload, message)
+        except DjrillError:
+            if not self.fail_silently:
+                raise
+            return None
+        finally:
+            if created_session:
+                self.close()
+        return resent
+
     def get_api_url(self, payload, message):
         """Return the correct Mandrill API url for sending payload
 
@@ -197,27 +519,119 @@ class DjrillBackend(BaseEmailBackend):
         """
         api_url = self.get_api_url(payload, message)
         try:
-            json_payload = self.serialize_payload(payload, message)
+            with self.tracer.span("djrill.serialize"):
+                json_payload = self.serialize_payload(payload, message)
         except TypeError as err:
             # Add some context to the "not JSON serializable" message
             raise NotSerializableForMandrillError(
                 orig_err=err, email_message=message, payload=payload)
+        return self.post_json_to_mandrill(api_url, json_payload, payload, message)
 
-        response = self.session.post(api_url, data=json_payload)
+    def post_json_to_mandrill(self, api_url, json_payload, payload=None, message=None):
+        """Post json_payload (a json str) to the Mandrill api_url, and return the response.
+
+        payload and message (if known) are only used to describe errors.
+
+        Can raise MandrillAPIError for HTTP errors in the post
+        """
+        return self._post_json(api_url, json_payload, payload, message)
+
+    def _post_json(self, api_url, json_payload, payload=None, message=None):
+        # The API call itself, for sends and call_mandrill_api, with the circuit breaker, tracing and metrics.
+        # Read-only API methods are hedged if MANDRILL_HEDGE_READS is set.
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            raise MandrillUnavailableError(email_message=message, payload=payload)
+        api_method = self._api_method(api_url)
+        started = time.time()
+        try:
+            with self.tracer.span("djrill.http_post", {"http.url": api_url}) as span:
+                if self.hedger is not None and api_method in self.hedger.idempotent_api_methods:
+                    session = self.session
+                    response = self.hedger.call(
+                        lambda: session.post(api_url, data=json_payload, timeout=self.timeout))
+                else:
+                    response = self.session.post(api_url, data=json_payload, timeout=self.timeout)
+                span.set_attribute("http.status_code", response.status_code)
+        except requests.RequestException:
+            metrics.inc("djrill_api_errors_total", api_method=api_method, status_code="none")
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(failed=True, started=started)
+            raise
+        duration = time.time() - started
+        metrics.observe("djrill_api_requests_seconds", duration, api_method=api_method)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(self.is_outage_response(response), duration, started)
         if response.status_code != 200:
+            metrics.inc("djrill_api_errors_total", api_method=api_method, status_code="%s" % response.status_code)
             raise MandrillAPIError(email_message=message, payload=payload, response=response)
         return response
 
+    def _api_method(self, api_url):
+        # e.g., "messages/send.json" (for metrics labels)
+        return api_url[len(self.api_url):] if api_url.startswith(self.api_url) else api_url
+
+    # Mandrill error names that indicate a problem with Mandrill, rather than with the call
+    outage_error_names = ("GeneralError",)
+
+    def is_outage_response(self, response):
+        """Return True if response indicates the Mandrill API is failing (for MANDRILL_CIRCUIT_BREAKER)
+
+        Mandrill reports most errors with a 500 status, so this looks at the error name.
+        Non-JSON 5xx responses (e.g., from a proxy or load balancer) count as failing.
+        """
+        if response.status_code < 500:
+            return False
+        try:
+            return response.json()['name'] in self.outage_error_names
+        except (KeyError, TypeError, ValueError):
+            return True
+
+    def send_with_fallback(self, message):
+        """Send message with the MANDRILL_FALLBACK_BACKEND, and return True if it was sent"""
+        fallback = get_connection(self.fallback_backend, fail_silently=self.fail_silently)
+        return bool(fallback.send_messages([message]))
+
+    def call_mandrill_api(self, api_method, params):
+        """Post params to any Mandrill API method, and return the parsed json response.
+
+        api_method is relative to the Mandrill API url, e.g., "rejects/list.json"
+        params is a dict of the method's arguments (the API key will be added)
+
+        Can raise MandrillAPIError for HTTP errors or an invalid response
+        (or MandrillUnavailableError if MANDRILL_CIRCUIT_BREAKER is open)
+        """
+        created_session = self.open()
+        if not self.session:
+            return None  # exception in self.open with fail_silently
+        try:
+            payload = self.get_base_payload()
+            payload.update(params)
+            response = self._post_json(urljoin(self.api_url, api_method), json.dumps(payload))
+            try:
+                return response.json()
+            except ValueError:
+                raise MandrillAPIError("Invalid JSON in Mandrill API response", response=response)
+        finally:
+            if created_session:
+                self.close()
+
     def parse_response(self, response, payload, message):
-        """Return parsed json from Mandrill API response
+        """Return a djrill.send_result.MandrillSendResult from Mandrill API response
+
+        (If the response isn't a list of recipient statuses, returns the parsed json
+        as-is, for validate_response to deal with.)
 
         Can raise MandrillAPIError if response is not valid JSON
         """
         try:
-            return response.json()
+            parsed_response = response.json()
         except ValueError:
             raise MandrillAPIError("Invalid JSON in Mandrill API response",
                                    email_message=message, payload=payload, response=response)
+        try:
+            return MandrillSendResult(parsed_response)
+        except (AttributeError, KeyError, TypeError):
+            return parsed_response
 
     def validate_response(self, parsed_response, response, payload, message):
         """Validate parsed_response, raising exceptions for any problems.
@@ -231,15 +645,203 @@ class DjrillBackend(BaseEmailBackend):
         if self.ignore_recipient_status:
             return
         try:
-            recipient_status = [item["status"] for item in parsed_response]
-        except (KeyError, TypeError):
-            raise MandrillAPIError("Invalid Mandrill API response format",
-                                   email_message=message, payload=payload, response=response)
+            status_counts = parsed_response.status_counts
+        except AttributeError:
+            try:
+                status_counts = MandrillSendResult(parsed_response).status_counts
+            except (AttributeError, KeyError, TypeError):
+                raise MandrillAPIError("Invalid Mandrill API response format",
+                                       email_message=message, payload=payload, response=response)
         # Error if *all* recipients are invalid or refused
         # (This behavior parallels smtplib.SMTPRecipientsRefused from Django's SMTP EmailBackend)
-        if all([status in ('invalid', 'rejected') for status in recipient_status]):
+        if all(status in ('invalid', 'rejected') for status in status_counts):
             raise MandrillRecipientsRefused(email_message=message, payload=payload, response=response)
 
+    #
+    # Mandrill templates
+    #
+
+    def get_template(self, template_name, api_key=None):
+        """Return a (cached) djrill.template_cache.MandrillTemplate, or None if Mandrill doesn't have it
+
+        The template is loaded with api_key (default MANDRILL_API_KEY, or the first MANDRILL_API_KEYS key).
+        The template's render method can be used to preview sends locally.
+        """
+        from ...template_cache import template_cache
+        return template_cache.get(self, template_name, self.template_cache_ttl, api_key)
+
+    def validate_template(self, payload, message):
+        """Raise MandrillTemplateError if payload's template_content or merge vars don't fit its template
+
+        Merge tags without merge vars (unless MANDRILL_TEMPLATE_VALIDATION is "strict")
+        and merge vars the template doesn't use only issue a MandrillTemplateWarning.
+        """
+        from ...template_cache import check_template_payload, unresolved_merge_tags, unused_merge_vars
+        template_name = payload['template_name']
+        template = self.get_template(template_name, self._template_api_key(message))
+        if template is None:
+            raise MandrillTemplateError("Unknown Mandrill template '%s'" % template_name,
+                                        email_message=message, payload=payload)
+        merge_language = payload['message'].get('merge_language', "mailchimp")
+        problems = check_template_payload(template, payload, merge_language)
+        unresolved_tags = unresolved_merge_tags(template, payload, merge_language)
+        if unresolved_tags:
+            problem = "uses merge tag(s) %s without a merge var" % ", ".join(unresolved_tags)
+            if self.template_validation == "strict":
+                problems.append(problem)
+            else:
+                warnings.warn("Mandrill template '%s' %s" % (template_name, problem), MandrillTemplateWarning)
+        if problems:
+            raise MandrillTemplateError("Mandrill template '%s' %s" % (template_name, "; ".join(problems)),
+                                        email_message=message, payload=payload)
+        unused_vars = unused_merge_vars(template, payload, merge_language,
+                                        ignore=self.global_settings.get('global_merge_vars', {}))
+        if unused_vars:
+            warnings.warn("Mandrill template '%s' doesn't use merge var(s) %s"
+                          % (template_name, ", ".join(unused_vars)), MandrillTemplateWarning)
+
+    def _template_api_key(self, message):
+        # The key message will be sent with: with MANDRILL_API_KEYS, that's known
+        # in advance for routed messages (unrouted ones use the default key)
+        if self.key_pool is not None:
+            route = self._get_route(message)
+            if route is not None:
+                return self.key_pool.routed(route).key
+        return self.api_key
+
+    #
+    # Local scheduler
+    #
+
+    def _is_due_later(self, payload):
+        from ...scheduler import parse_send_at
+        due_at = parse_send_at(payload.get('send_at'))
+        return due_at is not None and due_at > time.time()
+
+    def schedule_send(self, payload, message):
+        """Store payload in the local scheduler until its send_at, rather than sending it now.
+
+        Sets message.mandrill_scheduled_id (for cancelling or rescheduling), and
+        returns a MandrillSendResult with a "scheduled" status for each recipient.
+        """
+        from ...scheduler import parse_send_at
+        stored = dict(payload)
+        del stored['key']  # the key will be added when it's sent, so isn't kept in the scheduler db
+        due_at = parse_send_at(stored.pop('send_at'))
+        try:
+            serialized = self.serialize_payload(stored, message)
+        except TypeError as err:
+            raise NotSerializableForMandrillError(orig_err=err, email_message=message, payload=payload)
+        route = self._get_route(message) if self.key_pool is not None else None
+        message.mandrill_scheduled_id = self.scheduler.schedule(due_at, serialized, route)
+        return MandrillSendResult([{"email": to['email'], "status": "scheduled", "reject_reason": None, "_id": None}
+                                   for to in payload['message']['to']])
+
+    def send_scheduled(self, batch_size=100, now=None, max_attempts=5, retry_delay=60):
+        """Send up to batch_size locally-scheduled messages that are due, and return the number sent.
+
+        A send that fails (including with a connection error or timeout) is retried
+        after retry_delay seconds, up to max_attempts times. After that, it's removed
+        from the scheduler, and (unless fail_silently) the error is raised once the rest
+        of the batch has been handled. (Sends refused by an open MANDRILL_CIRCUIT_BREAKER
+        are always retried; sends where Mandrill rejected every recipient are never retried.)
+        """
+        return self.send_scheduled_batch(batch_size, now, max_attempts, retry_delay)[1]
+
+    def send_scheduled_batch(self, batch_size=100, now=None, max_attempts=5, retry_delay=60):
+        """Like send_scheduled, but returns (number of due messages claimed, number sent).
+
+        If fewer than batch_size were claimed, nothing else was due. (The number
+        sent can be smaller than the number claimed when some sends fail.)
+        """
+        if self.scheduler is None:
+            raise ImproperlyConfigured("Set MANDRILL_SCHEDULER_DB in settings.py to use Djrill's local scheduler")
+        due = self.scheduler.claim_due(batch_size, now)
+        if not due:
+            return 0, 0
+
+        created_session = self.open()
+        if not self.session:
+            return len(due), 0  # exception in self.open with fail_silently
+        num_sent = 0
+        handled = []
+        last_error = None
+        try:
+            for scheduled in due:
+                payload = json.loads(scheduled.payload)
+                payload.update(self.get_base_payload())
+                pool_key = self.use_pool_key(payload, None, scheduled.route) if self.key_pool is not None else None
+                try:
+                    response = self.post_to_mandrill(payload, None)
+                    parsed_response = self.parse_response(response, payload, None)
+                    count_recipient_statuses(parsed_response)
+                    self.validate_response(parsed_response, response, payload, None)
+                except (DjrillError, requests.RequestException) as err:
+                    metrics.inc("djrill_messages_total", result="failed")
+                    if pool_key is not None and isinstance(err, MandrillAPIError):
+                        pool_key.count_error()
+                    if isinstance(err, MandrillUnavailableError) or (
+                            scheduled.attempts < max_attempts and not isinstance(err, MandrillRecipientsRefused)):
+                        self.scheduler.retry(scheduled.id, retry_delay)
+                        continue
+                    last_error = err
+                else:
+                    metrics.inc("djrill_messages_total", result="sent")
+                    num_sent += 1
+                handled.append(scheduled.id)
+        finally:
+            self.scheduler.complete(handled)
+            if created_session:
+                self.close()
+
+        if last_error is not None and not self.fail_silently:
+            raise last_error
+        return len(due), num_sent
+
+    #
+    # Local reject list
+    #
+
+    def refresh_reject_list(self):
+        """Merge Mandrill's rejection blacklist into djrill.rejects.reject_list
+
+        Entries Mandrill reports as expired are removed; others not in the
+        result are kept. (Mandrill returns at most 1000 entries from rejects/list;
+        webhook events keep the local list current beyond that.)
+        """
+        params = {"include_expired": True}
+        if "subaccount" in self.global_settings:
+            params["subaccount"] = self.global_settings["subaccount"]
+        from ...rejects import reject_list, reject_sender
+        rejects = self.call_mandrill_api("rejects/list.json", params)
+        if rejects is not None:
+            current = [(item['email'], reject_sender(item)) for item in rejects if not item.get('expired')]
+            expired = [(item['email'], reject_sender(item)) for item in rejects if item.get('expired')]
+            reject_list.merge_refresh(current, expired)
+
+    def remove_rejected_recipients(self, payload, message):
+        """Remove recipients on the local reject list from payload.
+
+        Returns a list of Mandrill-style recipient status dicts for the removed
+        recipients, so they can be reported in the message's mandrill_response.
+        """
+        from ...rejects import reject_list
+        if reject_list.is_stale(self.reject_list_max_age):
+            try:
+                self.refresh_reject_list()
+            except (DjrillError, requests.RequestException):
+                # keep filtering with what we have; the send will report any real API problem
+                reject_list.refresh_failed()
+        to_list = payload['message']['to']
+        sender = payload['message'].get('from_email')  # (None for use_template_from: only all-sender rejects apply)
+        rejected = [to['email'] for to in to_list if reject_list.is_rejected(to['email'], sender)]
+        if not rejected:
+            return []
+        keep = [to['email'] for to in to_list if not reject_list.is_rejected(to['email'], sender)]
+        self._restrict_payload_recipients(payload, keep)
+        return [{"email": email, "status": "rejected", "reject_reason": "local-blacklist", "_id": None}
+                for email in rejected]
+
     #
     # Payload construction
     #
@@ -254,8 +856,7 @@ class DjrillBackend(BaseEmailBackend):
         Raises NotSupportedByMandrillError for any standard EmailMessage
         features that cannot be accurately communicated to Mandrill.
         """
-        sender = sanitize_address(message.from_email, message.encoding)
-        from_name, from_email = parseaddr(sender)
+        sender, from_name, from_email = parse_address(message.from_email, message.encoding)
 
         to_list = self._make_mandrill_to_list(message, message.to, "to")
         to_list += self._make_mandrill_to_list(message, message.cc, "cc")
@@ -276,7 +877,7 @@ class DjrillBackend(BaseEmailBackend):
             msg_dict["subject"] = message.subject
 
         if hasattr(message, 'reply_to'):
-            reply_to = [sanitize_address(addr, message.encoding) for addr in message.reply_to]
+            reply_to = [parse_address(addr, message.encoding)[0] for addr in message.reply_to]
             msg_dict["headers"] = {'Reply-To': ', '.join(reply_to)}
             # Note: An explicit Reply-To header will override the reply_to attr below
             # (matching Django's own behavior)
@@ -287,6 +888,30 @@ class DjrillBackend(BaseEmailBackend):
 
         return msg_dict
 
+    def _render_template(self, message, msg_dict):
+        """Fill in msg_dict from a cached copy of message's Mandrill template.
+
+        Fills the template's mc:edit regions with message.template_content, so the
+        message can be sent with messages/send rather than messages/send-template.
+        Merge tags are left for Mandrill to merge (with the message's merge vars).
+        """
+        template = self.get_template(message.template_name, self._template_api_key(message))
+        if template is None:
+            raise MandrillTemplateError("Unknown Mandrill template '%s'" % message.template_name,
+                                        email_message=message)
+        # Like send-template, ignore the EmailMessage's own body
+        msg_dict.pop('text', None)
+        msg_dict['html'] = template.compiled.render(getattr(message, 'template_content', {}))
+        if template.text:
+            msg_dict['text'] = template.text
+        if getattr(message, 'use_template_subject', False) and template.subject:
+            msg_dict['subject'] = template.subject
+        if getattr(message, 'use_template_from', False):
+            if template.from_email:
+                msg_dict['from_email'] = template.from_email
+            if template.from_name:
+                msg_dict.setdefault('from_name', template.from_name)
+
     def _add_mandrill_toplevel_options(self, message, api_params):
         """Extend api_params to include Mandrill global-send options set on message"""
         # Mandrill attributes that can be copied directly:
@@ -310,10 +935,9 @@ class DjrillBackend(BaseEmailBackend):
         Parses "Real Name <address@example.com>" format emails.
         Sanitizes all email addresses.
         """
-        parsed_rcpts = [parseaddr(sanitize_address(addr, message.encoding))
-                        for addr in recipients]
+        parsed_rcpts = [parse_address(addr, message.encoding) for addr in recipients]
         return [{"email": to_email, "name": to_name, "type": recipient_type}
-                for (to_name, to_email) in parsed_rcpts]
+                for (sanitized, to_name, to_email) in parsed_rcpts]
 
     def _add_mandrill_options(self, message, msg_dict):
         """Extend msg_dict to include Mandrill per-message options set on message"""
@@ -350,27 +974,53 @@ class DjrillBackend(BaseEmailBackend):
                 self._expand_merge_vars(global_merge_vars)
 
         if hasattr(message, 'merge_vars'):
-            # For testing reproducibility, we sort the recipients
-            msg_dict['merge_vars'] = [
-                { 'rcpt': rcpt,
-                  'vars': self._expand_merge_vars(message.merge_vars[rcpt]) }
-                for rcpt in sorted(message.merge_vars.keys())
-            ]
+            msg_dict['merge_vars'] = self._make_merge_vars(message.merge_vars)
         if hasattr(message, 'recipient_metadata'):
-            # For testing reproducibility, we sort the recipients
-            msg_dict['recipient_metadata'] = [
-                { 'rcpt': rcpt, 'values': message.recipient_metadata[rcpt] }
-                for rcpt in sorted(message.recipient_metadata.keys())
-            ]
+            msg_dict['recipient_metadata'] = self._make_recipient_metadata(message.recipient_metadata)
+
+    def _make_merge_vars(self, merge_vars):
+        """Convert a message's merge_vars (a dict or RecipientData) to Mandrill's array"""
+        if isinstance(merge_vars, RecipientData):
+            return merge_vars.as_merge_vars()
+        return [
+            { 'rcpt': rcpt,
+              'vars': self._expand_merge_vars(merge_vars[rcpt]) }
+            for rcpt in self._ordered_keys(merge_vars)
+        ]
+
+    def _make_recipient_metadata(self, recipient_metadata):
+        """Convert a message's recipient_metadata (a dict or RecipientData) to Mandrill's array"""
+        if isinstance(recipient_metadata, RecipientData):
+            return recipient_metadata.as_recipient_metadata()
+        return [
+            { 'rcpt': rcpt, 'values': recipient_metadata[rcpt] }
+            for rcpt in self._ordered_keys(recipient_metadata)
+        ]
+
+    def _restrict_payload_recipients(self, payload, emails):
+        """Limit payload's recipients (and their per-recipient data) to the addresses in emails"""
+        emails = set(email.lower() for email in emails)
+        msg_dict = payload['message']
+        msg_dict['to'] = [to for to in msg_dict['to'] if to['email'].lower() in emails]
+        for field in ('merge_vars', 'recipient_metadata'):
+            if field in msg_dict:
+                msg_dict[field] = [item for item in msg_dict[field] if item['rcpt'].lower() in emails]
 
     def _expand_merge_vars(self, vardict):
         """Convert a Python dict to an array of name-content used by Mandrill.
 
         { name: value, ... } --> [ {'name': name, 'content': value }, ... ]
         """
-        # For testing reproducibility, we sort the keys
         return [{'name': name, 'content': vardict[name]}
-                for name in sorted(vardict.keys())]
+                for name in self._ordered_keys(vardict)]
+
+    def _ordered_keys(self, d):
+        """Return d's keys, sorted unless MANDRILL_SORT_RECIPIENT_DATA is False.
+
+        (Sorting is only for testing reproducibility, and isn't free for very
+        large recipient lists.)
+        """
+        return sorted(d.keys()) if self.sort_recipient_data else d.keys()
 
     def _add_alternatives(self, message, msg_dict):
         """
@@ -425,9 +1075,15 @@ class DjrillBackend(BaseEmailBackend):
         # mimetype) or a MIMEBase object. (Also, both filename and mimetype may
         # be missing.)
         is_embedded_image = False
+        content_b64 = None
         if isinstance(attachment, MIMEBase):
             name = attachment.get_filename()
-            content = attachment.get_payload(decode=True)
+            if self._is_base64_part(attachment):
+                # Reuse the encoded payload (minus its line breaks), rather than decoding and re-encoding it
+                content = None
+                content_b64 = attachment.get_payload().replace("\r", "").replace("\n", "")
+            else:
+                content = attachment.get_payload(decode=True)
             mimetype = attachment.get_content_type()
             # Treat image attachments that have content ids as embedded:
             if attachment.get_content_maintype() == "image" and attachment["Content-ID"] is not None:
@@ -443,27 +1099,37 @@ class DjrillBackend(BaseEmailBackend):
         if mimetype is None:
             mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
 
-        # b64encode requires bytes, so let's convert our content.
-        try:
-            # noinspection PyUnresolvedReferences
-            if isinstance(content, unicode):
-                # Python 2.X unicode string
-                content = content.encode(str_encoding)
-        except NameError:
-            # Python 3 doesn't differentiate between strings and unicode
-            # Convert python3 unicode str to bytes attachment:
-            if isinstance(content, str):
-                content = content.encode(str_encoding)
-
-        content_b64 = b64encode(content)
+        if content_b64 is None:
+            # b64encode requires bytes, so let's convert our content.
+            try:
+                # noinspection PyUnresolvedReferences
+                if isinstance(content, unicode):
+                    # Python 2.X unicode string
+                    content = content.encode(str_encoding)
+            except NameError:
+                # Python 3 doesn't differentiate between strings and unicode
+                # Convert python3 unicode str to bytes attachment:
+                if isinstance(content, str):
+                    content = content.encode(str_encoding)
+
+            content_b64 = b64encode(content)
+        if isinstance(content_b64, bytes):
+            content_b64 = content_b64.decode('ascii')
 
         mandrill_attachment = {
             'type': mimetype,
             'name': name or "",
-            'content': content_b64.decode('ascii'),
+            'content': content_b64,
         }
         return mandrill_attachment, is_embedded_image
 
+    @staticmethod
+    def _is_base64_part(attachment):
+        """Return True if MIMEBase attachment's payload is already base64-encoded"""
+        encoding = attachment.get('Content-Transfer-Encoding')
+        return (encoding is not None and encoding.strip().lower() == "base64"
+                and not attachment.is_multipart())
+
     @classmethod
     def encode_date_for_mandrill(cls, dt):
         """Format a date or datetime for use as a Mandrill API date field
@@ -483,3 +1149,54 @@ class DjrillBackend(BaseEmailBackend):
             return dt.isoformat() + ' 00:00:00'
         else:
             return dt
+
+
+_settings_cache = {}  # backend class: dict of attrs set by its load_settings
+
+
+@receiver(setting_changed)
+def clear_settings_cache(setting=None, **kwargs):
+    """Forget backends' cached settings (when a Mandrill setting changes, or if called directly)"""
+    if setting is None or setting.startswith("MANDRILL_"):
+        _settings_cache.clear()
+
+
+# Plain ASCII addresses without a display name, which sanitize_address and parseaddr return unchanged
+PLAIN_ADDRESS_RE = re.compile(r"^[A-Za-z0-9.!#$%&'*+/=?^_`{|}~-]+@[A-Za-z0-9.-]+\Z")
+
+ADDRESS_CACHE_SIZE = 4096
+_address_cache = OrderedDict()  # (addr, encoding): (sanitized, name, email), least-recently used first
+_address_cache_lock = threading.Lock()
+
+
+def parse_address(addr, encoding):
+    """Return (sanitized, name, email) for an email address string.
+
+    sanitized is the address encoded as Django's sanitize_address would,
+    and name and email are its parts, as parsed by parseaddr.
+
+    Transactional mail tends to reuse the same addresses over and over, so
+    results are kept in a bounded, least-recently-used cache.
+    """
+    try:
+        if PLAIN_ADDRESS_RE.match(addr):
+            return addr, "", addr
+    except TypeError:
+        pass  # not a str (e.g., a lazy string or (name, addr) tuple)
+    key = (addr, encoding)
+    with _address_cache_lock:
+        try:
+            parsed = _address_cache.pop(key)
+        except KeyError:
+            parsed = None
+        else:
+            _address_cache[key] = parsed  # now most-recently used
+    if parsed is None:
+        sanitized = sanitize_address(addr, encoding)
+        name, email = parseaddr(sanitized)
+        parsed = (sanitized, name, email)
+        with _address_cache_lock:
+            _address_cache[key] = parsed
+            if len(_address_cache) > ADDRESS_CACHE_SIZE:
+                _address_cache.popitem(last=False)
+    return parsed
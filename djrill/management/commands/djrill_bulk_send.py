@@ -0,0 +1,107 @@
+import io
+import json
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk_send import BulkSender, read_recipients
+
+
+class Command(BaseCommand):
+    help = ("Sends a message to each recipient in a CSV or JSONL file, in batches, "
+            "logging per-recipient results to a file that lets an interrupted run resume.")
+    args = "<recipients_file>"
+
+    if django.VERSION < (1, 8):
+        option_list = BaseCommand.option_list + (
+            make_option('--results', dest='results', default=None,
+                        help="JSONL file for results and progress (required; reuse it to resume)."),
+            make_option('--format', dest='format', default=None,
+                        help="Recipients file format, csv or jsonl (default from the file extension)."),
+            make_option('--from-email', dest='from_email', default=None,
+                        help="From address (default DEFAULT_FROM_EMAIL)."),
+            make_option('--subject', dest='subject', default="",
+                        help="Message subject (can use Mandrill merge tags)."),
+            make_option('--text-file', dest='text_file', default=None,
+                        help="File with the plain text body."),
+            make_option('--html-file', dest='html_file', default=None,
+                        help="File with the html body."),
+            make_option('--template', dest='template_name', default=None,
+                        help="Mandrill template to send, instead of a body."),
+            make_option('--tag', action='append', dest='tags', default=None,
+                        help="Mandrill tag for the messages (can be repeated)."),
+            make_option('--batch-size', type='int', dest='batch_size', default=500,
+                        help="Recipients in each Mandrill API call (default 500)."),
+            make_option('--processes', type='int', dest='processes', default=1,
+                        help="Processes building payloads (default 1: build in this process)."),
+            make_option('--concurrency', type='int', dest='concurrency', default=4,
+                        help="API calls in progress at once (default 4)."),
+            make_option('--retry-unconfirmed', action='store_true', dest='retry_unconfirmed', default=False,
+                        help="Also resend batches a previous run started but didn't confirm "
+                             "(which may send duplicates)."),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('recipients_file',
+                            help="CSV (with a header row) or JSONL file of recipients.")
+        parser.add_argument('--results', dest='results', default=None,
+                            help="JSONL file for results and progress (required; reuse it to resume).")
+        parser.add_argument('--format', dest='format', default=None, choices=['csv', 'jsonl'],
+                            help="Recipients file format (default from the file extension).")
+        parser.add_argument('--from-email', dest='from_email', default=None,
+                            help="From address (default DEFAULT_FROM_EMAIL).")
+        parser.add_argument('--subject', dest='subject', default="",
+                            help="Message subject (can use Mandrill merge tags).")
+        parser.add_argument('--text-file', dest='text_file', default=None,
+                            help="File with the plain text body.")
+        parser.add_argument('--html-file', dest='html_file', default=None,
+                            help="File with the html body.")
+        parser.add_argument('--template', dest='template_name', default=None,
+                            help="Mandrill template to send, instead of a body.")
+        parser.add_argument('--tag', action='append', dest='tags', default=None,
+                            help="Mandrill tag for the messages (can be repeated).")
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=500,
+                            help="Recipients in each Mandrill API call (default 500).")
+        parser.add_argument('--processes', type=int, dest='processes', default=1,
+                            help="Processes building payloads (default 1: build in this process).")
+        parser.add_argument('--concurrency', type=int, dest='concurrency', default=4,
+                            help="API calls in progress at once (default 4).")
+        parser.add_argument('--retry-unconfirmed', action='store_true', dest='retry_unconfirmed', default=False,
+                            help="Also resend batches a previous run started but didn't confirm "
+                                 "(which may send duplicates).")
+
+    def handle(self, *args, **options):
+        recipients_file = options.get('recipients_file') or (args[0] if args else None)
+        if not recipients_file:
+            raise CommandError("Specify the recipients file")
+        if not options['results']:
+            raise CommandError("Specify a --results file")
+        message_options = {'subject': options['subject']}
+        if options['from_email']:
+            message_options['from_email'] = options['from_email']
+        if options['text_file']:
+            message_options['body'] = _read_file(options['text_file'])
+        if options['html_file']:
+            message_options['html'] = _read_file(options['html_file'])
+        if options['template_name']:
+            message_options['template_name'] = options['template_name']
+        if options['tags']:
+            message_options['tags'] = options['tags']
+
+        sender = BulkSender(options['results'], message_options, batch_size=options['batch_size'],
+                            processes=options['processes'], concurrency=options['concurrency'],
+                            retry_unconfirmed=options['retry_unconfirmed'])
+        try:
+            summary = sender.run(read_recipients(recipients_file, options['format']))
+        except (IOError, ValueError) as err:
+            raise CommandError("%s" % err)
+        self.stdout.write(json.dumps(summary, indent=2, sort_keys=True))
+        if summary['batches_unconfirmed']:
+            self.stderr.write("%d batches may or may not have been sent; check the Mandrill dashboard "
+                              "before using --retry-unconfirmed" % summary['batches_unconfirmed'])
+
+
+def _read_file(path):
+    with io.open(path, encoding="utf-8") as f:
+        return f.read()
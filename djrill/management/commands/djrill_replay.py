@@ -0,0 +1,52 @@
+import json
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from ...dry_run import PayloadReplayer, read_payloads
+
+
+class Command(BaseCommand):
+    help = ("Sends the Mandrill payloads in a file written by DjrillDryRunBackend, "
+            "logging per-recipient results to a file that lets an interrupted run resume.")
+    args = "<payloads_file>"
+
+    if django.VERSION < (1, 8):
+        option_list = BaseCommand.option_list + (
+            make_option('--results', dest='results', default=None,
+                        help="JSONL file for results and progress (required; reuse it to resume)."),
+            make_option('--concurrency', type='int', dest='concurrency', default=16,
+                        help="API calls in progress at once (default 16)."),
+            make_option('--retry-unconfirmed', action='store_true', dest='retry_unconfirmed', default=False,
+                        help="Also resend payloads a previous run started but didn't confirm "
+                             "(which may send duplicates)."),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('payloads_file',
+                            help="JSONL file written by DjrillDryRunBackend.")
+        parser.add_argument('--results', dest='results', default=None,
+                            help="JSONL file for results and progress (required; reuse it to resume).")
+        parser.add_argument('--concurrency', type=int, dest='concurrency', default=16,
+                            help="API calls in progress at once (default 16).")
+        parser.add_argument('--retry-unconfirmed', action='store_true', dest='retry_unconfirmed', default=False,
+                            help="Also resend payloads a previous run started but didn't confirm "
+                                 "(which may send duplicates).")
+
+    def handle(self, *args, **options):
+        payloads_file = options.get('payloads_file') or (args[0] if args else None)
+        if not payloads_file:
+            raise CommandError("Specify the payloads file")
+        if not options['results']:
+            raise CommandError("Specify a --results file")
+        replayer = PayloadReplayer(options['results'], concurrency=options['concurrency'],
+                                   retry_unconfirmed=options['retry_unconfirmed'])
+        try:
+            summary = replayer.run(read_payloads(payloads_file))
+        except (IOError, ValueError) as err:
+            raise CommandError("%s" % err)
+        self.stdout.write(json.dumps(summary, indent=2, sort_keys=True))
+        if summary['batches_unconfirmed']:
+            self.stderr.write("%d payloads may or may not have been sent; check the Mandrill dashboard "
+                              "before using --retry-unconfirmed" % summary['batches_unconfirmed'])
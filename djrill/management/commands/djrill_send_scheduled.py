@@ -0,0 +1,56 @@
+import time
+from optparse import make_option
+
+import django
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from ...exceptions import DjrillError
+
+
+class Command(BaseCommand):
+    help = "Sends messages held in Djrill's local scheduler (MANDRILL_SCHEDULER_DB) once they're due."
+
+    if django.VERSION < (1, 8):
+        option_list = BaseCommand.option_list + (
+            make_option('--batch-size', type='int', dest='batch_size', default=100,
+                        help="Number of due messages to send in each batch (default 100)."),
+            make_option('--loop', action='store_true', dest='loop', default=False,
+                        help="Keep running, sending messages as they come due."),
+            make_option('--interval', type='float', dest='interval', default=10,
+                        help="With --loop, the longest to wait between checks, in seconds (default 10)."),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=100,
+                            help="Number of due messages to send in each batch (default 100).")
+        parser.add_argument('--loop', action='store_true', dest='loop', default=False,
+                            help="Keep running, sending messages as they come due.")
+        parser.add_argument('--interval', type=float, dest='interval', default=10,
+                            help="With --loop, the longest to wait between checks, in seconds (default 10).")
+
+    def handle(self, *args, **options):
+        connection = get_connection('djrill.mail.backends.djrill.DjrillBackend')
+        batch_size = options['batch_size']
+        total_sent = 0
+        connection.open()
+        try:
+            while True:
+                try:
+                    claimed, sent = connection.send_scheduled_batch(batch_size=batch_size)
+                except DjrillError as err:
+                    # the rest of the batch was handled, and more may be due
+                    self.stderr.write("Dropped scheduled message after repeated errors: %s" % err)
+                    continue
+                total_sent += sent
+                if claimed == batch_size:
+                    continue  # there may be more due now (even if some of this batch failed)
+                if not options['loop']:
+                    break
+                next_due_at = connection.scheduler.next_due_at()
+                wait = options['interval'] if next_due_at is None else next_due_at - time.time()
+                time.sleep(min(max(wait, 0.1), options['interval']))
+        finally:
+            connection.close()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Sent %d scheduled messages" % total_sent)
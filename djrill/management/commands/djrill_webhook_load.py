@@ -0,0 +1,71 @@
+import json
+from optparse import make_option
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse  # Django < 1.10
+
+from ...webhook_load import DEFAULT_EVENT_MIX, WebhookEventFactory, WebhookLoadGenerator
+
+
+class Command(BaseCommand):
+    help = ("Posts synthetic Mandrill webhook events to Djrill's webhook view, "
+            "and reports throughput, latency and memory use.")
+
+    if django.VERSION < (1, 8):
+        option_list = BaseCommand.option_list + (
+            make_option('--url', dest='url', default=None,
+                        help="Path to post to in-process, or http(s) url of a running server "
+                             "(default: the djrill_webhook url, with DJRILL_WEBHOOK_SECRET)."),
+            make_option('--events', type='int', dest='events', default=10000,
+                        help="Total number of events to post (default 10000)."),
+            make_option('--batch-size', type='int', dest='batch_size', default=100,
+                        help="Events in each webhook post (default 100)."),
+            make_option('--rate', type='float', dest='rate', default=None,
+                        help="Target events per second (default as fast as possible)."),
+            make_option('--event-types', dest='event_types', default=None,
+                        help="Comma-separated event types to post (default all: %s)."
+                             % ",".join(sorted(DEFAULT_EVENT_MIX))),
+            make_option('--seed', type='int', dest='seed', default=None,
+                        help="Random seed, for reproducible events."),
+            make_option('--trace-memory', action='store_true', dest='trace_memory', default=False,
+                        help="Also report peak memory allocated during the run (python 3; slower)."),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', dest='url', default=None,
+                            help="Path to post to in-process, or http(s) url of a running server "
+                                 "(default: the djrill_webhook url, with DJRILL_WEBHOOK_SECRET).")
+        parser.add_argument('--events', type=int, dest='events', default=10000,
+                            help="Total number of events to post (default 10000).")
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=100,
+                            help="Events in each webhook post (default 100).")
+        parser.add_argument('--rate', type=float, dest='rate', default=None,
+                            help="Target events per second (default as fast as possible).")
+        parser.add_argument('--event-types', dest='event_types', default=None,
+                            help="Comma-separated event types to post (default all: %s)."
+                                 % ",".join(sorted(DEFAULT_EVENT_MIX)))
+        parser.add_argument('--seed', type=int, dest='seed', default=None,
+                            help="Random seed, for reproducible events.")
+        parser.add_argument('--trace-memory', action='store_true', dest='trace_memory', default=False,
+                            help="Also report peak memory allocated during the run (python 3; slower).")
+
+    def handle(self, *args, **options):
+        url = options['url']
+        if url is None:
+            url = "%s?%s=%s" % (reverse('djrill_webhook'),
+                                getattr(settings, 'DJRILL_WEBHOOK_SECRET_NAME', 'secret'),
+                                getattr(settings, 'DJRILL_WEBHOOK_SECRET', ''))
+        event_types = options['event_types'].split(",") if options['event_types'] else None
+        generator = WebhookLoadGenerator(url, factory=WebhookEventFactory(seed=options['seed']))
+        try:
+            report = generator.run(events=options['events'], batch_size=options['batch_size'],
+                                   rate=options['rate'], event_types=event_types,
+                                   trace_memory=options['trace_memory'])
+        except ValueError as err:
+            raise CommandError(str(err))
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
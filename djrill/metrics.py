@@ -0,0 +1,282 @@
+"""Counters and latency histograms for Djrill's sends, API calls and webhooks
+
+Djrill counts into the shared metrics registry as it works. Each thread counts
+into its own shard, so there's no lock to contend for; the shards are only
+summed when the metrics are collected. When a thread ends, its shard is folded
+into a shared total, so short-lived threads don't accumulate shards.
+
+To combine the metrics of several processes (e.g., gunicorn workers), set
+MANDRILL_METRICS_DIR to a directory they can all write. Each process then
+saves its totals there every few seconds (from a background thread, so sends
+never wait on, or fail because of, the metrics files), and collect sums them all.
+Files that haven't been saved for a while (from processes that have ended)
+are removed when the metrics are collected.
+
+DjrillMetricsView (in djrill.views) renders the metrics in Prometheus text format.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class MetricsRegistry(object):
+    """Thread-sharded counters and histograms, identified by name and labels"""
+
+    flush_interval = 5  # seconds between saves to MANDRILL_METRICS_DIR
+    stale_after = 60  # seconds after which an unsaved file in MANDRILL_METRICS_DIR is a dead process's
+
+    def __init__(self):
+        self.descriptions = {}  # name: (type, help, buckets)
+        self._local = threading.local()
+        self._shards = {}  # weakref to a thread's _ShardOwner: its (counters, histograms)
+        self._retired = ({}, {})  # totals of the shards of threads that have ended
+        self._ended = []  # weakrefs of ended threads' shards, to fold into _retired
+        self._lock = threading.Lock()  # for _shards and _retired
+        self._pid = os.getpid()
+        self._next_check = 0
+        self._flusher = None  # background thread saving to MANDRILL_METRICS_DIR
+
+    def describe(self, name, metric_type, help, buckets=DEFAULT_BUCKETS):
+        """Register a metric's Prometheus type ("counter" or "histogram") and help text"""
+        self.descriptions[name] = (metric_type, help, tuple(buckets))
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            # the thread's locals are freed when it ends, which calls back to the weakref
+            owner = self._local.owner = _ShardOwner()
+            ref = weakref.ref(owner, self._ended.append)  # (list.append is atomic, so safe from any thread)
+            with self._lock:
+                self._retire_ended()
+                self._shards[ref] = shard
+            return shard
+
+    def _retire_ended(self):
+        # (call with self._lock held)
+        retired_counters, retired_histograms = self._retired
+        while self._ended:
+            counters, histograms = self._shards.pop(self._ended.pop(), ({}, {}))
+            for key, value in counters.items():
+                retired_counters[key] = retired_counters.get(key, 0) + value
+            for key, data in histograms.items():
+                _add_histogram(retired_histograms, key, list(data))
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to the counter name (with labels)"""
+        counters = self._shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + amount
+        if time.time() >= self._next_check:
+            self._check_flusher()
+
+    def observe(self, name, value, **labels):
+        """Record value (e.g., a latency in seconds) in the histogram name (with labels)"""
+        histograms = self._shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.descriptions.get(name, (None, None, DEFAULT_BUCKETS))[2]
+        data = histograms.get(key)
+        if data is None:
+            data = histograms[key] = [0] * (len(buckets) + 2)  # a count for each bucket and +Inf, then the sum
+        data[bisect_left(buckets, value)] += 1
+        data[-1] += value
+        if time.time() >= self._next_check:
+            self._check_flusher()
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            # a forked child: what it inherited is the parent's to report
+            # (and the parent's flusher thread didn't come along)
+            self._pid = os.getpid()
+            self._flusher = None
+            self.reset()
+
+    def _check_flusher(self):
+        """Start the background flusher thread, if MANDRILL_METRICS_DIR is set and it isn't running"""
+        self._next_check = time.time() + self.flush_interval
+        self._check_fork()
+        if self._flusher is None and getattr(settings, "MANDRILL_METRICS_DIR", None):
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run_flusher, name="djrill-metrics-flusher")
+                    self._flusher.daemon = True
+                    self._flusher.start()
+
+    def _run_flusher(self):
+        flusher = threading.current_thread()
+        while self._flusher is flusher:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        """Return this process's metrics, as {"counters": {key: value}, "histograms": {key: data}}"""
+        with self._lock:
+            self._retire_ended()
+            shards = [(dict(self._retired[0]), dict((key, list(data)) for key, data in self._retired[1].items()))]
+            shards.extend(self._shards.values())
+        counters = {}
+        histograms = {}
+        for shard_counters, shard_histograms in shards:
+            for key, value in dict(shard_counters).items():  # (copying is atomic; iterating isn't)
+                counters[key] = counters.get(key, 0) + value
+            for key, data in dict(shard_histograms).items():
+                _add_histogram(histograms, key, list(data))
+        return {"counters": counters, "histograms": histograms}
+
+    def reset(self):
+        """Clear all the metrics in this process"""
+        with self._lock:
+            self._retire_ended()
+            for counters, histograms in [self._retired] + list(self._shards.values()):
+                counters.clear()
+                histograms.clear()
+
+    def flush(self):
+        """Save this process's metrics to MANDRILL_METRICS_DIR (if set)
+
+        Errors saving the file are logged, rather than raised.
+        """
+        self._check_fork()
+        directory = getattr(settings, "MANDRILL_METRICS_DIR", None)
+        if not directory:
+            return
+        snapshot = self.snapshot()
+        data = {
+            "counters": [[name, labels, value] for (name, labels), value in snapshot["counters"].items()],
+            "histograms": [[name, labels, value] for (name, labels), value in snapshot["histograms"].items()],
+        }
+        path = os.path.join(directory, "djrill-metrics-%d.json" % self._pid)
+        temp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(data, f)
+            try:
+                os.rename(temp_path, path)
+            except OSError:  # Windows won't rename over an existing file
+                os.remove(path)
+                os.rename(temp_path, path)
+        except (IOError, OSError):
+            logger.warning("Couldn't save Djrill metrics to %s", path, exc_info=True)
+
+    def collect(self):
+        """Return the metrics of every process sharing MANDRILL_METRICS_DIR (or just this one's), like snapshot"""
+        directory = getattr(settings, "MANDRILL_METRICS_DIR", None)
+        if not directory:
+            return self.snapshot()
+        self.flush()
+        counters = {}
+        histograms = {}
+        stale_before = time.time() - self.stale_after
+        own_filename = "djrill-metrics-%d.json" % self._pid
+        for filename in os.listdir(directory):
+            if not (filename.startswith("djrill-metrics-") and filename.endswith(".json")):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                if filename != own_filename and os.path.getmtime(path) < stale_before:
+                    os.remove(path)  # (a process that's no longer running)
+                    continue
+                with open(path) as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue  # (removed or being replaced)
+            for name, labels, value in data["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in data["histograms"]:
+                _add_histogram(histograms, (name, tuple(tuple(label) for label in labels)), value)
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self, snapshot=None):
+        """Return the metrics (default collect()) in Prometheus text exposition format"""
+        if snapshot is None:
+            snapshot = self.collect()
+        by_name = {}
+        for (name, labels), value in snapshot["counters"].items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in snapshot["histograms"].items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help, buckets = self.descriptions.get(name, ("untyped", None, DEFAULT_BUCKETS))
+            if help:
+                lines.append("# HELP %s %s" % (name, help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in sorted(by_name[name]):
+                if metric_type == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), value[:-1]):
+                        cumulative += count
+                        lines.append("%s_bucket%s %s" % (
+                            name, _format_labels(labels + (("le", _format_value(bound)),)), cumulative))
+                    lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(value[-1])))
+                    lines.append("%s_count%s %s" % (name, _format_labels(labels), cumulative))
+                else:
+                    lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class _ShardOwner(object):
+    """Kept in a thread's locals, so a weakref to it can tell when the thread has ended"""
+
+
+def _add_histogram(histograms, key, data):
+    total = histograms.get(key)
+    if total is None:
+        histograms[key] = data
+    else:
+        for i, value in enumerate(data):
+            total[i] += value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, ("%s" % value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return "%s" % value
+
+
+metrics = MetricsRegistry()
+
+metrics.describe("djrill_messages_total", "counter",
+                 "Messages handled by DjrillBackend, by result (sent, scheduled, fallback or failed)")
+metrics.describe("djrill_recipients_total", "counter",
+                 "Recipients in Mandrill send responses, by status")
+metrics.describe("djrill_api_requests_seconds", "histogram",
+                 "Mandrill API call latency, by API method")
+metrics.describe("djrill_api_errors_total", "counter",
+                 "Failed Mandrill API calls, by API method and HTTP status code (none for connection errors)")
+metrics.describe("djrill_hedged_calls_total", "counter",
+                 "Read-only Mandrill API calls made with MANDRILL_HEDGE_READS, "
+                 "by outcome (not_hedged, first_won or hedge_won)")
+metrics.describe("djrill_webhook_events_total", "counter",
+                 "Mandrill webhook events received, by event type")
+metrics.describe("djrill_webhook_batch_seconds", "histogram",
+                 "Time to handle each Mandrill webhook post (including webhook_event receivers)")
+
+
+def count_recipient_statuses(send_result):
+    """Count the recipients in a MandrillSendResult by status (ignoring other responses)"""
+    for status, count in getattr(send_result, 'status_counts', {}).items():
+        metrics.inc("djrill_recipients_total", count, status=status)
@@ -0,0 +1,84 @@
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+
+class MessagePrototype(object):
+    """A message compiled once into a Mandrill message dict, for sending many variants
+
+    Building a Mandrill payload from an EmailMessage (converting its body, alternatives,
+    attachments and Mandrill options) costs the same for every message. When many
+    messages differ only in their recipients and per-recipient data, compile the shared
+    message once, and send variants of it:
+
+        prototype = MessagePrototype(newsletter)
+        messages = [prototype.variant(to=[row['email']], merge_vars={row['email']: row['vars']})
+                    for row in rows]
+        get_connection().send_messages(messages)
+
+    Each variant's payload is a shallow copy of the prototype's message dict with
+    the variant's own recipients, merge_vars, recipient_metadata and metadata. The
+    rest (e.g., the attachments) is shared, not copied, so don't change the prototype
+    message after compiling it.
+
+    The message dict is built with connection (default a DjrillBackend), so it reflects
+    that connection's MANDRILL_SETTINGS (and, with MANDRILL_RENDER_TEMPLATES_LOCALLY, the
+    template as it was then).
+    """
+
+    def __init__(self, message, connection=None):
+        if connection is None:
+            connection = get_connection('djrill.mail.backends.djrill.DjrillBackend')
+        self.message = message
+        payload = {}
+        connection.build_send_payload(payload, message)
+        self.message_dict = payload.pop('message')
+        self.toplevel_params = payload  # e.g., template_name, send_at
+
+    def variant(self, to=None, cc=None, bcc=None, merge_vars=None, recipient_metadata=None, metadata=None):
+        """Return an EmailMessage for sending this prototype with other recipients and data
+
+        merge_vars and recipient_metadata (dicts or RecipientData) replace the prototype's.
+        metadata is added to the prototype's.
+        """
+        return PrototypeVariant(self, to=to, cc=cc, bcc=bcc, merge_vars=merge_vars,
+                                recipient_metadata=recipient_metadata, metadata=metadata)
+
+    def build_payload(self, backend, payload, message):
+        """Add variant message's Mandrill data to payload (for DjrillBackend.build_send_payload)"""
+        msg_dict = dict(self.message_dict)
+        msg_dict['to'] = (backend._make_mandrill_to_list(message, message.to, "to") +
+                          backend._make_mandrill_to_list(message, message.cc, "cc") +
+                          backend._make_mandrill_to_list(message, message.bcc, "bcc"))
+        if message.merge_vars is not None:
+            msg_dict['merge_vars'] = backend._make_merge_vars(message.merge_vars)
+        if message.recipient_metadata is not None:
+            msg_dict['recipient_metadata'] = backend._make_recipient_metadata(message.recipient_metadata)
+        if message.metadata is not None:
+            msg_dict['metadata'] = dict(self.message_dict.get('metadata', {}), **message.metadata)
+        payload.update(self.toplevel_params)
+        payload.setdefault('message', {}).update(msg_dict)
+
+
+class PrototypeVariant(EmailMultiAlternatives):
+    """An EmailMessage sending a MessagePrototype to its own recipients (see MessagePrototype.variant)
+
+    DjrillBackend builds its payload from the prototype. It shares the prototype
+    message's content, so other email backends (e.g., MANDRILL_FALLBACK_BACKEND)
+    can send it too, without the Mandrill options.
+    """
+
+    def __init__(self, prototype, to=None, cc=None, bcc=None, merge_vars=None, recipient_metadata=None,
+                 metadata=None):
+        base = prototype.message
+        super(PrototypeVariant, self).__init__(base.subject, base.body, base.from_email, to=to, cc=cc, bcc=bcc)
+        self.mandrill_prototype = prototype
+        self.merge_vars = merge_vars
+        self.recipient_metadata = recipient_metadata
+        self.metadata = metadata
+        self.attachments = base.attachments
+        self.alternatives = getattr(base, 'alternatives', [])
+        self.extra_headers = base.extra_headers
+        self.content_subtype = base.content_subtype
+        self.mixed_subtype = base.mixed_subtype
+        self.encoding = base.encoding
+        if hasattr(base, 'reply_to'):
+            self.reply_to = base.reply_to
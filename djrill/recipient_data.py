@@ -0,0 +1,70 @@
+class RecipientData(object):
+    """Per-recipient merge_vars or recipient_metadata, for large recipient lists.
+
+    Use in place of the usual {rcpt: {name: value, ...}, ...} dict on an
+    EmailMessage's merge_vars or recipient_metadata. Every recipient shares the
+    same set of names, so Djrill can build the Mandrill arrays in a single pass,
+    without sorting or expanding a separate dict for each recipient.
+
+    Construct from columns:
+        RecipientData({'rcpt': ["a@example.com", "b@example.com"],
+                       'NAME': ["Alice", "Bob"], 'CODE': ["A1", "B2"]})
+    or from rows sharing one set of keys:
+        RecipientData.from_rows([{'rcpt': "a@example.com", 'NAME': "Alice"},
+                                 {'rcpt': "b@example.com", 'NAME': "Bob"}])
+
+    Recipients stay in the order given.
+    """
+
+    def __init__(self, columns, rcpt_column='rcpt'):
+        self.names = sorted(name for name in columns if name != rcpt_column)
+        self.rcpts = list(columns[rcpt_column])
+        value_columns = [columns[name] for name in self.names]
+        for name, column in zip(self.names, value_columns):
+            if len(column) != len(self.rcpts):
+                raise ValueError("RecipientData column '%s' has %d values for %d recipients"
+                                 % (name, len(column), len(self.rcpts)))
+        self.rows = list(zip(*value_columns)) if value_columns else [()] * len(self.rcpts)
+
+    @classmethod
+    def from_rows(cls, rows, rcpt_column='rcpt'):
+        """Return a RecipientData from a sequence of dicts that all have the same keys"""
+        names = None
+        rcpts = []
+        value_rows = []
+        for row in rows:
+            if names is None:
+                names = sorted(name for name in row if name != rcpt_column)
+            rcpts.append(row[rcpt_column])
+            value_rows.append(tuple([row[name] for name in names]))
+        return cls._from_parts(names or [], rcpts, value_rows)
+
+    @classmethod
+    def _from_parts(cls, names, rcpts, rows):
+        data = cls.__new__(cls)
+        data.names = names
+        data.rcpts = rcpts
+        data.rows = rows
+        return data
+
+    def __len__(self):
+        return len(self.rcpts)
+
+    def subset(self, emails):
+        """Return a RecipientData with only the recipients in emails (case-insensitive)"""
+        emails = set(email.lower() for email in emails)
+        kept = [(rcpt, row) for rcpt, row in zip(self.rcpts, self.rows) if rcpt.lower() in emails]
+        return self._from_parts(self.names, [rcpt for rcpt, row in kept], [row for rcpt, row in kept])
+
+    def as_merge_vars(self):
+        """Return Mandrill's [{'rcpt': rcpt, 'vars': [{'name': name, 'content': value}, ...]}, ...]"""
+        names = self.names
+        return [{'rcpt': rcpt, 'vars': [{'name': name, 'content': value} for name, value in zip(names, row)]}
+                for rcpt, row in zip(self.rcpts, self.rows)]
+
+    def as_recipient_metadata(self):
+        """Return Mandrill's [{'rcpt': rcpt, 'values': {name: value, ...}}, ...]"""
+        names = self.names
+        return [{'rcpt': rcpt, 'values': dict(zip(names, row))}
+                for rcpt, row in zip(self.rcpts, self.rows)]
+
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .signals import webhook_event
+
+
+class RejectList(object):
+    """In-process set of email addresses known to be on the Mandrill rejection blacklist.
+
+    Addresses are stored lowercased, so membership tests are case-insensitive.
+    An entry can apply to all senders, or (like Mandrill's sender-specific
+    rejects) to a single sender address; `email in reject_list` tests for the former.
+    The list is shared by every DjrillBackend in the process, and is kept
+    current by merging in Mandrill's rejects/list API results and by
+    rejection-related webhook events.
+    """
+
+    def __init__(self):
+        self._entries = {}  # lowercased email: frozenset of lowercased senders (None for all senders)
+        self._lock = threading.Lock()
+        self.refreshed_at = None  # time.time() of last full refresh
+        self.refresh_failed_at = None  # time.time() of last failed refresh (since the last successful one)
+
+    def __contains__(self, email):
+        return None in self._entries.get(email.lower(), ())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_rejected(self, email, sender=None):
+        """Return True if email is rejected for all senders, or for sender (an email address)"""
+        senders = self._entries.get(email.lower())
+        if not senders:
+            return False
+        return None in senders or (sender is not None and sender.lower() in senders)
+
+    def add(self, email, sender=None):
+        """Add email, rejected for all senders (or just for sender)"""
+        self.update([(email, sender)])
+
+    def discard(self, email, sender=None):
+        """Remove email's entry for sender (or, if sender is None, all its entries)"""
+        self.update((), [(email, sender)])
+
+    def update(self, added=(), removed=()):
+        """Add the (email, sender) entries in added, and remove those in removed
+
+        (A sender of None means all senders; removing it removes all of the email's entries.)
+        """
+        with self._lock:
+            self._entries = _updated_entries(self._entries, added, removed)
+
+    def merge_refresh(self, added, removed=()):
+        """Merge a rejects/list result: add its current (email, sender) entries, and remove its expired ones
+
+        Entries that aren't in the result are kept (rejects/list returns at most
+        1000 entries, and webhook events may have added newer ones).
+        """
+        with self._lock:
+            self._entries = _updated_entries(self._entries, added, removed)
+            self.refreshed_at = time.time()
+            self.refresh_failed_at = None
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.refreshed_at = None
+            self.refresh_failed_at = None
+
+    def refresh_failed(self):
+        """Note that a refresh was attempted and failed, so is_stale will wait a while before asking for another"""
+        self.refresh_failed_at = time.time()
+
+    def is_stale(self, max_age, retry_delay=60):
+        """Return True if the list has never been refreshed, or is older than max_age seconds
+
+        After a failed refresh, returns False for retry_delay seconds (or max_age, if shorter),
+        so an API outage doesn't add a rejects/list call to every send.
+        """
+        if max_age is None:
+            return False
+        now = time.time()
+        if self.refresh_failed_at is not None and now - self.refresh_failed_at < min(retry_delay, max_age):
+            return False
+        return self.refreshed_at is None or now - self.refreshed_at > max_age
+
+
+def _updated_entries(entries, added, removed):
+    entries = dict(entries)  # (readers never see a partial update)
+    for email, sender in removed:
+        email = email.lower()
+        if sender is None:
+            entries.pop(email, None)
+        elif email in entries:
+            senders = entries[email] - {sender.lower()}
+            if senders:
+                entries[email] = senders
+            else:
+                del entries[email]
+    for email, sender in added:
+        email = email.lower()
+        entries[email] = entries.get(email, frozenset()) | {sender.lower() if sender else None}
+    return entries
+
+
+def reject_sender(reject):
+    """Return the sender address a Mandrill reject entry applies to, or None for all senders
+
+    (rejects/list gives the sender as a struct with an address; sync webhook events as a string.)
+    """
+    sender = reject.get('sender')
+    if isinstance(sender, dict):
+        sender = sender.get('address')
+    return sender or None
+
+
+reject_list = RejectList()
+
+
+@receiver(webhook_event)
+def update_reject_list(sender, event_type, data, **kwargs):
+    """Keep reject_list current from Mandrill message and sync webhook events"""
+    if not getattr(settings, "MANDRILL_REJECT_FILTER", False):
+        return
+    try:
+        if event_type in ('hard_bounce', 'reject'):
+            # Message event: Mandrill blacklists hard bounces automatically
+            reject_list.add(data['msg']['email'])
+        elif event_type in ('blacklist_add', 'blacklist_change'):
+            if data['reject'].get('expired'):
+                reject_list.discard(data['reject']['email'], reject_sender(data['reject']))
+            else:
+                reject_list.add(data['reject']['email'], reject_sender(data['reject']))
+        elif event_type == 'blacklist_remove':
+            reject_list.discard(data['reject']['email'], reject_sender(data['reject']))
+        elif event_type == 'whitelist_add':
+            reject_list.discard(data['reject']['email'])
+    except (KeyError, TypeError, AttributeError):
+        pass  # malformed event; not our problem to report
@@ -0,0 +1,149 @@
+"""Local storage for messages with a future send_at, until they're due
+
+Enabled by the MANDRILL_SCHEDULER_DB setting (the path of a SQLite database).
+Djrill stores each scheduled send's Mandrill payload (without the API key),
+indexed by due time, and the djrill_send_scheduled management command (or
+DjrillBackend.send_scheduled) releases the due ones in batches.
+
+Claiming a batch pushes its due times out by a lease period, rather than
+removing the messages, so a worker that dies mid-batch doesn't lose them
+(they're sent again once the lease expires).
+"""
+
+import calendar
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS djrill_scheduled (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    due_at REAL NOT NULL,
+    payload TEXT NOT NULL,
+    route TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS djrill_scheduled_due_at ON djrill_scheduled (due_at);
+"""
+
+
+class ScheduledSend(object):
+    """A stored send, claimed for sending"""
+
+    def __init__(self, id, due_at, payload, route, attempts):
+        self.id = id
+        self.due_at = due_at
+        self.payload = payload  # serialized json, without the API key or send_at
+        self.route = route  # MANDRILL_KEY_FUNCTION value when it was scheduled
+        self.attempts = attempts  # including this one
+
+
+class SendScheduler(object):
+    """SQLite-backed store of scheduled sends, indexed by due time"""
+
+    lease_seconds = 300  # how long a claimed send is held before it's eligible to be claimed again
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # sqlite connections can't be shared between threads
+        self._execute_script(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _execute_script(self, script):
+        for statement in script.split(";"):
+            if statement.strip():
+                self.connection.execute(statement)
+
+    def schedule(self, due_at, payload, route=None):
+        """Store serialized payload to send at due_at (a Unix timestamp). Returns its id."""
+        cursor = self.connection.execute(
+            "INSERT INTO djrill_scheduled (due_at, payload, route) VALUES (?, ?, ?)",
+            (due_at, payload, None if route is None else "%s" % route))
+        return cursor.lastrowid
+
+    def cancel(self, send_id):
+        """Remove a scheduled send. Returns True if it was still scheduled."""
+        cursor = self.connection.execute("DELETE FROM djrill_scheduled WHERE id = ?", (send_id,))
+        return cursor.rowcount > 0
+
+    def reschedule(self, send_id, due_at):
+        """Change when a scheduled send is due. Returns True if it was still scheduled."""
+        cursor = self.connection.execute("UPDATE djrill_scheduled SET due_at = ? WHERE id = ?", (due_at, send_id))
+        return cursor.rowcount > 0
+
+    def claim_due(self, limit=100, now=None):
+        """Return a list of up to limit ScheduledSends that are due, leased to the caller.
+
+        Call complete (or retry) for each one once it's been handled.
+        """
+        now = time.time() if now is None else now
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                "SELECT id, due_at, payload, route, attempts FROM djrill_scheduled"
+                " WHERE due_at <= ? ORDER BY due_at LIMIT ?", (now, limit)).fetchall()
+            for ids in _chunks([row[0] for row in rows], 500):
+                connection.execute(
+                    "UPDATE djrill_scheduled SET due_at = ?, attempts = attempts + 1 WHERE id IN (%s)"
+                    % ",".join("?" * len(ids)), [now + self.lease_seconds] + ids)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return [ScheduledSend(id, due_at, payload, route, attempts + 1)
+                for (id, due_at, payload, route, attempts) in rows]
+
+    def complete(self, send_ids):
+        """Remove claimed sends that have been handled"""
+        for ids in _chunks(list(send_ids), 500):
+            self.connection.execute("DELETE FROM djrill_scheduled WHERE id IN (%s)" % ",".join("?" * len(ids)), ids)
+
+    def retry(self, send_id, delay):
+        """Make a claimed send due again after delay seconds"""
+        self.reschedule(send_id, time.time() + delay)
+
+    def count(self):
+        """Return the number of stored sends"""
+        return self.connection.execute("SELECT COUNT(*) FROM djrill_scheduled").fetchone()[0]
+
+    def next_due_at(self):
+        """Return the earliest due time of any stored send, or None"""
+        return self.connection.execute("SELECT MIN(due_at) FROM djrill_scheduled").fetchone()[0]
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+_schedulers = {}  # path: SendScheduler
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(path):
+    """Return the shared SendScheduler for the SQLite database at path"""
+    with _schedulers_lock:
+        try:
+            return _schedulers[path]
+        except KeyError:
+            scheduler = _schedulers[path] = SendScheduler(path)
+            return scheduler
+
+
+def parse_send_at(send_at):
+    """Return a Mandrill send_at string ("YYYY-MM-DD HH:MM:SS", UTC) as a Unix timestamp, or None"""
+    try:
+        return calendar.timegm(datetime.strptime(send_at, "%Y-%m-%d %H:%M:%S").timetuple())
+    except (TypeError, ValueError):
+        return None
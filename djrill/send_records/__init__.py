@@ -0,0 +1,164 @@
+"""Buffered recording of send results, and batch lookup for webhook events
+
+Enabled by the MANDRILL_RECORD_SENDS setting. DjrillBackend adds each sent
+message's recipients to a shared SendRecordWriter, which saves them with one
+bulk_create per batch (rather than one insert per send). DjrillWebhookView
+uses lookup_send_records to find the records for a whole webhook batch at once.
+Database errors saving a batch are logged (and the batch dropped), rather than
+raised from the send that happened to fill it: the message has already been sent.
+
+The MandrillSend model lives in this optional app: add "djrill.send_records"
+to INSTALLED_APPS (and migrate) to use it.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+default_app_config = 'djrill.send_records.apps.SendRecordsConfig'
+
+logger = logging.getLogger(__name__)
+
+
+class SendRecordWriter(object):
+    """Collects MandrillSend records, and saves them in batches
+
+    The buffer is saved once it holds batch_size records, or max_delay seconds
+    after the oldest buffered record was added (by a timer thread, so records
+    aren't held indefinitely in a process that has stopped sending), and at exit.
+    """
+
+    def __init__(self, batch_size=500, max_delay=5):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._oldest = None
+        self._timer = None
+        self.saved = 0
+
+    def add_result(self, send_result, reference=""):
+        """Buffer a record for each recipient in a MandrillSendResult that Mandrill gave an _id"""
+        from .models import MandrillSend
+        now = timezone.now()
+        reference = reference or ""
+        records = [
+            MandrillSend(mandrill_id=mandrill_id, email=email, status=status,
+                         reject_reason=send_result.reject_reasons.get(email) or "",
+                         reference=reference, created=now)
+            for email, status, mandrill_id in zip(send_result.emails, send_result.statuses, send_result.ids)
+            if mandrill_id
+        ]
+        if records:
+            self.add(records)
+
+    def add(self, records):
+        """Buffer MandrillSend records (saving the buffer if it's due)"""
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.time()
+                self._timer = threading.Timer(self.max_delay, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+            self._buffer.extend(records)
+            due = len(self._buffer) >= self.batch_size or time.time() - self._oldest >= self.max_delay
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Save all the buffered records now (logging, rather than raising, database errors)"""
+        from .models import MandrillSend
+        with self._lock:
+            records, self._buffer = self._buffer, []
+            timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        if records:
+            try:
+                for start in range(0, len(records), self.batch_size):
+                    MandrillSend.objects.bulk_create(records[start:start + self.batch_size])
+            except DatabaseError:
+                logger.exception("Couldn't save %d Djrill send records", len(records))
+                return
+            with self._lock:
+                self.saved += len(records)
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()  # (the timer thread's own connection)
+
+    def pending(self):
+        """Return the number of buffered records"""
+        return len(self._buffer)
+
+
+def lookup_send_records(events, writer=None):
+    """Return {Mandrill _id: MandrillSend record} for a batch of webhook events
+
+    Saves writer's buffered records first, so recent sends are found.
+    """
+    from .models import MandrillSend
+    if writer is not None:
+        writer.flush()
+    mandrill_ids = set()
+    for event in events:
+        mandrill_id = event_mandrill_id(event)
+        if mandrill_id:
+            mandrill_ids.add(mandrill_id)
+    records = {}
+    mandrill_ids = sorted(mandrill_ids)
+    for start in range(0, len(mandrill_ids), 500):  # (SQLite allows 999 query parameters)
+        for record in MandrillSend.objects.filter(mandrill_id__in=mandrill_ids[start:start + 500]):
+            records[record.mandrill_id] = record
+    return records
+
+
+def event_mandrill_id(event):
+    """Return the Mandrill message _id a webhook event is about, or None"""
+    try:
+        return event.get('_id') or event['msg']['_id']
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+_writers = {}  # repr(options): SendRecordWriter
+_writers_lock = threading.Lock()
+
+
+def get_send_record_writer(options):
+    """Return the shared SendRecordWriter for options (a dict), creating it if needed"""
+    if not is_installed():
+        raise ImproperlyConfigured("MANDRILL_RECORD_SENDS requires 'djrill.send_records' in INSTALLED_APPS")
+    config = repr(sorted(options.items()))
+    with _writers_lock:
+        try:
+            return _writers[config]
+        except KeyError:
+            writer = _writers[config] = SendRecordWriter(**options)
+            atexit.register(writer.flush)
+            return writer
+
+
+def is_installed():
+    """Return whether the djrill.send_records app (with the MandrillSend model) is installed"""
+    try:
+        from django.apps import apps
+    except ImportError:  # Django < 1.7
+        return 'djrill.send_records' in settings.INSTALLED_APPS
+    return apps.is_installed('djrill.send_records')
+
+
+def flush_send_records():
+    """Save the buffered send records of every SendRecordWriter in this process"""
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()
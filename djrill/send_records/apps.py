@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class SendRecordsConfig(AppConfig):
+    name = 'djrill.send_records'
+    label = 'djrill_send_records'
+    verbose_name = "Djrill send records"
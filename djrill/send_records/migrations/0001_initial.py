@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MandrillSend',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('mandrill_id', models.CharField(max_length=32, db_index=True)),
+                ('email', models.CharField(max_length=254)),
+                ('status', models.CharField(max_length=16)),
+                ('reject_reason', models.CharField(max_length=32, blank=True, default='')),
+                ('reference', models.CharField(max_length=255, blank=True, default='', db_index=True)),
+                ('created', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'db_table': 'djrill_mandrillsend',
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class MandrillSend(models.Model):
+    """One recipient's Mandrill send result, recorded when MANDRILL_RECORD_SENDS is enabled
+
+    Lets webhook events (which identify the message by its Mandrill _id)
+    be tied back to the send, and to the sender's own reference for it.
+    """
+
+    mandrill_id = models.CharField(max_length=32, db_index=True)
+    email = models.CharField(max_length=254)
+    status = models.CharField(max_length=16)
+    reject_reason = models.CharField(max_length=32, blank=True, default="")
+    reference = models.CharField(max_length=255, blank=True, default="", db_index=True)
+    created = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'djrill_mandrillsend'  # (the same on Django < 1.7, whose app_label is 'send_records')
+
+    def __str__(self):
+        return "%s to %s (%s)" % (self.mandrill_id, self.email, self.status)
@@ -0,0 +1,141 @@
+# Recipient statuses that mean Mandrill won't deliver to the recipient
+FAILED_STATUSES = ("invalid", "rejected")
+
+# Mandrill reject_reasons that may not apply on a later attempt (see DjrillBackend.resend_failed)
+RESENDABLE_REJECT_REASONS = ("rule", "soft-bounce")
+
+
+class MandrillSendResult(list):
+    """Mandrill's per-recipient messages/send response, with a compact index.
+
+    It's the original list of recipient status dicts (so it can be indexed,
+    iterated, compared, concatenated and serialized like one), plus what's
+    needed to answer the common questions quickly, even for very large
+    recipient lists, built in a single pass over the response:
+      status_counts: dict of status: number of recipients
+      emails, statuses, ids: per-recipient arrays, in response order
+      reject_reasons: dict of email: reject_reason (only for recipients that have one)
+    and status_for, id_for and reject_reason_for look up a single recipient
+    (case-insensitively). Adding recipients with extend (or append or +=)
+    updates the index incrementally; other changes to the list rebuild it.
+    """
+
+    def __init__(self, items=(), local_items=()):
+        """items is Mandrill's parsed send response (a list of recipient status dicts).
+
+        local_items are additional recipient status dicts (e.g., for recipients
+        Djrill rejected without calling Mandrill), reported after items.
+        """
+        super(MandrillSendResult, self).__init__(items)
+        self._reindex()
+        self.extend(local_items)
+
+    def _reindex(self):
+        self.status_counts = {}
+        self.emails = []
+        self.statuses = []
+        self.ids = []
+        self.reject_reasons = {}
+        self._index = {}  # lowercased email: index of its first entry
+        self._add(self)
+
+    def _add(self, items):
+        status_counts = self.status_counts
+        statuses = {}  # shares one str object for each distinct status
+        for item in items:
+            status = item['status']
+            status = statuses.setdefault(status, status)
+            email = item.get('email', "")
+            reject_reason = item.get('reject_reason')
+            self._index.setdefault(email.lower(), len(self.emails))
+            self.emails.append(email)
+            self.statuses.append(status)
+            self.ids.append(item.get('_id'))
+            if reject_reason is not None:
+                self.reject_reasons.setdefault(email, reject_reason)
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    def extend(self, items):
+        """Add more recipient status dicts (or another MandrillSendResult's recipients) to the result"""
+        if isinstance(items, MandrillSendResult):
+            offset = len(self.emails)
+            for email, index in items._index.items():
+                self._index.setdefault(email, offset + index)
+            self.emails.extend(items.emails)
+            self.statuses.extend(items.statuses)
+            self.ids.extend(items.ids)
+            for email, reject_reason in items.reject_reasons.items():
+                self.reject_reasons.setdefault(email, reject_reason)
+            for status, count in items.status_counts.items():
+                self.status_counts[status] = self.status_counts.get(status, 0) + count
+        else:
+            items = list(items)
+            self._add(items)
+        super(MandrillSendResult, self).extend(items)
+
+    def append(self, item):
+        self.extend([item])
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def index_of(self, email):
+        """Return the position of email's (first) entry in the response, or None"""
+        return self._index.get(email.lower())
+
+    def status_for(self, email):
+        """Return email's Mandrill status (e.g., "sent" or "rejected"), or None if not in the response"""
+        index = self.index_of(email)
+        return self.statuses[index] if index is not None else None
+
+    def id_for(self, email):
+        """Return the Mandrill _id of the message to email, or None"""
+        index = self.index_of(email)
+        return self.ids[index] if index is not None else None
+
+    def reject_reason_for(self, email):
+        """Return why Mandrill rejected email, or None"""
+        index = self.index_of(email)
+        return self.reject_reasons.get(self.emails[index]) if index is not None else None
+
+    def emails_with_status(self, *statuses):
+        """Return a list of the emails whose status is any of statuses"""
+        return [email for email, status in zip(self.emails, self.statuses) if status in statuses]
+
+    def failures(self, statuses=FAILED_STATUSES):
+        """Return a dict of email, status, reject_reason and _id for each recipient whose status is any of statuses"""
+        reject_reasons = self.reject_reasons
+        return [{"email": email, "status": status, "reject_reason": reject_reasons.get(email), "_id": _id}
+                for email, status, _id in zip(self.emails, self.statuses, self.ids) if status in statuses]
+
+    @property
+    def raw(self):
+        """The response as a plain list of recipient status dicts"""
+        return list(self)
+
+    def __reduce__(self):
+        # (the index is rebuilt, rather than pickled)
+        return self.__class__, (list(self),)
+
+    def __repr__(self):
+        return "<MandrillSendResult %s>" % ", ".join(
+            "%d %s" % (count, status) for status, count in sorted(self.status_counts.items()))
+
+
+def _reindexing(name):
+    method = getattr(list, name)
+
+    def reindexing_method(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._reindex()
+        return result
+    reindexing_method.__name__ = name
+    return reindexing_method
+
+
+# Any other change to the list rebuilds the index
+for _name in ("clear", "insert", "pop", "remove", "reverse", "sort",  # (clear: python 3)
+              "__setitem__", "__delitem__", "__imul__", "__setslice__", "__delslice__"):  # (the last two: python 2)
+    if hasattr(list, _name):
+        setattr(MandrillSendResult, _name, _reindexing(_name))
@@ -1,3 +1,3 @@
 from django.dispatch import Signal
 
-webhook_event = Signal(providing_args=['event_type', 'data'])
+webhook_event = Signal(providing_args=['event_type', 'data', 'send_record'])
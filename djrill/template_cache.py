@@ -0,0 +1,298 @@
+import re
+import threading
+import time
+
+from django.utils.html import escape
+
+from .exceptions import MandrillAPIError
+
+
+class MandrillTemplate(object):
+    """Local copy of a Mandrill template, from the templates/info API.
+
+    Only the *published* version of the template is used, because that's
+    the version Mandrill uses when sending.
+    """
+
+    def __init__(self, info):
+        self.name = info.get('name')
+        self.slug = info.get('slug')
+        self.code = info.get('publish_code') or ""
+        self.text = info.get('publish_text') or ""
+        self.subject = info.get('publish_subject')
+        self.from_email = info.get('publish_from_email')
+        self.from_name = info.get('publish_from_name')
+        self.edit_regions = frozenset(
+            match.group(3) for match in _EDIT_REGION_RE.finditer(self.code))
+        self._compiled = None
+
+    @property
+    def compiled(self):
+        """The template's html as a CompiledTemplate (compiled on first use)"""
+        if self._compiled is None:
+            self._compiled = CompiledTemplate(self.code)
+        return self._compiled
+
+    def merge_tags(self, merge_language="mailchimp", extra_content=(), conditionals=True):
+        """Return the set of merge var names used in the template.
+
+        extra_content is an optional list of additional strings (e.g.,
+        template_content blocks) that may also contain merge tags.
+        Mailchimp-language names are returned uppercased, since Mandrill
+        treats them case-insensitively. If conditionals is False, mailchimp
+        names that are only tested (like NAME in *|IF:NAME|*) are left out.
+        """
+        content = [self.code, self.text, self.subject or ""]
+        content.extend(extra_content)
+        if merge_language == "handlebars":
+            return set(name for text in content for name in _handlebars_names(text))
+        return set(name for text in content for name in _mailchimp_names(text, conditionals))
+
+    def render(self, template_content=None, merge_vars=None, merge_language="mailchimp"):
+        """Return the template's html with template_content and merge_vars filled in.
+
+        Intended for previews: this is a simple approximation of Mandrill's
+        rendering, which leaves conditionals, helpers and any merge tags not
+        in merge_vars untouched.
+        """
+        html = self.compiled.render(template_content or {})
+        return merge(html, merge_vars or {}, merge_language)
+
+
+class CompiledTemplate(object):
+    """Template html pre-split at its mc:edit regions, for quickly filling in template_content"""
+
+    def __init__(self, code):
+        self.segments = []  # (html before region, region name, CompiledTemplate of region's default content)
+        pos = 0
+        for name, inner_start, inner_end in edit_region_spans(code):
+            if inner_start < pos:
+                continue  # nested in the previous region; handled by that region's default
+            self.segments.append((code[pos:inner_start], name, CompiledTemplate(code[inner_start:inner_end])))
+            pos = inner_end
+        self.tail = code[pos:]
+
+    def render(self, template_content):
+        """Return the html with the content of each mc:edit region in template_content replaced"""
+        if not self.segments:
+            return self.tail
+        pieces = []
+        for html, name, default in self.segments:
+            pieces.append(html)
+            if name in template_content:
+                pieces.append(template_content[name])
+            else:
+                pieces.append(default.render(template_content))
+        pieces.append(self.tail)
+        return "".join(pieces)
+
+
+class TemplateCache(object):
+    """In-process cache of MandrillTemplate objects, with a time-to-live.
+
+    Unknown template names are cached too, so repeated sends to a missing
+    template don't each cost an API call.
+    """
+
+    def __init__(self):
+        self._templates = {}  # (api_key, name): (expires, MandrillTemplate or None)
+        self._lock = threading.Lock()
+
+    def get(self, backend, name, ttl=300, api_key=None):
+        """Return the MandrillTemplate for name, loading it via backend if needed.
+
+        Templates are cached (and loaded) separately for each API key,
+        defaulting to the backend's api_key.
+        Returns None if Mandrill doesn't know the template.
+        """
+        api_key = api_key or backend.api_key
+        cache_key = (api_key, name)
+        entry = self._templates.get(cache_key)
+        if entry is None or (entry[0] is not None and entry[0] < time.time()):
+            template = self._fetch(backend, name, api_key)
+            expires = time.time() + ttl if ttl is not None else None
+            with self._lock:
+                self._templates[cache_key] = entry = (expires, template)
+        return entry[1]
+
+    def invalidate(self, name=None):
+        """Forget the cached copy of template name (or all templates if name is None)"""
+        with self._lock:
+            if name is None:
+                self._templates.clear()
+            else:
+                for cache_key in [cache_key for cache_key in self._templates if cache_key[1] == name]:
+                    del self._templates[cache_key]
+
+    @staticmethod
+    def _fetch(backend, name, api_key):
+        try:
+            info = backend.call_mandrill_api("templates/info.json", {"key": api_key, "name": name})
+        except MandrillAPIError as err:
+            try:
+                if err.response.json()['name'] == 'Unknown_Template':
+                    return None
+            except (AttributeError, KeyError, TypeError, ValueError):
+                pass
+            raise
+        return MandrillTemplate(info)
+
+
+template_cache = TemplateCache()
+
+
+def check_template_payload(template, payload, merge_language="mailchimp"):
+    """Return a list of problems sending payload with template (empty if none)
+
+    Checks that every template_content block names one of the template's
+    mc:edit regions, and that the template can supply the subject and from
+    address if the message omits them. (Merge tags without merge vars are
+    reported separately, by unresolved_merge_tags.)
+    """
+    problems = []
+    msg_dict = payload.get('message', {})
+    template_content = payload.get('template_content', [])
+
+    unknown_regions = [block['name'] for block in template_content
+                       if block['name'] not in template.edit_regions]
+    if unknown_regions:
+        problems.append("no editable region(s) %s" % ", ".join(unknown_regions))
+
+    if 'subject' not in msg_dict and not template.subject:
+        problems.append("has no default subject")
+    if 'from_email' not in msg_dict and not template.from_email:
+        problems.append("has no default from address")
+    return problems
+
+
+def unresolved_merge_tags(template, payload, merge_language="mailchimp"):
+    """Return a sorted list of merge tags in template that payload has no merge var for
+
+    Covers (mailchimp) merge tags in the template, its content blocks and the
+    message's own subject, html and text, other than tags only used in
+    conditionals and Mandrill's own tags. Handlebars templates aren't checked
+    (their names can't be resolved without running the template).
+    """
+    if merge_language == "handlebars":
+        return []
+    needed_tags = _payload_merge_tags(template, payload, merge_language, conditionals=False)
+    return sorted(needed_tags - _payload_var_names(payload, merge_language) - _MAILCHIMP_BUILTIN_TAGS)
+
+
+def unused_merge_vars(template, payload, merge_language="mailchimp", ignore=()):
+    """Return a sorted list of payload's merge var names that aren't used in template
+
+    Tags in the template's content blocks and the message's own subject, html
+    and text count as used. Names in ignore (e.g., MANDRILL_SETTINGS's
+    global_merge_vars, which are shared by every template) aren't reported.
+    """
+    var_names = _payload_var_names(payload, merge_language) - _var_names(ignore, merge_language)
+    if not var_names:
+        return []
+    return sorted(var_names - _payload_merge_tags(template, payload, merge_language))
+
+
+def _payload_merge_tags(template, payload, merge_language, conditionals=True):
+    msg_dict = payload.get('message', {})
+    extra_content = ["%s" % block['content'] for block in payload.get('template_content', [])]
+    extra_content.extend(msg_dict.get(field) or "" for field in ('subject', 'html', 'text'))
+    return template.merge_tags(merge_language, extra_content, conditionals)
+
+
+def _payload_var_names(payload, merge_language):
+    msg_dict = payload.get('message', {})
+    var_names = [var['name'] for var in msg_dict.get('global_merge_vars', [])]
+    for rcpt_vars in msg_dict.get('merge_vars', []):
+        var_names.extend(var['name'] for var in rcpt_vars['vars'])
+    return _var_names(var_names, merge_language)
+
+
+def _var_names(names, merge_language):
+    if merge_language == "handlebars":
+        return set(names)
+    return set(name.upper() for name in names)  # (mailchimp tags are case-insensitive)
+
+
+#
+# Simple rendering
+#
+
+_EDIT_REGION_RE = re.compile(r'<([A-Za-z][A-Za-z0-9]*)\b[^>]*?\bmc:edit\s*=\s*(["\'])(.*?)\2[^>]*>', re.S)
+_MAILCHIMP_TAG_RE = re.compile(r'\*\|([A-Za-z0-9_]+)\|\*')
+# also finds var names in conditionals and modifiers, like *|IF:NAME=value|* or *|HTML:NAME|*:
+_MAILCHIMP_USAGE_RE = re.compile(r'\*\|(?:([A-Za-z]+):)?([A-Za-z0-9_]+)(?:[=!<>][^|]*)?\|\*')
+_MAILCHIMP_CONDITIONALS = frozenset(['IF', 'ELSEIF', 'IFNOT'])
+_MAILCHIMP_MODIFIERS = frozenset(['HTML', 'UPPER', 'LOWER', 'TITLE', 'URL'])
+# Mandrill fills these in itself (as well as prefixed tags like *|MC:SUBJECT|*, *|LIST:COMPANY|*
+# or *|DATE:Y|*, which _mailchimp_names skips):
+_MAILCHIMP_BUILTIN_TAGS = frozenset([
+    'ABOUT_LIST', 'ARCHIVE', 'ARCHIVE_LINK_SHORT', 'CURRENT_YEAR', 'EMAIL', 'FORWARD',
+    'LIST_ADDRESS', 'LIST_ADDRESS_HTML', 'MC_LANGUAGE', 'MC_LANGUAGE_LABEL', 'MC_PREVIEW_TEXT',
+    'REWARDS', 'REWARDS_TEXT', 'UNSUB', 'UPDATE_PROFILE'])
+_HANDLEBARS_RE = re.compile(r'({{{?)\s*([^}]*?)\s*}}}?')
+_HANDLEBARS_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*')
+
+
+def _mailchimp_names(text, conditionals=True):
+    """Yield the (uppercased) merge var names used in mailchimp merge tags in text
+
+    Names in conditionals (like *|IF:NAME|*) are left out if conditionals is False.
+    """
+    for match in _MAILCHIMP_USAGE_RE.finditer(text):
+        prefix = (match.group(1) or "").upper()
+        if prefix in _MAILCHIMP_CONDITIONALS:
+            if conditionals:
+                yield match.group(2).upper()
+        elif not prefix or prefix in _MAILCHIMP_MODIFIERS:
+            yield match.group(2).upper()
+
+
+def _handlebars_names(text):
+    """Yield top-level variable names referenced in handlebars expressions in text"""
+    for match in _HANDLEBARS_RE.finditer(text):
+        for token in match.group(2).lstrip('#^/').split()[:4]:
+            name = _HANDLEBARS_NAME_RE.match(token)
+            if name and name.group(0) not in ('if', 'unless', 'each', 'with', 'else', 'this'):
+                yield name.group(0)
+
+
+def _find_region_end(code, tag, start):
+    """Return (inner_end, outer_end) of the element tag opened just before start, or None"""
+    depth = 1
+    for match in re.compile(r'<(/?)%s\b[^>]*?(/?)>' % re.escape(tag), re.I).finditer(code, start):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                return match.start(), match.end()
+        elif not match.group(2):
+            depth += 1
+    return None
+
+
+def edit_region_spans(code):
+    """Yield (name, inner_start, inner_end) for each mc:edit region in code"""
+    for match in _EDIT_REGION_RE.finditer(code):
+        if match.group(0).endswith('/>'):
+            continue
+        end = _find_region_end(code, match.group(1), match.end())
+        if end is not None:
+            yield match.group(3), match.end(), end[0]
+
+
+def merge(text, merge_vars, merge_language="mailchimp"):
+    """Return text with simple merge tags replaced by values from merge_vars"""
+    if merge_language == "handlebars":
+        def replace(match):
+            name = match.group(2)
+            if name not in merge_vars:
+                return match.group(0)
+            value = "%s" % merge_vars[name]
+            return value if match.group(1) == '{{{' else escape(value)
+        return _HANDLEBARS_RE.sub(replace, text)
+
+    upper_vars = dict((name.upper(), value) for name, value in merge_vars.items())
+
+    def replace(match):
+        name = match.group(1).upper()
+        return "%s" % upper_vars[name] if name in upper_vars else match.group(0)
+    return _MAILCHIMP_TAG_RE.sub(replace, text)
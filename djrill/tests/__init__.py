@@ -1,6 +1,21 @@
+from .test_fake_mandrill import *
+from .test_mandrill_bulk_send import *
+from .test_mandrill_circuit_breaker import *
+from .test_mandrill_dry_run import *
+from .test_mandrill_hedging import *
 from .test_mandrill_integration import *
+from .test_mandrill_key_pool import *
+from .test_mandrill_metrics import *
+from .test_mandrill_prototype import *
+from .test_mandrill_rejects import *
+from .test_mandrill_resend import *
+from .test_mandrill_scheduler import *
 from .test_mandrill_send import *
+from .test_mandrill_send_records import *
 from .test_mandrill_send_template import *
 from .test_mandrill_session_sharing import *
 from .test_mandrill_subaccounts import *
+from .test_mandrill_tracing import *
+from .test_mandrill_transports import *
 from .test_mandrill_webhook import *
+from .test_mandrill_webhook_load import *
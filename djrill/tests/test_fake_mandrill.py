@@ -0,0 +1,96 @@
+import errno
+import socket
+
+from mock import patch
+
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djrill import MandrillAPIError, MandrillRecipientsRefused
+from djrill.fake_mandrill import FakeMandrill, FakeMandrillServer, fake_mandrill
+
+
+@override_settings(MANDRILL_API_KEY="FAKE_API_KEY_FOR_TESTING",
+                   EMAIL_BACKEND="djrill.fake_mandrill.FakeMandrillBackend")
+class FakeMandrillBackendTests(TestCase):
+    """Test sending through the in-process fake Mandrill transport"""
+
+    def setUp(self):
+        fake_mandrill.configure(latency=0, error_rate=0, rate_limit_rate=0, rejects=[], templates={})
+        fake_mandrill.reset()
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_send(self):
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to1@example.com', 'to2@example.com'])
+        sent = msg.send()
+        self.assertEqual(sent, 1)
+        self.assertEqual([item['status'] for item in msg.mandrill_response], ['sent', 'sent'])
+        self.assertEqual(len(msg.mandrill_response[0]['_id']), 32)
+        self.assertEqual(fake_mandrill.call_counts, {"messages/send.json": 1})
+        self.assertEqual(fake_mandrill.recipient_count, 2)
+
+    def test_send_template(self):
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        msg.template_name = "WELCOME"
+        msg.send()
+        self.assertEqual(fake_mandrill.call_counts, {"messages/send-template.json": 1})
+
+        fake_mandrill.configure(templates={"OTHER_TEMPLATE": {"name": "OTHER_TEMPLATE"}})
+        with self.assertRaisesMessage(MandrillAPIError, "Unknown_Template"):
+            msg.send()
+
+    def test_rejects(self):
+        fake_mandrill.configure(rejects=["bounced@example.com"])
+        with self.assertRaises(MandrillRecipientsRefused):
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['bounced@example.com'])
+
+    def test_errors(self):
+        fake_mandrill.configure(error_rate=1)
+        with self.assertRaises(MandrillAPIError) as cm:
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(cm.exception.status_code, 500)
+
+        fake_mandrill.configure(error_rate=0, rate_limit_rate=1)
+        with self.assertRaises(MandrillAPIError) as cm:
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(cm.exception.status_code, 429)
+        self.assertEqual(fake_mandrill.status_counts, {500: 1, 429: 1})
+
+    def test_error_rate(self):
+        fake_mandrill.configure(error_rate=0.5, seed=1)
+        sent = sum(mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'], fail_silently=True)
+                   for i in range(100))
+        self.assertTrue(30 < sent < 70, "%d sent" % sent)
+
+
+@override_settings(MANDRILL_API_KEY="FAKE_API_KEY_FOR_TESTING",
+                   EMAIL_BACKEND="djrill.mail.backends.djrill.DjrillBackend")
+class FakeMandrillServerTests(TestCase):
+    """Test sending to a local fake Mandrill HTTP server"""
+
+    def test_send(self):
+        fake = FakeMandrill(api_key="FAKE_API_KEY_FOR_TESTING")
+        with FakeMandrillServer(fake) as server:
+            with self.settings(MANDRILL_API_URL=server.api_url):
+                connection = mail.get_connection()
+                messages = [mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to%d@example.com' % i])
+                            for i in range(5)]
+                self.assertEqual(connection.send_messages(messages), 5)
+            with self.settings(MANDRILL_API_URL=server.api_url, MANDRILL_API_KEY="WRONG_KEY"):
+                with self.assertRaisesMessage(MandrillAPIError, "Invalid_Key"):
+                    mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(fake.call_counts, {"messages/send.json": 6})
+        self.assertEqual(messages[4].mandrill_response[0]['email'], "to4@example.com")
+
+    def test_client_disconnects_not_reported(self):
+        with FakeMandrillServer() as server:
+            with patch('djrill.fake_mandrill.HTTPServer.handle_error') as mock_handle_error:
+                for err in [socket.error(errno.EPIPE, "Broken pipe"), ValueError("a real error")]:
+                    try:
+                        raise err
+                    except Exception:
+                        server.handle_error(None, ("127.0.0.1", 12345))
+        self.assertEqual(mock_handle_error.call_count, 1)  # only the real error
@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+import six
+from mock import patch
+
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+from djrill.bulk_send import BulkSender, BulkSendLog, batched, read_recipients
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+@override_settings(DEFAULT_FROM_EMAIL="from@example.com")
+class DjrillBulkSendTests(DjrillBackendMockAPITestCase):
+    """Streaming bulk sends, with resumable results files"""
+
+    def setUp(self):
+        super(DjrillBulkSendTests, self).setUp()
+        self.mock_post.side_effect = self.echo_recipients
+        self.failing_email = None
+        self.timeout_email = None
+        self.tempdir = tempfile.mkdtemp()
+        self.results_path = os.path.join(self.tempdir, "results.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(DjrillBulkSendTests, self).tearDown()
+
+    def echo_recipients(self, session, url, data, **kwargs):
+        recipients = json.loads(data)['message']['to']
+        emails = [to['email'] for to in recipients]
+        if self.failing_email in emails:
+            return self.MockResponse(status_code=500, raw=b'{"status": "error", "name": "GeneralError"}')
+        if self.timeout_email in emails:
+            raise requests.Timeout("timed out")
+        return self.MockResponse(raw=six.b(json.dumps([
+            {"email": email, "status": "sent", "_id": email[:2], "reject_reason": None} for email in emails])))
+
+    def write_file(self, name, content):
+        path = os.path.join(self.tempdir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def recipients(self, count):
+        return [{"email": "r%d@example.com" % i, "merge_vars": {"N": i}} for i in range(count)]
+
+    def read_results(self):
+        with open(self.results_path) as f:
+            return [json.loads(line) for line in f]
+
+    def sent_emails(self):
+        return sorted(to['email'] for args, kwargs in self.mock_post.call_args_list
+                      for to in json.loads(kwargs['data'])['message']['to'])
+
+    def test_read_recipients(self):
+        path = self.write_file("recipients.csv", "email,name,FIRST\none@example.com,One,Uno\ntwo@example.com,,\n")
+        self.assertEqual(list(read_recipients(path)), [
+            {"email": "one@example.com", "name": "One", "merge_vars": {"FIRST": "Uno"}},
+            {"email": "two@example.com", "name": None, "merge_vars": {"FIRST": ""}},
+        ])
+        path = self.write_file("recipients.jsonl",
+                               '{"email": "one@example.com", "metadata": {"id": 1}, "FIRST": "Uno"}\n\n')
+        self.assertEqual(list(read_recipients(path)), [
+            {"email": "one@example.com", "metadata": {"id": 1}, "merge_vars": {"FIRST": "Uno"}},
+        ])
+        with self.assertRaises(ValueError):
+            list(read_recipients(self.write_file("bad.csv", "address\none@example.com\n")))
+
+    @unittest.skipIf(six.PY2, "python 2's csv module reads bytes")
+    def test_read_recipients_csv_text(self):
+        path = os.path.join(self.tempdir, "recipients.csv")
+        with io.open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(u'email,name,ADDRESS\r\none@example.com,Zo\u00eb,"1 Main St.\r\nApt. 2"\r\n')
+        self.assertEqual(list(read_recipients(path)), [
+            {"email": "one@example.com", "name": u"Zo\u00eb", "merge_vars": {"ADDRESS": "1 Main St.\r\nApt. 2"}},
+        ])
+
+    def test_batched(self):
+        self.assertEqual(list(batched(range(5), 2)), [(0, [0, 1]), (1, [2, 3]), (2, [4])])
+
+    def test_send(self):
+        sender = BulkSender(self.results_path, {'subject': "Hi *|N|*", 'body': "Body", 'tags': ["bulk"]},
+                            batch_size=2, concurrency=2)
+        summary = sender.run(self.recipients(5))
+        self.assertEqual(summary, {"batches_sent": 3, "batches_failed": 0, "batches_skipped": 0,
+                                   "batches_unconfirmed": 0, "status_counts": {"sent": 5}})
+        self.assertEqual(self.mock_post.call_count, 3)
+        payloads = sorted((json.loads(kwargs['data']) for args, kwargs in self.mock_post.call_args_list),
+                          key=lambda payload: payload['message']['to'][0]['email'])
+        msg = payloads[0]['message']
+        self.assertEqual([to['email'] for to in msg['to']], ["r0@example.com", "r1@example.com"])
+        self.assertFalse(msg['preserve_recipients'])
+        self.assertEqual(msg['from_email'], "from@example.com")
+        self.assertEqual(msg['tags'], ["bulk"])
+        self.assertEqual(msg['merge_vars'], [
+            {'rcpt': "r0@example.com", 'vars': [{'name': "N", 'content': 0}]},
+            {'rcpt': "r1@example.com", 'vars': [{'name': "N", 'content': 1}]},
+        ])
+        results = self.read_results()
+        self.assertEqual(results[0], {"batch_size": 2})
+        self.assertEqual(sorted(result['email'] for result in results if 'email' in result),
+                         ["r%d@example.com" % i for i in range(5)])
+        self.assertIn({"batch": 2, "email": "r4@example.com", "status": "sent", "_id": "r4",
+                       "reject_reason": None}, results)
+
+    def test_resume(self):
+        # batch 1 fails (so is retried), and batch 2 times out (so may have been sent)
+        self.failing_email = "r2@example.com"
+        self.timeout_email = "r4@example.com"
+        summary = BulkSender(self.results_path, {'subject': "Hi"}, batch_size=2).run(self.recipients(7))
+        self.assertEqual((summary['batches_sent'], summary['batches_failed'], summary['batches_unconfirmed']),
+                         (2, 1, 1))
+        with open(self.results_path, "a") as f:
+            f.write('{"batch": 3, "email": "r6@exa')  # a crash mid-write
+        self.assertEqual(BulkSendLog(self.results_path, 2).states, {0: "done", 1: "failed", 2: "started", 3: "done"})
+
+        self.failing_email = self.timeout_email = None
+        self.mock_post.reset_mock()
+        summary = BulkSender(self.results_path, {'subject': "Hi"}, batch_size=2).run(self.recipients(7))
+        self.assertEqual((summary['batches_sent'], summary['batches_skipped'], summary['batches_unconfirmed']),
+                         (1, 2, 1))
+        self.assertEqual(self.sent_emails(), ["r2@example.com", "r3@example.com"])
+
+        self.mock_post.reset_mock()
+        summary = BulkSender(self.results_path, {'subject': "Hi"}, batch_size=2,
+                             retry_unconfirmed=True).run(self.recipients(7))
+        self.assertEqual((summary['batches_sent'], summary['batches_skipped']), (1, 3))
+        self.assertEqual(self.sent_emails(), ["r4@example.com", "r5@example.com"])
+
+        with self.assertRaisesMessage(ValueError, "batch size 2"):
+            BulkSender(self.results_path, {'subject': "Hi"}, batch_size=3).run(self.recipients(7))
+
+    def test_unexpected_error(self):
+        self.mock_post.side_effect = TypeError("a bug")
+        with patch('djrill.bulk_send.logger') as mock_logger:
+            with self.assertRaisesMessage(TypeError, "a bug"):
+                BulkSender(self.results_path, {'subject': "Hi"}, batch_size=2).run(self.recipients(7))
+        self.assertTrue(mock_logger.exception.called)
+
+    def test_process_pool(self):
+        summary = BulkSender(self.results_path, {'subject': "Hi"}, batch_size=3, processes=2).run(self.recipients(10))
+        self.assertEqual(summary['batches_sent'], 4)
+        self.assertEqual(self.sent_emails(), sorted("r%d@example.com" % i for i in range(10)))
+
+    def test_command(self):
+        recipients_path = self.write_file("recipients.csv", "email,FIRST\none@example.com,Uno\ntwo@example.com,Dos\n")
+        text_path = self.write_file("body.txt", "Hi *|FIRST|*")
+        stdout = six.StringIO()
+        call_command('djrill_bulk_send', recipients_path, results=self.results_path, subject="Hello",
+                     text_file=text_path, tags=["bulk"], batch_size=10, stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue())['status_counts'], {"sent": 2})
+        data = self.get_api_call_data()
+        self.assertEqual(data['message']['text'], "Hi *|FIRST|*")
+        self.assertEqual(data['message']['subject'], "Hello")
@@ -0,0 +1,111 @@
+import time
+
+import requests
+from django.core import mail
+from django.test.utils import override_settings
+
+from djrill import MandrillAPIError, MandrillUnavailableError, circuit_breaker
+from djrill.circuit_breaker import circuit_breaker_status
+from djrill.mail.backends.djrill import clear_settings_cache
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+GENERAL_ERROR = b'{"status": "error", "code": -1, "name": "GeneralError", "message": "Oops"}'
+VALIDATION_ERROR = b'{"status": "error", "code": -2, "name": "ValidationError", "message": "Bad"}'
+
+
+@override_settings(MANDRILL_CIRCUIT_BREAKER={"min_calls": 2, "failure_rate": 0.5, "reset_timeout": 30})
+class DjrillCircuitBreakerTests(DjrillBackendMockAPITestCase):
+    """Test Djrill backend's optional circuit breaker"""
+
+    def tearDown(self):
+        circuit_breaker._breakers.clear()
+        clear_settings_cache()  # backends hold on to the cleared object
+        super(DjrillCircuitBreakerTests, self).tearDown()
+
+    def send(self, **kwargs):
+        return mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'], **kwargs)
+
+    def fail(self, raw=GENERAL_ERROR):
+        self.mock_post.return_value = self.MockResponse(status_code=500, raw=raw)
+        with self.assertRaises(MandrillAPIError):
+            self.send()
+
+    def get_breaker(self):
+        return mail.get_connection().circuit_breaker
+
+    def test_trips_and_fails_fast(self):
+        self.fail()
+        self.fail()
+        self.assertEqual(self.get_breaker().state, "open")
+        self.mock_post.reset_mock()
+        with self.assertRaises(MandrillUnavailableError):
+            self.send()
+        self.assertFalse(self.mock_post.called)
+        self.assertEqual(self.send(fail_silently=True), 0)
+
+        status = list(circuit_breaker_status().values())[0]
+        self.assertEqual(status['state'], "open")
+        self.assertEqual(status['trips'], 1)
+
+    def test_other_api_calls(self):
+        self.fail()
+        self.fail()
+        self.mock_post.reset_mock()
+        with self.assertRaises(MandrillUnavailableError):
+            mail.get_connection().call_mandrill_api("users/ping.json", {})
+        self.assertFalse(self.mock_post.called)
+
+    def test_client_errors_dont_trip(self):
+        self.fail(raw=VALIDATION_ERROR)
+        self.fail(raw=VALIDATION_ERROR)
+        self.assertEqual(self.get_breaker().state, "closed")
+
+    def test_connection_errors_trip(self):
+        self.mock_post.side_effect = requests.ConnectionError("no route to host")
+        for i in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                self.send()
+        self.assertEqual(self.get_breaker().state, "open")
+
+    def test_half_open_probe(self):
+        self.fail()
+        self.fail()
+        breaker = self.get_breaker()
+        breaker.opened_at -= 31  # reset_timeout has passed
+        self.fail()  # failed probe reopens the breaker
+        self.assertEqual(breaker.state, "open")
+        self.assertEqual(breaker.trips, 2)
+
+        breaker.opened_at -= 31
+        self.mock_post.return_value = self.MockResponse()
+        self.assertEqual(self.send(), 1)  # successful probe closes it
+        self.assertEqual(breaker.state, "closed")
+
+    def test_only_probe_closes(self):
+        breaker = circuit_breaker.CircuitBreaker(min_calls=1, reset_timeout=30)
+        slow_call_started = time.time()
+        breaker.record(failed=True)
+        self.assertEqual(breaker.state, "open")
+        breaker.record(failed=False, started=slow_call_started)  # finished while open
+        self.assertEqual(breaker.state, "open")
+
+        breaker.opened_at -= 31
+        self.assertTrue(breaker.allow())  # the probe
+        self.assertEqual(breaker.state, "half-open")
+        breaker.record(failed=False, started=slow_call_started)  # (not the probe)
+        self.assertEqual(breaker.state, "half-open")
+        self.assertFalse(breaker.allow())
+        breaker.record(failed=False, started=time.time())
+        self.assertEqual(breaker.state, "closed")
+
+    @override_settings(MANDRILL_FALLBACK_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_fallback_backend(self):
+        self.fail()
+        self.fail()
+        self.mock_post.reset_mock()
+        self.assertEqual(self.send(), 1)
+        self.assertFalse(self.mock_post.called)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['to@example.com'])
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+
+import six
+
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+from djrill import key_pool
+from djrill.dry_run import DjrillDryRunBackend, PayloadReplayer, read_payloads
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+class DjrillDryRunTests(DjrillBackendMockAPITestCase):
+    """Writing payloads to a file with DjrillDryRunBackend, and replaying them"""
+
+    def setUp(self):
+        super(DjrillDryRunTests, self).setUp()
+        self.mock_post.side_effect = self.echo_recipients
+        self.tempdir = tempfile.mkdtemp()
+        self.payloads_path = os.path.join(self.tempdir, "payloads.jsonl")
+        self.results_path = os.path.join(self.tempdir, "results.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(DjrillDryRunTests, self).tearDown()
+
+    def echo_recipients(self, session, url, data, **kwargs):
+        recipients = json.loads(data)['message']['to']
+        return self.MockResponse(raw=six.b(json.dumps([
+            {"email": to['email'], "status": "sent", "_id": to['email'][:2], "reject_reason": None}
+            for to in recipients])))
+
+    def compile_messages(self):
+        connection = mail.get_connection('djrill.dry_run.DjrillDryRunBackend', path=self.payloads_path)
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['r%d@example.com' % i])
+                    for i in range(3)]
+        messages[1].template_name = "welcome"
+        messages[2].send_at = "2022-10-11 12:13:14"
+        self.assertEqual(connection.send_messages(messages), 3)
+        return messages
+
+    def test_dry_run(self):
+        messages = self.compile_messages()
+        self.assertEqual(self.mock_post.call_count, 0)
+        self.assertEqual(messages[0].mandrill_response[0]['status'], "queued")
+        with open(self.payloads_path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['api_method'] for line in lines],
+                         ["messages/send.json", "messages/send-template.json", "messages/send.json"])
+        self.assertEqual(lines[0]['payload']['message']['subject'], "Subject 0")
+        self.assertNotIn('key', lines[0]['payload'])
+        self.assertEqual(lines[2]['payload']['send_at'], "2022-10-11 12:13:14")
+
+    def test_stream(self):
+        stream = six.StringIO()
+        connection = DjrillDryRunBackend(stream=stream)
+        mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'], connection=connection).send()
+        self.assertEqual(json.loads(stream.getvalue())['payload']['message']['to'][0]['email'], "to@example.com")
+
+    def test_api_calls_not_written(self):
+        # only sends go to the payloads file; other API calls (e.g., loading templates) are made as usual
+        self.mock_post.side_effect = None
+        stream = six.StringIO()
+        DjrillDryRunBackend(stream=stream).call_mandrill_api("users/ping.json", {})
+        self.assertEqual(self.mock_post.call_count, 1)
+        self.assertEqual(stream.getvalue(), "")
+
+    def test_not_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            DjrillDryRunBackend()
+
+    def test_replay(self):
+        self.compile_messages()
+        summary = PayloadReplayer(self.results_path, concurrency=2).run(read_payloads(self.payloads_path))
+        self.assertEqual(summary['batches_sent'], 3)
+        self.assertEqual(summary['status_counts'], {"sent": 3})
+        calls = sorted(self.mock_post.call_args_list,
+                       key=lambda call: json.loads(call[1]['data'])['message']['to'][0]['email'])
+        self.assertEqual([call[0][1] for call in calls], [
+            "https://mandrillapp.com/api/1.0/messages/send.json",
+            "https://mandrillapp.com/api/1.0/messages/send-template.json",
+            "https://mandrillapp.com/api/1.0/messages/send.json",
+        ])
+        data = json.loads(calls[0][1]['data'])
+        self.assertEqual(data['key'], "FAKE_API_KEY_FOR_TESTING")
+        self.assertEqual(data['message']['subject'], "Subject 0")
+
+        # replaying again (e.g., after a crash) skips what's been sent
+        self.mock_post.reset_mock()
+        summary = PayloadReplayer(self.results_path).run(read_payloads(self.payloads_path))
+        self.assertEqual(summary['batches_skipped'], 3)
+        self.assertEqual(self.mock_post.call_count, 0)
+
+    @override_settings(MANDRILL_API_KEYS=[{'key': "KEY1", 'subaccount': "one"}])
+    def test_replay_key_pool(self):
+        self.compile_messages()
+        try:
+            PayloadReplayer(self.results_path).run(read_payloads(self.payloads_path))
+        finally:
+            key_pool._pools.clear()
+        data = self.get_api_call_data()
+        self.assertEqual(data['key'], "KEY1")
+        self.assertEqual(data['message']['subaccount'], "one")
+
+    def test_malformed_payloads(self):
+        for line in ['{"api_method": "messages/send.json"}', '{"payload": {}}',
+                     '{"api_method": "messages/send.json", "payload": "truncated']:
+            with open(self.payloads_path, "w") as f:
+                f.write('{"api_method": "messages/send.json", "payload": {"message": {}}}\n' + line + '\n')
+            with self.assertRaisesMessage(ValueError, "line 2 isn't a DjrillDryRunBackend payload"):
+                list(read_payloads(self.payloads_path))
+
+    def test_command(self):
+        self.compile_messages()
+        stdout = six.StringIO()
+        call_command('djrill_replay', self.payloads_path, results=self.results_path, stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue())['batches_sent'], 3)
+        self.assertEqual(self.mock_post.call_count, 3)
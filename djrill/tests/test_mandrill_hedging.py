@@ -0,0 +1,61 @@
+import threading
+import time
+
+from django.core import mail
+from django.test.utils import override_settings
+
+from djrill import hedging
+from djrill.hedging import hedge_stats
+from djrill.mail.backends.djrill import clear_settings_cache
+from djrill.metrics import metrics
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+@override_settings(MANDRILL_HEDGE_READS={"initial_delay": 0.05})
+class DjrillHedgingTests(DjrillBackendMockAPITestCase):
+    """Test Djrill backend's optional hedging of read-only API calls"""
+
+    def setUp(self):
+        super(DjrillHedgingTests, self).setUp()
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    def tearDown(self):
+        hedging._hedgers.clear()
+        metrics.reset()
+        clear_settings_cache()  # backends hold on to the cleared object
+        super(DjrillHedgingTests, self).tearDown()
+
+    def slow_first_call(self, *args, **kwargs):
+        with self.calls_lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            time.sleep(0.5)
+            return self.MockResponse(raw=b'"slow"')
+        return self.MockResponse(raw=b'"fast"')
+
+    def test_slow_read_is_hedged(self):
+        self.mock_post.side_effect = self.slow_first_call
+        connection = mail.get_connection()
+        self.assertEqual(connection.call_mandrill_api("users/ping.json", {}), "fast")
+        self.assertEqual(self.mock_post.call_count, 2)
+        stats = list(hedge_stats().values())[0]
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['win_rate'], 1.0)
+        self.assertEqual(metrics.snapshot()["counters"][("djrill_hedged_calls_total", (("outcome", "hedge_won"),))], 1)
+
+    def test_fast_read_not_hedged(self):
+        connection = mail.get_connection()
+        connection.call_mandrill_api("users/ping.json", {})
+        self.assertEqual(self.mock_post.call_count, 1)
+        self.assertEqual(list(hedge_stats().values())[0]['hedge_rate'], 0.0)
+
+    def test_sends_not_hedged(self):
+        def slow_send(*args, **kwargs):
+            time.sleep(0.2)
+            return self.MockResponse()
+        self.mock_post.side_effect = slow_send
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_post.call_count, 1)
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+
+from djrill import MandrillAPIError, key_pool
+from djrill.key_pool import key_pool_stats
+from djrill.mail.backends.djrill import clear_settings_cache
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+def route_by_tenant(message):
+    return getattr(message, 'tenant', None)
+
+
+@override_settings(MANDRILL_API_KEYS=[
+    {"key": "KEY_A", "subaccount": "tenant-a", "weight": 2},
+    {"key": "KEY_B", "subaccount": "tenant-b"},
+])
+class DjrillKeyPoolTests(DjrillBackendMockAPITestCase):
+    """Test Djrill backend's MANDRILL_API_KEYS pool"""
+
+    def tearDown(self):
+        key_pool._pools.clear()
+        clear_settings_cache()  # backends hold on to the cleared object
+        super(DjrillKeyPoolTests, self).tearDown()
+
+    def send(self, count=1, **attrs):
+        """Send count messages (with attrs), and return the (key, subaccount) used for each"""
+        used = []
+        for i in range(count):
+            msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            for attr, value in attrs.items():
+                setattr(msg, attr, value)
+            msg.send()
+            data = self.get_api_call_data()
+            used.append((data['key'], data['message'].get('subaccount')))
+        return used
+
+    def test_spread_by_weight(self):
+        used = self.send(6)
+        self.assertEqual([key for key, subaccount in used], ['KEY_A', 'KEY_B', 'KEY_A'] * 2)
+        self.assertIn(('KEY_B', 'tenant-b'), used)
+        stats = key_pool_stats()
+        self.assertEqual(stats['tenant-a']['messages'], 4)
+        self.assertEqual(stats['tenant-b']['recipients'], 2)
+        self.assertNotIn('KEY_A', str(stats))  # doesn't expose the keys
+
+    def test_explicit_subaccount(self):
+        self.assertEqual(self.send(subaccount='other'), [('KEY_A', 'other')])
+
+    @override_settings(MANDRILL_KEY_FUNCTION='djrill.tests.test_mandrill_key_pool.route_by_tenant')
+    def test_key_function(self):
+        # routes that name a pool entry use it
+        self.assertEqual(self.send(3, tenant='tenant-b'), [('KEY_B', 'tenant-b')] * 3)
+        # other routes are consistently hashed to an entry
+        used = self.send(3, tenant='some-other-tenant')
+        self.assertEqual(len(set(used)), 1)
+        # no route: weighted round robin
+        self.assertEqual(len(set(self.send(3))), 2)
+
+    @override_settings(MANDRILL_API_KEYS=[
+        {"key": "KEY_A", "weight": 10, "rate_limit": 1, "name": "a"},
+        {"key": "KEY_B", "name": "b"},
+    ])
+    def test_rate_limit(self):
+        # KEY_A's weight would get it both sends, but the second would exceed its rate limit
+        self.assertEqual(self.send(2), [('KEY_A', None), ('KEY_B', None)])
+        self.assertEqual(key_pool_stats()['a']['throttled'], 1)
+
+    def test_errors_counted(self):
+        self.mock_post.return_value = self.MockResponse(status_code=500)
+        with self.assertRaises(MandrillAPIError):
+            self.send()
+        self.assertEqual(key_pool_stats()['tenant-a']['errors'], 1)
+
+    def test_api_key_not_required(self):
+        with self.settings():
+            del settings.MANDRILL_API_KEY
+            clear_settings_cache()  # (deleting a setting doesn't send setting_changed)
+            self.assertEqual(mail.get_connection().api_key, "KEY_A")  # for non-send API calls
+
+    @override_settings(MANDRILL_API_KEYS=[{"api_key": "KEY_A"}])
+    def test_improperly_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            mail.get_connection()
+
+    @override_settings(MANDRILL_API_KEYS=[{"key": "KEY_A", "subaccount": "shared"},
+                                          {"key": "KEY_B", "subaccount": "shared"}])
+    def test_duplicate_names(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "more than one entry named 'shared'"):
+            mail.get_connection()
+
+    @override_settings(MANDRILL_KEY_FUNCTION='djrill.tests.no_such_function')
+    def test_key_function_import_error(self):
+        with self.assertRaises(ImproperlyConfigured):
+            mail.get_connection()
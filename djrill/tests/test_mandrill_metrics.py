@@ -0,0 +1,170 @@
+import gc
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from mock import patch
+
+from django.core import mail
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+
+from djrill.metrics import MetricsRegistry, metrics
+from djrill.views import DjrillMetricsView
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+class MetricsRegistryTests(TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.registry.describe("test_calls_total", "counter", "Test calls")
+        self.registry.describe("test_seconds", "histogram", "Test latency", buckets=(0.1, 1))
+
+    def test_counters(self):
+        self.registry.inc("test_calls_total", status="sent")
+        self.registry.inc("test_calls_total", 2, status="sent")
+        self.registry.inc("test_calls_total", status='say "hi"')
+        self.assertEqual(self.registry.snapshot()["counters"], {
+            ("test_calls_total", (("status", "sent"),)): 3,
+            ("test_calls_total", (("status", 'say "hi"'),)): 1,
+        })
+        self.assertEqual(self.registry.render_prometheus(), "\n".join([
+            '# HELP test_calls_total Test calls',
+            '# TYPE test_calls_total counter',
+            'test_calls_total{status="say \\"hi\\""} 1',
+            'test_calls_total{status="sent"} 3',
+        ]) + "\n")
+
+    def test_histograms(self):
+        for value in [0.05, 0.1, 0.5, 3]:
+            self.registry.observe("test_seconds", value)
+        self.assertEqual(self.registry.render_prometheus(), "\n".join([
+            '# HELP test_seconds Test latency',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 3.65',
+            'test_seconds_count 4',
+        ]) + "\n")
+
+    def test_threads(self):
+        def count():
+            for i in range(1000):
+                self.registry.inc("test_calls_total")
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.registry.snapshot()["counters"], {("test_calls_total", ()): 4000})
+        self.registry.reset()
+        self.assertEqual(self.registry.snapshot()["counters"], {})
+
+    def test_ended_threads(self):
+        def count():
+            self.registry.inc("test_calls_total")
+            self.registry.observe("test_seconds", 0.5)
+        for i in range(20):
+            thread = threading.Thread(target=count)
+            thread.start()
+            thread.join()
+        gc.collect()
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot["counters"], {("test_calls_total", ()): 20})
+        self.assertEqual(snapshot["histograms"], {("test_seconds", ()): [0, 20, 0, 10.0]})
+        self.assertLessEqual(len(self.registry._shards), 1)  # ended threads' shards were folded together
+
+    def test_metrics_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, "djrill-metrics-1.json"), "w") as f:
+            # another process's metrics
+            json.dump({"counters": [["test_calls_total", [["status", "sent"]], 5]],
+                       "histograms": [["test_seconds", [], [1, 0, 0, 0.05]]]}, f)
+        self.registry.inc("test_calls_total", status="sent")
+        self.registry.observe("test_seconds", 0.5)
+        with self.settings(MANDRILL_METRICS_DIR=directory):
+            collected = self.registry.collect()
+        self.assertEqual(collected["counters"], {("test_calls_total", (("status", "sent"),)): 6})
+        self.assertEqual(collected["histograms"], {("test_seconds", ()): [1, 1, 0, 0.55]})
+        self.assertIn("djrill-metrics-%d.json" % os.getpid(), os.listdir(directory))
+
+    def test_stale_files_removed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "djrill-metrics-1.json")
+        with open(path, "w") as f:
+            json.dump({"counters": [["test_calls_total", [], 5]], "histograms": []}, f)
+        last_saved = time.time() - self.registry.stale_after - 1
+        os.utime(path, (last_saved, last_saved))
+        with self.settings(MANDRILL_METRICS_DIR=directory):
+            self.assertEqual(self.registry.collect()["counters"], {})
+        self.assertEqual(os.listdir(directory), ["djrill-metrics-%d.json" % os.getpid()])
+
+    def test_background_flush(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.registry.flush_interval = 0.01
+        with self.settings(MANDRILL_METRICS_DIR=directory):
+            self.registry.inc("test_calls_total")
+            self.addCleanup(setattr, self.registry, "_flusher", None)  # (stops the thread)
+            for i in range(200):
+                if os.listdir(directory):
+                    break
+                time.sleep(0.01)
+        self.assertEqual(os.listdir(directory), ["djrill-metrics-%d.json" % os.getpid()])
+
+    def test_flush_errors_logged(self):
+        with self.settings(MANDRILL_METRICS_DIR=os.path.join(tempfile.gettempdir(), "djrill-no-such-dir")):
+            with patch('djrill.metrics.logger') as mock_logger:
+                self.registry.flush()  # doesn't raise
+        self.assertEqual(mock_logger.warning.call_count, 1)
+
+
+class DjrillSendMetricsTests(DjrillBackendMockAPITestCase):
+
+    def setUp(self):
+        super(DjrillSendMetricsTests, self).setUp()
+        metrics.reset()
+
+    def test_send_metrics(self):
+        mail.send_mail('Subject', 'Message', 'from@example.com', ['to@example.com'])
+        self.mock_post.return_value = self.MockResponse(status_code=500, raw=b'{"name": "GeneralError"}')
+        mail.send_mail('Subject', 'Message', 'from@example.com', ['to@example.com'], fail_silently=True)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters[("djrill_messages_total", (("result", "sent"),))], 1)
+        self.assertEqual(counters[("djrill_messages_total", (("result", "failed"),))], 1)
+        self.assertEqual(counters[("djrill_recipients_total", (("status", "sent"),))], 1)
+        self.assertEqual(counters[("djrill_api_errors_total", (("api_method", "messages/send.json"),
+                                                               ("status_code", "500")))], 1)
+        histogram = metrics.snapshot()["histograms"][("djrill_api_requests_seconds",
+                                                       (("api_method", "messages/send.json"),))]
+        self.assertEqual(sum(histogram[:-1]), 2)
+
+
+@override_settings(DJRILL_WEBHOOK_SECRET='abc123')
+class DjrillWebhookMetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_webhook_metrics(self):
+        self.client.post('/webhook/?secret=abc123', {
+            'mandrill_events': json.dumps([{"event": "send", "msg": {}}, {"event": "open", "msg": {}},
+                                           {"event": "open", "msg": {}}, {"something": "else"}])
+        })
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters[("djrill_webhook_events_total", (("event_type", "open"),))], 2)
+        self.assertEqual(counters[("djrill_webhook_events_total", (("event_type", "unknown"),))], 1)
+
+    def test_metrics_view(self):
+        metrics.inc("djrill_webhook_events_total", event_type="send")
+        response = DjrillMetricsView.as_view()(RequestFactory().get('/metrics/'))
+        self.assertEqual(response['Content-Type'], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertIn(b'djrill_webhook_events_total{event_type="send"} 1\n', response.content)
@@ -0,0 +1,77 @@
+from django.core import mail
+from django.test.utils import override_settings
+
+from djrill import MessagePrototype, RecipientData
+from djrill.mail.backends.djrill import DjrillBackend
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+class DjrillMessagePrototypeTests(DjrillBackendMockAPITestCase):
+    """Sending variants of a message compiled once"""
+
+    def setUp(self):
+        super(DjrillMessagePrototypeTests, self).setUp()
+        self.message = mail.EmailMultiAlternatives('Subject', 'Text', 'From Name <from@example.com>',
+                                                   headers={'X-Campaign': "spring"})
+        self.message.attach_alternative("<p>HTML</p>", "text/html")
+        self.message.attach("data.txt", "content", "text/plain")
+        self.message.tags = ["newsletter"]
+        self.message.metadata = {'campaign': "spring"}
+        self.message.send_at = "2022-10-11 12:13:14"
+
+    def test_variant_matches_full_build(self):
+        prototype = MessagePrototype(self.message)
+        variant = prototype.variant(to=["Recipient <to@example.com>"], bcc=["bcc@example.com"],
+                                    merge_vars={'to@example.com': {'NAME': "To"}},
+                                    recipient_metadata={'to@example.com': {'id': 1}},
+                                    metadata={'segment': "a"})
+        variant.send()
+        variant_data = self.get_api_call_data()
+
+        self.message.to = ["Recipient <to@example.com>"]
+        self.message.bcc = ["bcc@example.com"]
+        self.message.merge_vars = {'to@example.com': {'NAME': "To"}}
+        self.message.recipient_metadata = {'to@example.com': {'id': 1}}
+        self.message.metadata = {'campaign': "spring", 'segment': "a"}
+        self.message.send()
+        self.assertEqual(variant_data, self.get_api_call_data())
+        self.assertEqual(variant.mandrill_response[0]['status'], "sent")
+
+    def test_shared_structures(self):
+        prototype = MessagePrototype(self.message)
+        backend = DjrillBackend()
+        payloads = []
+        for email in ("one@example.com", "two@example.com"):
+            payload = backend.get_base_payload()
+            backend.build_send_payload(payload, prototype.variant(to=[email]))
+            payloads.append(payload)
+        self.assertEqual([payload['message']['to'][0]['email'] for payload in payloads],
+                         ["one@example.com", "two@example.com"])
+        self.assertIs(payloads[0]['message']['attachments'], payloads[1]['message']['attachments'])
+        self.assertIs(payloads[0]['message']['headers'], prototype.message_dict['headers'])
+        self.assertEqual(prototype.message_dict["to"], [])  # (the prototype is unchanged)
+        self.assertEqual(payloads[0]['send_at'], "2022-10-11 12:13:14")
+        self.assertEqual(payloads[0]['message']['metadata'], {'campaign': "spring"})
+
+    def test_recipient_data(self):
+        prototype = MessagePrototype(self.message)
+        prototype.variant(to=["a@example.com", "b@example.com"],
+                          merge_vars=RecipientData({'rcpt': ["a@example.com", "b@example.com"],
+                                                    'NAME': ["A", "B"]})).send()
+        data = self.get_api_call_data()
+        self.assertEqual(data['message']['merge_vars'], [
+            {'rcpt': "a@example.com", 'vars': [{'name': "NAME", 'content': "A"}]},
+            {'rcpt': "b@example.com", 'vars': [{'name': "NAME", 'content': "B"}]},
+        ])
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    def test_other_backends(self):
+        prototype = MessagePrototype(self.message, connection=DjrillBackend())
+        prototype.variant(to=["to@example.com"]).send()
+        self.assertEqual(len(mail.outbox), 1)
+        sent = mail.outbox[0]
+        self.assertEqual(sent.to, ["to@example.com"])
+        self.assertEqual(sent.alternatives, [("<p>HTML</p>", "text/html")])
+        self.assertEqual(sent.attachments, [("data.txt", "content", "text/plain")])
+        self.assertIn("X-Campaign: spring", sent.message().as_string())
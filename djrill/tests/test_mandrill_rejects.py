@@ -0,0 +1,139 @@
+import json
+import requests
+import six
+
+from django.core import mail
+from django.test.utils import override_settings
+
+from djrill import MandrillRecipientsRefused
+from djrill.rejects import reject_list
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+@override_settings(MANDRILL_REJECT_FILTER=True, MANDRILL_REJECT_LIST_MAX_AGE=None)
+class DjrillRejectFilterTests(DjrillBackendMockAPITestCase):
+    """Test Djrill backend's optional local reject list"""
+
+    def setUp(self):
+        super(DjrillRejectFilterTests, self).setUp()
+        reject_list.clear()
+
+    def tearDown(self):
+        reject_list.clear()
+        super(DjrillRejectFilterTests, self).tearDown()
+
+    def test_rejected_recipients_removed(self):
+        reject_list.add('Bounced@example.com')
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com',
+                                ['to@example.com', 'bounced@example.com'])
+        msg.merge_vars = {'to@example.com': {'NAME': "To"}, 'bounced@example.com': {'NAME': "Bounced"}}
+        msg.recipient_metadata = {'to@example.com': {'id': 1}, 'bounced@example.com': {'id': 2}}
+        sent = msg.send()
+        self.assertEqual(sent, 1)
+        data = self.get_api_call_data()
+        self.assertEqual([to['email'] for to in data['message']['to']], ['to@example.com'])
+        self.assertEqual([mv['rcpt'] for mv in data['message']['merge_vars']], ['to@example.com'])
+        self.assertEqual([md['rcpt'] for md in data['message']['recipient_metadata']], ['to@example.com'])
+        # locally-rejected recipients are still reported in the mandrill_response:
+        self.assertEqual(msg.mandrill_response[-1]['email'], 'bounced@example.com')
+        self.assertEqual(msg.mandrill_response[-1]['status'], 'rejected')
+
+    def test_all_rejected_skips_api_call(self):
+        reject_list.add('bounced@example.com')
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['bounced@example.com'])
+        with self.assertRaises(MandrillRecipientsRefused):
+            msg.send()
+        self.assertFalse(self.mock_post.called)
+
+        sent = mail.send_mail('Subject', 'Body', 'from@example.com', ['bounced@example.com'],
+                              fail_silently=True)
+        self.assertEqual(sent, 0)
+        self.assertFalse(self.mock_post.called)
+
+    @override_settings(MANDRILL_REJECT_FILTER=False)
+    def test_filter_disabled(self):
+        reject_list.add('bounced@example.com')
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['bounced@example.com', 'to@example.com'])
+        data = self.get_api_call_data()
+        self.assertEqual(len(data['message']['to']), 2)
+
+    @override_settings(MANDRILL_REJECT_LIST_MAX_AGE=3600)
+    def test_refresh_from_mandrill(self):
+        rejects_response = [
+            {"email": "bounced@example.com", "reason": "hard-bounce", "expired": False},
+            {"email": "expired@example.com", "reason": "soft-bounce", "expired": True},
+        ]
+        self.mock_post.side_effect = [
+            self.MockResponse(raw=six.b(json.dumps(rejects_response))),
+            self.MockResponse(),
+        ]
+        reject_list.add('expired@example.com')
+        reject_list.add('from-webhook@example.com')  # (e.g., beyond rejects/list's 1000 entries)
+        mail.send_mail('Subject', 'Body', 'from@example.com',
+                       ['to@example.com', 'bounced@example.com', 'expired@example.com', 'from-webhook@example.com'])
+        self.assertEqual(self.mock_post.call_count, 2)
+        self.assertTrue(self.mock_post.call_args_list[0][0][1].endswith("/rejects/list.json"))
+        self.assertTrue(json.loads(self.mock_post.call_args_list[0][1]['data'])['include_expired'])
+        data = self.get_api_call_data()
+        self.assertEqual([to['email'] for to in data['message']['to']],
+                         ['to@example.com', 'expired@example.com'])
+        self.assertIn('bounced@example.com', reject_list)
+        self.assertIn('from-webhook@example.com', reject_list)  # merged, not replaced
+        self.assertNotIn('expired@example.com', reject_list)
+
+        # the refreshed list is reused until it's stale:
+        self.mock_post.side_effect = None
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_post.call_count, 3)
+
+    def test_sender_specific_rejects(self):
+        reject_list.add('unsubscribed@example.com', sender='News@example.com')
+        self.assertNotIn('unsubscribed@example.com', reject_list)
+        mail.send_mail('Subject', 'Body', 'orders@example.com', ['to@example.com', 'unsubscribed@example.com'])
+        self.assertEqual(len(self.get_api_call_data()['message']['to']), 2)
+        mail.send_mail('Subject', 'Body', 'news@example.com', ['to@example.com', 'unsubscribed@example.com'])
+        self.assertEqual([to['email'] for to in self.get_api_call_data()['message']['to']], ['to@example.com'])
+
+        reject_list.add('unsubscribed@example.com')
+        reject_list.discard('unsubscribed@example.com', sender='news@example.com')
+        self.assertIn('unsubscribed@example.com', reject_list)  # the all-senders entry is kept
+        reject_list.discard('unsubscribed@example.com')
+        self.assertEqual(len(reject_list), 0)
+
+    @override_settings(MANDRILL_REJECT_LIST_MAX_AGE=3600)
+    def test_refresh_errors(self):
+        def post(session, url, data, **kwargs):
+            if url.endswith("/rejects/list.json"):
+                raise requests.ConnectionError("no route to host")
+            return self.MockResponse()
+        self.mock_post.side_effect = post
+        self.assertEqual(mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com']), 1)
+        self.assertEqual(self.mock_post.call_count, 2)
+
+        # a failed refresh isn't retried on every send:
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_post.call_count, 3)
+        reject_list.refresh_failed_at -= 61
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_post.call_count, 5)
+
+    @override_settings(DJRILL_WEBHOOK_SECRET='abc123')
+    def test_webhook_events_update_list(self):
+        events = [
+            {"event": "hard_bounce", "msg": {"email": "bounced@example.com"}},
+            {"event": "soft_bounce", "msg": {"email": "soft@example.com"}},
+            {"type": "blacklist", "action": "add", "reject": {"email": "added@example.com"}},
+            {"type": "blacklist", "action": "remove", "reject": {"email": "was-rejected@example.com"}},
+            {"type": "blacklist", "action": "add",
+             "reject": {"email": "news-only@example.com", "sender": "news@example.com"}},
+        ]
+        reject_list.add('was-rejected@example.com')
+        response = self.client.post('/webhook/?secret=abc123', {'mandrill_events': json.dumps(events)})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('bounced@example.com', reject_list)
+        self.assertIn('added@example.com', reject_list)
+        self.assertNotIn('soft@example.com', reject_list)
+        self.assertNotIn('was-rejected@example.com', reject_list)
+        self.assertNotIn('news-only@example.com', reject_list)
+        self.assertTrue(reject_list.is_rejected('news-only@example.com', 'news@example.com'))
@@ -0,0 +1,94 @@
+import json
+
+import six
+from django.core import mail
+
+from djrill import MandrillRecipientsRefused
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+class DjrillResendFailedTests(DjrillBackendMockAPITestCase):
+    """Reporting recipients that failed, and resending to just them"""
+
+    response = [
+        {"email": "sent@example.com", "status": "sent", "_id": "id1", "reject_reason": None},
+        {"email": "Rule@Example.com", "status": "rejected", "_id": "id2", "reject_reason": "rule"},
+        {"email": "bounced@example.com", "status": "rejected", "_id": "id3", "reject_reason": "hard-bounce"},
+        {"email": "invalid@localhost", "status": "invalid", "_id": "id4", "reject_reason": None},
+        {"email": "bcc@example.com", "status": "rejected", "_id": "id5", "reject_reason": "soft-bounce"},
+    ]
+
+    def setUp(self):
+        super(DjrillResendFailedTests, self).setUp()
+        self.mock_post.return_value = self.MockResponse(raw=six.b(json.dumps(self.response)))
+        self.message = mail.EmailMessage('Subject', 'Body', 'from@example.com',
+                                         [item['email'] for item in self.response[:4]], bcc=["bcc@example.com"])
+        self.message.merge_vars = dict((item['email'], {'ID': item['_id']}) for item in self.response)
+        self.message.recipient_metadata = dict((item['email'], {'id': item['_id']}) for item in self.response)
+        self.message.send()  # (some recipients were accepted, so this doesn't raise)
+
+    def respond(self, statuses):
+        self.mock_post.reset_mock()
+        self.mock_post.return_value = self.MockResponse(raw=six.b(json.dumps([
+            {"email": email, "status": status, "_id": "new-" + email[:3], "reject_reason": None}
+            for email, status in statuses])))
+
+    def test_failures(self):
+        self.assertEqual(self.message.mandrill_response.failures(), [
+            {"email": "Rule@Example.com", "status": "rejected", "reject_reason": "rule", "_id": "id2"},
+            {"email": "bounced@example.com", "status": "rejected", "reject_reason": "hard-bounce", "_id": "id3"},
+            {"email": "invalid@localhost", "status": "invalid", "reject_reason": None, "_id": "id4"},
+            {"email": "bcc@example.com", "status": "rejected", "reject_reason": "soft-bounce", "_id": "id5"},
+        ])
+        self.assertEqual([failure['email'] for failure in self.message.mandrill_response.failures(["sent"])],
+                         ["sent@example.com"])
+
+    def test_resend_failed(self):
+        self.respond([("Rule@Example.com", "sent"), ("bcc@example.com", "queued")])
+        resent = mail.get_connection().resend_failed(self.message)
+        self.assertEqual(resent.status_counts, {"sent": 1, "queued": 1})
+
+        data = self.get_api_call_data()
+        self.assertEqual(data['message']['to'], [
+            {'email': "Rule@Example.com", 'name': "", 'type': "to"},
+            {'email': "bcc@example.com", 'name': "", 'type': "bcc"},
+        ])
+        self.assertEqual(data['message']['merge_vars'], [
+            {'rcpt': "Rule@Example.com", 'vars': [{'name': "ID", 'content': "id2"}]},
+            {'rcpt': "bcc@example.com", 'vars': [{'name': "ID", 'content': "id5"}]},
+        ])
+        self.assertEqual(data['message']['recipient_metadata'], [
+            {'rcpt': "Rule@Example.com", 'values': {'id': "id2"}},
+            {'rcpt': "bcc@example.com", 'values': {'id': "id5"}},
+        ])
+        self.assertEqual(data['message']['subject'], "Subject")
+
+        result = self.message.mandrill_response
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result.status_for("rule@example.com"), "sent")
+        self.assertEqual(result.id_for("rule@example.com"), "new-Rul")
+        self.assertEqual(result.status_for("bounced@example.com"), "rejected")
+        self.assertEqual(result.status_counts, {"sent": 2, "queued": 1, "rejected": 1, "invalid": 1})
+
+    def test_resend_options(self):
+        self.respond([("bounced@example.com", "sent"), ("invalid@localhost", "invalid")])
+        mail.get_connection().resend_failed(self.message, statuses=("invalid", "rejected"),
+                                            reject_reasons=["hard-bounce"])
+        self.assertEqual([to['email'] for to in self.get_api_call_data()['message']['to']],
+                         ["bounced@example.com", "invalid@localhost"])
+
+    def test_nothing_to_resend(self):
+        self.respond([])
+        connection = mail.get_connection()
+        self.assertIsNone(connection.resend_failed(self.message, reject_reasons=["spam"]))
+        self.assertIsNone(connection.resend_failed(mail.EmailMessage('Unsent', 'Body', to=["to@example.com"])))
+        self.assertEqual(self.mock_post.call_count, 0)
+
+    def test_resend_refused(self):
+        self.respond([("Rule@Example.com", "rejected"), ("bcc@example.com", "rejected")])
+        with self.assertRaises(MandrillRecipientsRefused):
+            mail.get_connection().resend_failed(self.message)
+        self.assertEqual(self.message.mandrill_response.status_counts, {"sent": 1, "rejected": 3, "invalid": 1})
+        self.assertIsNone(mail.get_connection(fail_silently=True).resend_failed(self.message, reject_reasons=None))
+        self.assertEqual(self.mock_post.call_count, 2)
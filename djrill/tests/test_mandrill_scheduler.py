@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import requests
+import six
+from django.core import mail
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+from djrill import MandrillAPIError, MandrillRecipientsRefused, scheduler
+from djrill.scheduler import get_scheduler
+from djrill.mail.backends.djrill import clear_settings_cache
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+class DjrillSchedulerTests(DjrillBackendMockAPITestCase):
+    """Test Djrill backend's optional local scheduler for send_at messages"""
+
+    def setUp(self):
+        super(DjrillSchedulerTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, "scheduled.sqlite3")
+        self.settings_override = override_settings(MANDRILL_SCHEDULER_DB=self.db_path)
+        self.settings_override.enable()
+        self.scheduler = get_scheduler(self.db_path)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        scheduler._schedulers.clear()
+        clear_settings_cache()  # backends hold on to the cleared object
+        shutil.rmtree(self.tempdir)
+        super(DjrillSchedulerTests, self).tearDown()
+
+    def make_message(self, send_at, to=('to@example.com',)):
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', list(to))
+        msg.send_at = send_at
+        return msg
+
+    def test_future_send_is_scheduled(self):
+        msg = self.make_message(datetime.utcnow() + timedelta(hours=1), to=['one@example.com', 'two@example.com'])
+        sent = msg.send()
+        self.assertEqual(sent, 1)
+        self.assertFalse(self.mock_post.called)
+        self.assertEqual(msg.mandrill_response.status_counts, {'scheduled': 2})
+        self.assertEqual(self.scheduler.count(), 1)
+        self.assertAlmostEqual(self.scheduler.next_due_at(), time.time() + 3600, delta=5)
+
+        # stored without the API key:
+        stored = self.scheduler.claim_due(now=time.time() + 7200)[0]
+        self.assertNotIn("FAKE_API_KEY_FOR_TESTING", stored.payload)
+        self.assertEqual(json.loads(stored.payload)['message']['to'][1]['email'], 'two@example.com')
+
+    def test_past_send_at_sent_now(self):
+        self.make_message(datetime.utcnow() - timedelta(hours=1)).send()
+        self.assertTrue(self.mock_post.called)
+        self.assertIn('send_at', self.get_api_call_data())  # still passed to Mandrill
+        self.assertEqual(self.scheduler.count(), 0)
+
+    def test_send_scheduled(self):
+        for i in range(3):
+            self.make_message(datetime.utcnow() + timedelta(minutes=i + 1), to=['to%d@example.com' % i]).send()
+        connection = mail.get_connection()
+        self.assertEqual(connection.send_scheduled(), 0)  # nothing due yet
+        self.assertEqual(connection.send_scheduled(batch_size=2, now=time.time() + 3600), 2)
+        self.assertEqual(self.mock_post.call_count, 2)
+        data = self.get_api_call_data()
+        self.assertEqual(data['key'], "FAKE_API_KEY_FOR_TESTING")
+        self.assertNotIn('send_at', data)  # released messages are sent immediately
+        self.assertEqual(data['message']['to'][0]['email'], 'to1@example.com')  # in due order
+        self.assertEqual(self.scheduler.count(), 1)
+
+    def test_cancel(self):
+        msg = self.make_message(datetime.utcnow() + timedelta(hours=1))
+        msg.send()
+        self.assertTrue(self.scheduler.cancel(msg.mandrill_scheduled_id))
+        self.assertEqual(mail.get_connection().send_scheduled(now=time.time() + 7200), 0)
+        self.assertFalse(self.mock_post.called)
+
+    def test_failed_sends_retried(self):
+        self.make_message(datetime.utcnow() + timedelta(hours=1)).send()
+        self.mock_post.return_value = self.MockResponse(status_code=500)
+        connection = mail.get_connection()
+        later = time.time() + 7200
+        self.assertEqual(connection.send_scheduled(now=later, max_attempts=2), 0)
+        self.assertEqual(self.scheduler.count(), 1)  # will be retried
+        with self.assertRaises(MandrillAPIError):
+            connection.send_scheduled(now=later + 3600, max_attempts=2)
+        self.assertEqual(self.scheduler.count(), 0)  # gave up
+
+    def test_connection_errors_retried(self):
+        self.make_message(datetime.utcnow() + timedelta(hours=1)).send()
+        self.mock_post.side_effect = requests.ConnectionError("Connection refused")
+        connection = mail.get_connection()
+        self.assertEqual(connection.send_scheduled(now=time.time() + 7200), 0)
+        self.assertEqual(self.scheduler.count(), 1)  # will be retried
+
+    def test_refused_sends_not_retried(self):
+        self.make_message(datetime.utcnow() + timedelta(hours=1)).send()
+        self.mock_post.return_value = self.MockResponse(raw=six.b(json.dumps(
+            [{"email": "to@example.com", "status": "rejected", "_id": "abc", "reject_reason": "hard-bounce"}])))
+        with self.assertRaises(MandrillRecipientsRefused):
+            mail.get_connection().send_scheduled(now=time.time() + 7200)
+        self.assertEqual(self.scheduler.count(), 0)
+
+    def test_management_command(self):
+        self.make_message(datetime.utcnow() - timedelta(seconds=1)).send()  # sent directly
+        self.scheduler.schedule(time.time() - 1, json.dumps({"message": {"to": [{"email": "to@example.com"}]}}))
+        stdout = six.StringIO()
+        call_command('djrill_send_scheduled', stdout=stdout)
+        self.assertIn("Sent 1 scheduled messages", stdout.getvalue())
+        self.assertEqual(self.mock_post.call_count, 2)
+        self.assertEqual(self.scheduler.count(), 0)
+
+    def test_management_command_continues_after_failures(self):
+        for i in range(3):
+            self.scheduler.schedule(time.time() - 10 + i, json.dumps(
+                {"message": {"to": [{"email": "to%d@example.com" % i}]}}))
+        responses = [self.MockResponse(status_code=500), self.MockResponse(), self.MockResponse()]
+        self.mock_post.side_effect = lambda *args, **kwargs: responses.pop(0)
+        stdout = six.StringIO()
+        call_command('djrill_send_scheduled', batch_size=2, stdout=stdout)
+        self.assertIn("Sent 2 scheduled messages", stdout.getvalue())  # kept going after the partial batch
+        self.assertEqual(self.mock_post.call_count, 3)
+        self.assertEqual(self.scheduler.count(), 1)  # the failed send, waiting to be retried
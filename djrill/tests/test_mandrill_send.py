@@ -4,23 +4,33 @@ from __future__ import unicode_literals
 
 import json
 import os
+import pickle
 import re
+import requests
 import six
+import subprocess
+import sys
 import unittest
 from base64 import b64decode
+from collections import OrderedDict
 from datetime import date, datetime, timedelta, tzinfo
 from decimal import Decimal
+from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 
+from mock import patch
+
 from django.core import mail
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import make_msgid
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from djrill import (MandrillAPIError, MandrillRecipientsRefused,
-                    NotSerializableForMandrillError, NotSupportedByMandrillError)
+from djrill import (MandrillAPIError, MandrillRecipientsRefused, MandrillSendResult,
+                    NotSerializableForMandrillError, NotSupportedByMandrillError, RecipientData)
+
+from djrill.mail.backends.djrill import DjrillBackend
 
 from .mock_backend import DjrillBackendMockAPITestCase
 
@@ -87,6 +97,25 @@ class DjrillBackendTests(DjrillBackendMockAPITestCase):
         self.assertEqual(data['message']['to'][5]['name'], "")
         self.assertEqual(data['message']['to'][5]['email'], "bcc2@example.com")
 
+    def test_address_parsing_cached(self):
+        """Repeated addresses are only sanitized and parsed once"""
+        from djrill.mail.backends import djrill as djrill_backend
+        djrill_backend._address_cache.clear()  # (other tests may have sent to the same addresses)
+        with patch('djrill.mail.backends.djrill.sanitize_address',
+                   wraps=djrill_backend.sanitize_address) as mock_sanitize:
+            for i in range(2):
+                mail.send_mail('Subject', 'Message', 'From Name <from@example.com>',
+                               ['Recipient <to1@example.com>', 'to2@example.com'])
+                data = self.get_api_call_data()
+                self.assertEqual(data['message']['from_name'], "From Name")
+                self.assertEqual(data['message']['from_email'], "from@example.com")
+                self.assertEqual(data['message']['to'][0]['name'], "Recipient")
+                self.assertEqual(data['message']['to'][0]['email'], "to1@example.com")
+                self.assertEqual(data['message']['to'][1]['name'], "")
+                self.assertEqual(data['message']['to'][1]['email'], "to2@example.com")
+        # plain "to2@example.com" never needs sanitizing; the others are cached after the first send:
+        self.assertEqual(mock_sanitize.call_count, 2)
+
     def test_email_message(self):
         email = mail.EmailMessage('Subject', 'Body goes here',
             'from@example.com',
@@ -269,6 +298,25 @@ class DjrillBackendTests(DjrillBackendMockAPITestCase):
         # Make sure the image attachments are not treated as embedded:
         self.assertFalse('images' in data['message'])
 
+    def test_base64_mime_attachment(self):
+        # Already-encoded MIME payloads are passed through (without line breaks), not decoded and re-encoded
+        pdf_content = b"PDF\xb4 pretend this is valid pdf data" * 10
+        email = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        email.attach(MIMEApplication(pdf_content, "pdf"))
+        quoted = MIMEBase('text', 'plain')
+        quoted.set_payload("Caf=C3=A9")
+        quoted['Content-Transfer-Encoding'] = "quoted-printable"
+        email.attach(quoted)
+        with patch.object(MIMEBase, 'get_payload', autospec=True, side_effect=MIMEBase.get_payload) as get_payload:
+            email.send()
+        self.assertNotIn(True, [kwargs.get('decode') for args, kwargs in get_payload.call_args_list
+                                if args[0]['Content-Transfer-Encoding'] == "base64"])
+        attachments = self.get_api_call_data()['message']['attachments']
+        self.assertEqual(attachments[0]["type"], "application/pdf")
+        self.assertNotIn("\n", attachments[0]["content"])
+        self.assertEqual(decode_att(attachments[0]["content"]), pdf_content)
+        self.assertEqual(decode_att(attachments[1]["content"]), "Caf\u00e9".encode('utf-8'))
+
     def test_alternative_errors(self):
         # Multiple alternatives not allowed
         email = mail.EmailMultiAlternatives('Subject', 'Body',
@@ -307,6 +355,16 @@ class DjrillBackendTests(DjrillBackendMockAPITestCase):
             ['to@example.com'], fail_silently=True)
         self.assertEqual(sent, 0)
 
+    def test_api_timeout(self):
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_post.call_args[1]['timeout'], (10, 120))  # default
+        with self.settings(MANDRILL_API_TIMEOUT=None):
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertIsNone(self.mock_post.call_args[1]['timeout'])
+        with self.settings(MANDRILL_API_TIMEOUT=[3.05, 27]):
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_post.call_args[1]['timeout'], (3.05, 27))
+
     def test_api_error_includes_details(self):
         """MandrillAPIError should include Mandrill's error message"""
         msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
@@ -415,6 +473,49 @@ class DjrillMandrillFeatureTests(DjrillBackendMockAPITestCase):
                 'vars': [{ 'name': "GREETING", 'content': "Dear Guest"}] }
             ])
 
+    def test_columnar_merge_vars(self):
+        # RecipientData is a faster alternative to per-recipient dicts for large sends
+        self.message.merge_vars = RecipientData({
+            'rcpt': ["guest@example.com", "customer@example.com"],  # (order is preserved)
+            'GREETING': ["Dear Guest", "Dear Customer"],
+            'ACCOUNT_TYPE': ["Basic", "Premium"],
+        })
+        self.message.recipient_metadata = RecipientData.from_rows([
+            {'rcpt': "guest@example.com", 'cust_id': "94107"},
+            {'rcpt': "customer@example.com", 'cust_id': "67890"},
+        ])
+        self.message.send()
+        data = self.get_api_call_data()
+        self.assertEqual(data['message']['merge_vars'],
+            [ { 'rcpt': "guest@example.com",
+                'vars': [{ 'name': 'ACCOUNT_TYPE', 'content': "Basic" },
+                         { 'name': "GREETING", 'content': "Dear Guest"}] },
+              { 'rcpt': "customer@example.com",
+                'vars': [{ 'name': 'ACCOUNT_TYPE', 'content': "Premium" },
+                         { 'name': "GREETING", 'content': "Dear Customer"}] }
+            ])
+        self.assertEqual(data['message']['recipient_metadata'],
+            [ { 'rcpt': "guest@example.com", 'values': { 'cust_id': "94107" } },
+              { 'rcpt': "customer@example.com", 'values': { 'cust_id': "67890" } }
+            ])
+
+    def test_columnar_merge_vars_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            RecipientData({'rcpt': ["a@example.com", "b@example.com"], 'NAME': ["A"]})
+
+    @override_settings(MANDRILL_SORT_RECIPIENT_DATA=False)
+    def test_unsorted_merge_vars(self):
+        self.message.merge_vars = OrderedDict([
+            ("guest@example.com", OrderedDict([('GREETING', "Dear Guest"), ('ACCOUNT_TYPE', "Basic")])),
+            ("customer@example.com", {'GREETING': "Dear Customer"}),
+        ])
+        self.message.send()
+        data = self.get_api_call_data()
+        self.assertEqual([item['rcpt'] for item in data['message']['merge_vars']],
+                         ["guest@example.com", "customer@example.com"])
+        self.assertEqual([var['name'] for var in data['message']['merge_vars'][0]['vars']],
+                         ["GREETING", "ACCOUNT_TYPE"])
+
     def test_tags(self):
         self.message.tags = ["receipt", "repeat-user"]
         self.message.send()
@@ -605,6 +706,206 @@ class DjrillRecipientsRefusedTests(DjrillBackendMockAPITestCase):
         self.assertEqual(sent, 1)  # refused message is included in sent count
 
 
+class DjrillSendResultTests(DjrillBackendMockAPITestCase):
+    """Djrill attaches a compact, indexed MandrillSendResult as the mandrill_response"""
+
+    response = [
+        {"email": "one@example.com", "status": "sent", "_id": "id1", "reject_reason": None},
+        {"email": "Two@Example.com", "status": "rejected", "_id": "id2", "reject_reason": "hard-bounce"},
+        {"email": "three@example.com", "status": "queued", "_id": "id3", "reject_reason": None},
+        {"email": "four@example.com", "status": "sent", "_id": "id4", "reject_reason": None},
+    ]
+
+    def setUp(self):
+        super(DjrillSendResultTests, self).setUp()
+        self.mock_post.return_value = self.MockResponse(raw=six.b(json.dumps(self.response)))
+        self.message = mail.EmailMessage('Subject', 'Body', 'from@example.com',
+                                         [item['email'] for item in self.response])
+
+    def test_send_result(self):
+        self.message.send()
+        result = self.message.mandrill_response
+        self.assertIsInstance(result, MandrillSendResult)
+        self.assertEqual(result.status_counts, {'sent': 2, 'rejected': 1, 'queued': 1})
+        self.assertEqual(result.ids, ['id1', 'id2', 'id3', 'id4'])
+        self.assertEqual(result.reject_reasons, {'Two@Example.com': 'hard-bounce'})
+        self.assertEqual(result.status_for('three@example.com'), 'queued')
+        self.assertEqual(result.id_for('two@example.com'), 'id2')  # case-insensitive
+        self.assertEqual(result.reject_reason_for('TWO@example.com'), 'hard-bounce')
+        self.assertIsNone(result.reject_reason_for('one@example.com'))
+        self.assertIsNone(result.status_for('unknown@example.com'))
+        self.assertEqual(result.emails_with_status('sent', 'queued'),
+                         ['one@example.com', 'three@example.com', 'four@example.com'])
+
+    def test_send_result_as_list(self):
+        self.message.send()
+        result = self.message.mandrill_response
+        self.assertEqual(len(result), 4)
+        self.assertEqual(result[1]['email'], 'Two@Example.com')
+        self.assertEqual([item['_id'] for item in result], ['id1', 'id2', 'id3', 'id4'])
+        self.assertEqual(result, self.response)
+        self.assertNotEqual(result, self.response[:2])
+        self.assertEqual(result.raw, self.response)
+        self.assertIsInstance(result, list)
+        self.assertEqual(json.loads(json.dumps(result)), self.response)
+        self.assertEqual(result + [], self.response)
+        self.assertEqual(pickle.loads(pickle.dumps(result)).status_counts, result.status_counts)
+
+    def test_send_result_changes(self):
+        self.message.send()
+        result = self.message.mandrill_response
+        result += [{"email": "five@example.com", "status": "sent", "_id": "id5", "reject_reason": None}]
+        self.assertEqual(result.id_for('five@example.com'), 'id5')
+        del result[0]
+        self.assertIsNone(result.status_for('one@example.com'))
+        self.assertEqual(result.id_for('five@example.com'), 'id5')
+        self.assertEqual(result.status_counts, {'sent': 2, 'rejected': 1, 'queued': 1})
+
+    @unittest.skipIf(sys.version_info < (3,), "list.clear is new in Python 3")
+    def test_send_result_cleared(self):
+        self.message.send()
+        result = self.message.mandrill_response
+        result.clear()
+        self.assertIsNone(result.status_for('one@example.com'))
+        self.assertEqual(result.status_counts, {})
+
+    def test_unexpected_response_format(self):
+        self.mock_post.return_value = self.MockResponse(raw=b'{"status": "sent"}')
+        with self.assertRaisesMessage(MandrillAPIError, "Invalid Mandrill API response format"):
+            self.message.send()
+        self.mock_post.return_value = self.MockResponse(raw=b'{"status": "sent"}')
+        with self.settings(MANDRILL_IGNORE_RECIPIENT_STATUS=True):
+            msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            msg.send()
+        self.assertEqual(msg.mandrill_response, {"status": "sent"})
+
+
+@override_settings(MANDRILL_MAX_RECIPIENTS_PER_SEND=2)
+class DjrillChunkedSendTests(DjrillBackendMockAPITestCase):
+    """Djrill splits messages with many recipients into parallel sends"""
+
+    def setUp(self):
+        super(DjrillChunkedSendTests, self).setUp()
+        self.mock_post.side_effect = self.echo_recipients
+        self.failing_email = None
+
+    def echo_recipients(self, session, url, data, **kwargs):
+        recipients = json.loads(data)['message']['to']
+        if any(to['email'] == self.failing_email for to in recipients):
+            return self.MockResponse(status_code=500, raw=b'{"status": "error", "name": "ValidationError"}')
+        return self.MockResponse(raw=six.b(json.dumps([
+            {"email": to['email'], "status": "sent", "_id": to['email'][:2], "reject_reason": None}
+            for to in recipients])))
+
+    def test_chunked_send(self):
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['r1@example.com', 'r2@example.com'],
+                                bcc=['r3@example.com', 'R1@example.com', 'r5@example.com'])
+        msg.merge_vars = {'r1@example.com': {'NAME': "One"}, 'r5@example.com': {'NAME': "Five"}}
+        msg.recipient_metadata = {'r3@example.com': {'id': 3}}
+        self.assertEqual(msg.send(), 1)
+        self.assertEqual(self.mock_post.call_count, 3)
+        chunks = sorted((json.loads(kwargs['data'])['message'] for args, kwargs in self.mock_post.call_args_list),
+                        key=lambda chunk: chunk['to'][0]['email'])
+        self.assertEqual([[to['email'] for to in chunk['to']] for chunk in chunks],
+                         [['r1@example.com', 'r2@example.com'], ['r3@example.com', 'R1@example.com'],
+                          ['r5@example.com']])
+        self.assertEqual([to['type'] for to in chunks[1]['to']], ['bcc', 'bcc'])
+        self.assertEqual([[item['rcpt'] for item in chunk['merge_vars']] for chunk in chunks],
+                         [['r1@example.com'], ['r1@example.com'], ['r5@example.com']])
+        self.assertEqual([chunk['recipient_metadata'] for chunk in chunks],
+                         [[], [{'rcpt': 'r3@example.com', 'values': {'id': 3}}], []])
+        self.assertEqual(chunks[0]['subject'], "Subject")
+
+        # results are combined in recipient order:
+        result = msg.mandrill_response
+        self.assertIsInstance(result, MandrillSendResult)
+        self.assertEqual(result.emails, ['r1@example.com', 'r2@example.com', 'r3@example.com',
+                                         'R1@example.com', 'r5@example.com'])
+        self.assertEqual(result.status_counts, {'sent': 5})
+        self.assertEqual(result.id_for('r5@example.com'), 'r5')
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result[4]['email'], 'r5@example.com')
+
+    def test_small_send_not_chunked(self):
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['r1@example.com', 'r2@example.com'])
+        msg.send()
+        self.assertEqual(self.mock_post.call_count, 1)
+
+    def test_preserve_recipients_not_chunked(self):
+        # everyone needs to be in the same message to see each other
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['r1@example.com', 'r2@example.com'],
+                                cc=['r3@example.com'])
+        msg.preserve_recipients = True
+        msg.send()
+        self.assertEqual(self.mock_post.call_count, 1)
+
+    def test_failed_chunk(self):
+        self.failing_email = 'r3@example.com'
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com',
+                                ['r1@example.com', 'r2@example.com', 'r3@example.com'])
+        with self.assertRaises(MandrillAPIError):
+            msg.send()
+        self.assertEqual(self.mock_post.call_count, 2)
+        # the chunks that were sent are reported
+        self.assertEqual(msg.mandrill_response.emails, ['r1@example.com', 'r2@example.com'])
+
+
+class DjrillErrorDescriptionTests(DjrillBackendMockAPITestCase):
+    """Djrill exceptions summarize large sends, rather than holding on to them"""
+
+    def setUp(self):
+        super(DjrillErrorDescriptionTests, self).setUp()
+        self.recipients = ['to%d@example.com' % i for i in range(50)]
+        self.mock_post.return_value = self.MockResponse(status_code=200, raw=six.b(json.dumps(
+            [{"email": email, "status": "rejected" if i % 2 else "invalid"}
+             for i, email in enumerate(self.recipients)])))
+        self.message = mail.EmailMessage('Subject', 'Body', 'from@example.com', self.recipients)
+        self.message.attach("report.pdf", b"x" * 3000, "application/pdf")
+
+    def test_large_send_summarized(self):
+        with self.assertRaises(MandrillRecipientsRefused) as cm:
+            self.message.send()
+        err = cm.exception
+        self.assertIsNone(err.payload)
+        description = str(err)
+        self.assertIn("Sending a message to to0@example.com,to1@example.com,", description)
+        self.assertIn("to9@example.com (and 40 more) from from@example.com", description)
+        self.assertNotIn("to10@example.com", description)
+        self.assertIn("with attachments report.pdf (3000 bytes)", description)
+        self.assertIn("Mandrill API response 200: 25 invalid, 25 rejected", description)
+        self.assertIn("(and 40 more)", description.splitlines()[-1])
+
+    def test_request_body_not_retained(self):
+        self.mock_post.return_value.request = requests.Request('POST', "https://example.com", data="x" * 1000)
+        with self.assertRaises(MandrillRecipientsRefused) as cm:
+            self.message.send()
+        self.assertEqual(cm.exception.response.status_code, 200)
+        self.assertEqual(len(cm.exception.response.json()), 50)
+        self.assertIsNone(cm.exception.response.request)  # (its body would be the whole payload)
+
+        self.mock_post.return_value = self.MockResponse(status_code=500, raw=b'{"status": "error"}')
+        self.mock_post.return_value.request = requests.Request('POST', "https://example.com", data="x" * 1000)
+        with self.assertRaises(MandrillAPIError) as cm:
+            self.message.send()
+        self.assertIsNone(cm.exception.response.request)
+        self.assertIsNone(cm.exception.request)
+
+    def test_description_cached(self):
+        with self.assertRaises(MandrillRecipientsRefused) as cm:
+            self.message.send()
+        err = cm.exception
+        with patch.object(err.response, 'json', wraps=err.response.json) as mock_json:
+            description = str(err)
+            self.assertEqual(str(err), description)
+        self.assertEqual(mock_json.call_count, 1)
+
+    @override_settings(MANDRILL_RETAIN_ERROR_PAYLOAD=True)
+    def test_retain_payload(self):
+        with self.assertRaises(MandrillRecipientsRefused) as cm:
+            self.message.send()
+        self.assertEqual(len(cm.exception.payload['message']['to']), 50)
+
+
 @override_settings(MANDRILL_SETTINGS={
     'from_name': 'Djrill Test',
     'important': True,
@@ -742,6 +1043,47 @@ class DjrillMandrillGlobalFeatureTests(DjrillBackendMockAPITestCase):
                          [{'name': 'TEST', 'content': 'Hello'}])
 
 
+class DjrillSettingsCacheTests(DjrillBackendMockAPITestCase):
+    """Djrill resolves its settings once, until they change"""
+
+    def test_settings_cached(self):
+        with patch.object(DjrillBackend, 'load_settings', autospec=True,
+                          side_effect=DjrillBackend.load_settings) as mock_load_settings:
+            with self.settings(MANDRILL_SETTINGS={'track_opens': True}):
+                mail.get_connection()
+                backend = mail.get_connection()
+                self.assertEqual(mock_load_settings.call_count, 1)
+                self.assertEqual(backend.global_settings, {'track_opens': True})
+            # changing a setting invalidates the cache
+            with self.settings(MANDRILL_SETTINGS={'track_opens': False}):
+                backend = mail.get_connection()
+                self.assertEqual(mock_load_settings.call_count, 2)
+                self.assertEqual(backend.global_settings, {'track_opens': False})
+
+    def test_optional_features_imported_lazily(self):
+        code = ("from django.conf import settings; settings.configure(MANDRILL_API_KEY='key'); "
+                "import sys, djrill.mail.backends.djrill; "
+                "print(' '.join(sorted(m for m in sys.modules if m.startswith('djrill.'))))")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        loaded = subprocess.check_output([sys.executable, '-c', code], env=env).decode('ascii').split()
+        for module in ['djrill.circuit_breaker', 'djrill.hedging', 'djrill.key_pool', 'djrill.rejects',
+                       'djrill.scheduler', 'djrill.send_records', 'djrill.template_cache', 'djrill.transports']:
+            self.assertNotIn(module, loaded)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "module attributes can't be lazy before Python 3.5")
+    def test_package_imported_lazily(self):
+        code = ("from django.conf import settings; settings.configure(); "
+                "import sys, djrill; "
+                "print(' '.join(m for m in sys.modules if m.startswith(('djrill.', 'django.core.mail')))); "
+                "print(djrill.MessagePrototype.__module__)")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env).decode('ascii')
+        loaded, prototype_module = output.splitlines()
+        for module in ['django.core.mail', 'djrill.prototype', 'djrill.recipient_data', 'djrill.send_result']:
+            self.assertNotIn(module, loaded.split())
+        self.assertEqual(prototype_module, "djrill.prototype")  # imported on first use
+
+
 @override_settings(EMAIL_BACKEND="djrill.mail.backends.djrill.DjrillBackend")
 class DjrillImproperlyConfiguredTests(TestCase):
     """Test Djrill backend without Djrill-specific settings in place"""
@@ -0,0 +1,124 @@
+import json
+import time
+
+import six
+from mock import patch
+
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from djrill import send_records
+from djrill.mail.backends.djrill import clear_settings_cache
+from djrill.send_records import flush_send_records, lookup_send_records
+from djrill.send_records.models import MandrillSend
+from djrill.signals import webhook_event
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+
+def mandrill_response(*recipients):
+    return six.b(json.dumps([{"email": email, "status": "sent", "_id": "id-%s" % email[:2], "reject_reason": None}
+                             for email in recipients]))
+
+
+@override_settings(MANDRILL_RECORD_SENDS={"batch_size": 3, "max_delay": 60})
+class DjrillSendRecordsTests(DjrillBackendMockAPITestCase):
+    """Test Djrill backend's optional recording of send results"""
+
+    def tearDown(self):
+        send_records._writers.clear()
+        clear_settings_cache()  # backends hold on to the cleared object
+        super(DjrillSendRecordsTests, self).tearDown()
+
+    def test_buffered_bulk_create(self):
+        self.mock_post.return_value = self.MockResponse(raw=mandrill_response("r1@example.com", "r2@example.com"))
+        msg = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['r1@example.com', 'r2@example.com'])
+        msg.mandrill_reference = "order:1"
+        msg.send()
+        self.assertEqual(MandrillSend.objects.count(), 0)  # buffered
+        self.assertEqual(mail.get_connection().send_record_writer.pending(), 2)
+
+        self.mock_post.return_value = self.MockResponse(raw=mandrill_response("r3@example.com"))
+        with self.assertNumQueries(1):
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['r3@example.com'])
+        self.assertEqual(
+            list(MandrillSend.objects.order_by('email').values_list('mandrill_id', 'email', 'status', 'reference')),
+            [("id-r1", "r1@example.com", "sent", "order:1"),
+             ("id-r2", "r2@example.com", "sent", "order:1"),
+             ("id-r3", "r3@example.com", "sent", "")])
+
+    def test_flush(self):
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        flush_send_records()
+        self.assertEqual(MandrillSend.objects.get().mandrill_id, "abc123")
+
+    def test_no_record_without_id(self):
+        self.mock_post.return_value = self.MockResponse(raw=six.b(json.dumps(
+            [{"email": "to@example.com", "status": "rejected", "_id": None, "reject_reason": "hard-bounce"}])))
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'], fail_silently=True)
+        self.assertEqual(mail.get_connection().send_record_writer.pending(), 0)
+
+    def test_flush_after_max_delay(self):
+        writer = send_records.SendRecordWriter(batch_size=10, max_delay=0.01)
+        with patch.object(writer, 'flush') as mock_flush:
+            writer.add([MandrillSend(mandrill_id="abc123", email="to@example.com", status="sent",
+                                     created=timezone.now())])
+            for i in range(200):
+                if mock_flush.called:
+                    break
+                time.sleep(0.01)
+        self.assertTrue(mock_flush.called)  # without waiting for another send
+
+    def test_flush_errors_logged(self):
+        mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        with patch.object(MandrillSend.objects, 'bulk_create', side_effect=DatabaseError("disk full")):
+            with patch('djrill.send_records.logger') as mock_logger:
+                flush_send_records()  # doesn't raise
+        self.assertEqual(mock_logger.exception.call_count, 1)
+        self.assertEqual(MandrillSend.objects.count(), 0)
+
+    def test_requires_app(self):
+        with self.settings(INSTALLED_APPS=['django.contrib.contenttypes', 'djrill']):
+            with self.assertRaisesMessage(ImproperlyConfigured, "djrill.send_records"):
+                mail.get_connection()
+
+
+@override_settings(DJRILL_WEBHOOK_SECRET='abc123', MANDRILL_RECORD_SENDS=True)
+class DjrillWebhookSendRecordsTests(TestCase):
+    """Test webhook events are resolved to their send records"""
+
+    def tearDown(self):
+        send_records._writers.clear()
+
+    def test_lookup(self):
+        MandrillSend.objects.create(mandrill_id="id1", email="one@example.com", status="sent",
+                                    reference="order:1", created=timezone.now())
+        MandrillSend.objects.create(mandrill_id="id2", email="two@example.com", status="sent",
+                                    created=timezone.now())
+        events = [{"event": "open", "_id": "id1", "msg": {"_id": "id1"}}, {"event": "send", "msg": {"_id": "id2"}},
+                  {"event": "click", "_id": "unknown"}, {"type": "blacklist", "action": "add", "reject": {}}]
+        with self.assertNumQueries(1):
+            records = lookup_send_records(events)
+        self.assertEqual(sorted(records), ["id1", "id2"])
+        self.assertEqual(records["id1"].reference, "order:1")
+
+    def test_webhook_send_record(self):
+        MandrillSend.objects.create(mandrill_id="id1", email="one@example.com", status="sent",
+                                    reference="order:1", created=timezone.now())
+        received = []
+
+        def receiver(sender, event_type, data, send_record=None, **kwargs):
+            received.append((event_type, send_record.reference if send_record else None))
+
+        webhook_event.connect(receiver)
+        try:
+            response = self.client.post('/webhook/?secret=abc123', {'mandrill_events': json.dumps(
+                [{"event": "open", "_id": "id1", "msg": {"_id": "id1"}}, {"event": "open", "_id": "id9"}])})
+        finally:
+            webhook_event.disconnect(receiver)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(received, [("open", "order:1"), ("open", None)])
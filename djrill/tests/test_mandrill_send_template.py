@@ -1,6 +1,13 @@
+import json
+import six
+import warnings
+
 from django.core import mail
+from django.test.utils import override_settings
 
-from djrill import MandrillAPIError
+from djrill import MandrillAPIError, MandrillTemplateError, MandrillTemplateWarning, key_pool
+from djrill.mail.backends.djrill import clear_settings_cache
+from djrill.template_cache import CompiledTemplate, MandrillTemplate, template_cache, unresolved_merge_tags
 
 from .mock_backend import DjrillBackendMockAPITestCase
 
@@ -82,3 +89,196 @@ class DjrillMandrillSendTemplateTests(DjrillBackendMockAPITestCase):
         self.assertFalse('template_name' in data)
         self.assertFalse('template_content' in data)
         self.assertFalse('async' in data)
+
+
+TEMPLATE_INFO = {
+    "slug": "personalized-specials",
+    "name": "PERSONALIZED_SPECIALS",
+    "publish_code": '<div mc:edit="HEADLINE"><h1>Default headline</h1></div>'
+                    '<div mc:edit="OFFER_BLOCK">Default offer</div>'
+                    '<p>*|IF:FNAME|*Hi *|FNAME|*!*|END:IF|* See you at *|STORE|*</p>',
+    "publish_subject": "Specials for *|FNAME|*",
+    "publish_from_email": "specials@example.com",
+    "publish_from_name": "Example Store",
+    "publish_text": None,
+}
+
+
+class DjrillTemplateInfoMockAPITestCase(DjrillBackendMockAPITestCase):
+    """DjrillBackendMockAPITestCase that also mocks the Mandrill templates/info API"""
+
+    def setUp(self):
+        super(DjrillTemplateInfoMockAPITestCase, self).setUp()
+        template_cache.invalidate()
+        self.mock_post.side_effect = self.mock_api
+        self.message = mail.EmailMessage('Subject', 'Text Body', 'from@example.com', ['to@example.com'])
+        self.message.template_name = "PERSONALIZED_SPECIALS"
+
+    def tearDown(self):
+        template_cache.invalidate()
+        super(DjrillTemplateInfoMockAPITestCase, self).tearDown()
+
+    def mock_api(self, session, url, data=None, **kwargs):
+        if url.endswith("/templates/info.json"):
+            if json.loads(data)['name'] == "PERSONALIZED_SPECIALS":
+                return self.MockResponse(raw=six.b(json.dumps(TEMPLATE_INFO)))
+            return self.MockResponse(status_code=500, raw=b"""{"status": "error", "code": 5,
+                "name": "Unknown_Template", "message": "No such template"}""")
+        return self.MockResponse()
+
+    def api_methods_called(self):
+        return [call[0][1].rsplit("/api/1.0/", 1)[-1] for call in self.mock_post.call_args_list]
+
+
+@override_settings(MANDRILL_TEMPLATE_VALIDATION=True)
+class DjrillTemplateValidationTests(DjrillTemplateInfoMockAPITestCase):
+    """Test Djrill backend's optional local validation of Mandrill template sends"""
+
+    def test_valid_template_send(self):
+        self.message.template_content = {'HEADLINE': "<h1>Hi *|FNAME|*</h1>"}
+        self.message.global_merge_vars = {'STORE': "Main St."}
+        self.message.merge_vars = {'to@example.com': {'fname': "Kim"}}  # mailchimp tags aren't case-sensitive
+        self.message.send()
+        self.message.send()  # template info is cached
+        self.assertEqual(self.api_methods_called(), [
+            "templates/info.json", "messages/send-template.json", "messages/send-template.json"])
+
+    def test_unknown_template(self):
+        self.message.template_name = "NO_SUCH_TEMPLATE"
+        with self.assertRaisesMessage(MandrillTemplateError, "Unknown Mandrill template 'NO_SUCH_TEMPLATE'"):
+            self.message.send()
+        with self.assertRaises(MandrillTemplateError):
+            self.message.send()
+        # unknown template is cached, and send-template is never called:
+        self.assertEqual(self.api_methods_called(), ["templates/info.json"])
+
+    def test_unknown_edit_region(self):
+        self.message.template_content = {'HEADLINE': "Hi", 'FOOTER': "Bye"}
+        with self.assertRaisesMessage(MandrillTemplateError, "no editable region(s) FOOTER"):
+            self.message.send()
+
+    def test_unused_merge_vars(self):
+        self.message.global_merge_vars = {'STORE': "Main St.", 'FNAME': "Kim", 'COUPON': "SAVE10"}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.message.send()  # (sent anyway)
+        self.assertEqual([str(warning.message) for warning in caught],
+                         ["Mandrill template 'PERSONALIZED_SPECIALS' doesn't use merge var(s) COUPON"])
+        self.assertEqual(caught[0].category, MandrillTemplateWarning)
+        self.assertEqual(self.api_methods_called(), ["templates/info.json", "messages/send-template.json"])
+
+    @override_settings(MANDRILL_SETTINGS={'global_merge_vars': {'STORE': "Main St.", 'SITE': "example.com"}})
+    def test_merge_vars_used_outside_template(self):
+        self.message.subject = "Your *|COUPON|* coupon"
+        self.message.global_merge_vars = {'FNAME': "Kim", 'COUPON': "SAVE10"}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.message.send()
+        self.assertEqual(caught, [])  # (SITE is shared by all templates)
+
+    def test_unresolved_merge_tags(self):
+        self.message.merge_vars = {'to@example.com': {'fname': "Kim"}}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.message.send()  # (sent anyway)
+        self.assertEqual([str(warning.message) for warning in caught],
+                         ["Mandrill template 'PERSONALIZED_SPECIALS' uses merge tag(s) STORE without a merge var"])
+        self.assertEqual(caught[0].category, MandrillTemplateWarning)
+        self.assertEqual(self.api_methods_called(), ["templates/info.json", "messages/send-template.json"])
+
+    @override_settings(MANDRILL_TEMPLATE_VALIDATION="strict")
+    def test_unresolved_merge_tags_strict(self):
+        self.message.merge_vars = {'to@example.com': {'fname': "Kim"}}
+        with self.assertRaisesMessage(MandrillTemplateError, "uses merge tag(s) STORE without a merge var"):
+            self.message.send()
+        self.assertEqual(self.api_methods_called(), ["templates/info.json"])
+
+    def test_merge_tags_needing_vars(self):
+        template = MandrillTemplate({
+            "publish_code": "*|IF:VIP|*Hi VIP*|ELSEIF:LEVEL=2|*Hi*|ELSE:|**|END:IF|* *|UPPER:NAME|* *|MC:SUBJECT|* "
+                            "*|DATE:Y|* *|CURRENT_YEAR|* *|ARCHIVE|* *|LIST:COMPANY|* *|HTML:LIST_ADDRESS_HTML|* "
+                            "*|UPDATE_PROFILE|* *|UNSUB|*",
+            "publish_subject": "Subject", "publish_from_email": "from@example.com"})
+        payload = {'template_content': [], 'message': {}}
+        self.assertEqual(unresolved_merge_tags(template, payload), ["NAME"])
+        payload['message']['global_merge_vars'] = [{'name': "name", 'content': "Kim"}]
+        self.assertEqual(unresolved_merge_tags(template, payload), [])
+        self.assertEqual(template.merge_tags(), set(["VIP", "LEVEL", "NAME", "CURRENT_YEAR", "ARCHIVE",
+                                                     "LIST_ADDRESS_HTML", "UPDATE_PROFILE", "UNSUB"]))
+
+    @override_settings(MANDRILL_API_KEYS=[{"key": "KEY_A", "name": "a"}, {"key": "KEY_B", "name": "b"}],
+                       MANDRILL_KEY_FUNCTION='djrill.tests.test_mandrill_key_pool.route_by_tenant')
+    def test_cached_by_api_key(self):
+        try:
+            self.message.global_merge_vars = {'STORE': "Main St.", 'FNAME': "Kim"}
+            for tenant in ["a", "b", "b"]:
+                self.message.tenant = tenant
+                self.message.send()
+        finally:
+            key_pool._pools.clear()
+            clear_settings_cache()
+        info_keys = [json.loads(call[1]['data'])['key'] for call in self.mock_post.call_args_list
+                     if call[0][1].endswith("/templates/info.json")]
+        self.assertEqual(info_keys, ["KEY_A", "KEY_B"])  # loaded with the key each send uses
+
+    def test_fail_silently(self):
+        self.message.template_name = "NO_SUCH_TEMPLATE"
+        self.assertEqual(self.message.send(fail_silently=True), 0)
+
+    def test_render_preview(self):
+        template = mail.get_connection().get_template("PERSONALIZED_SPECIALS")
+        self.assertEqual(template.subject, "Specials for *|FNAME|*")
+        self.assertEqual(template.edit_regions, frozenset(['HEADLINE', 'OFFER_BLOCK']))
+        html = template.render({'OFFER_BLOCK': "<b>Half off</b>"}, {'FNAME': "Kim"})
+        self.assertEqual(html, '<div mc:edit="HEADLINE"><h1>Default headline</h1></div>'
+                               '<div mc:edit="OFFER_BLOCK"><b>Half off</b></div>'
+                               '<p>*|IF:FNAME|*Hi Kim!*|END:IF|* See you at *|STORE|*</p>')
+
+
+@override_settings(MANDRILL_RENDER_TEMPLATES_LOCALLY=True)
+class DjrillLocalTemplateRenderingTests(DjrillTemplateInfoMockAPITestCase):
+    """Test Djrill backend's optional local rendering of Mandrill templates"""
+
+    def test_render_locally(self):
+        self.message.template_content = {'OFFER_BLOCK': "<b>Half off</b>"}
+        self.message.merge_vars = {'to@example.com': {'FNAME': "Kim"}}
+        self.message.use_template_subject = True
+        self.message.send()
+        self.message.send()  # template is compiled once and cached
+        self.assertEqual(self.api_methods_called(), [
+            "templates/info.json", "messages/send.json", "messages/send.json"])
+        data = self.get_api_call_data()
+        self.assertNotIn('template_name', data)
+        self.assertNotIn('template_content', data)
+        self.assertNotIn('text', data['message'])  # body is ignored, as with send-template
+        self.assertEqual(data['message']['html'],
+                         '<div mc:edit="HEADLINE"><h1>Default headline</h1></div>'
+                         '<div mc:edit="OFFER_BLOCK"><b>Half off</b></div>'
+                         '<p>*|IF:FNAME|*Hi *|FNAME|*!*|END:IF|* See you at *|STORE|*</p>')
+        self.assertEqual(data['message']['subject'], "Specials for *|FNAME|*")
+        self.assertEqual(data['message']['from_email'], "from@example.com")
+        # merge tags are left for Mandrill:
+        self.assertEqual(data['message']['merge_vars'],
+                         [{'rcpt': 'to@example.com', 'vars': [{'name': 'FNAME', 'content': "Kim"}]}])
+
+    def test_template_from(self):
+        self.message.use_template_from = True
+        self.message.send()
+        data = self.get_api_call_data()
+        self.assertEqual(data['message']['from_email'], "specials@example.com")
+        self.assertEqual(data['message']['from_name'], "Example Store")
+        self.assertEqual(data['message']['subject'], "Subject")
+
+    def test_unknown_template(self):
+        self.message.template_name = "NO_SUCH_TEMPLATE"
+        with self.assertRaisesMessage(MandrillTemplateError, "Unknown Mandrill template 'NO_SUCH_TEMPLATE'"):
+            self.message.send()
+
+    def test_nested_edit_regions(self):
+        compiled = CompiledTemplate('<div mc:edit="outer">a<div mc:edit="inner">b</div>c</div>'
+                                    '<img mc:edit="logo" src="x.png"/><p mc:edit="last">d</p>')
+        self.assertEqual(compiled.render({'inner': "B", 'last': "D"}),
+                         '<div mc:edit="outer">a<div mc:edit="inner">B</div>c</div>'
+                         '<img mc:edit="logo" src="x.png"/><p mc:edit="last">D</p>')
+        self.assertEqual(compiled.render({'outer': "A"}),
+                         '<div mc:edit="outer">A</div><img mc:edit="logo" src="x.png"/><p mc:edit="last">d</p>')
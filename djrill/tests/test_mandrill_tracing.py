@@ -0,0 +1,104 @@
+import json
+import unittest
+from contextlib import contextmanager
+
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djrill.tracing import get_tracer, null_tracer
+from djrill.views import calculate_signature
+
+from .mock_backend import DjrillBackendMockAPITestCase
+
+try:
+    import opentelemetry
+except ImportError:
+    opentelemetry = None
+
+
+class RecordingTracer(object):
+    """Minimal OpenTelemetry-compatible tracer that records its spans"""
+
+    class Span(object):
+        def __init__(self, name, attributes):
+            self.name = name
+            self.attributes = dict(attributes or {})
+
+        def set_attribute(self, key, value):
+            self.attributes[key] = value
+
+    def __init__(self):
+        self.spans = []  # in the order they finished
+        self.depth = 0
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = self.Span(name, attributes)
+        span.depth = self.depth
+        self.depth += 1
+        try:
+            yield span
+        finally:
+            self.depth -= 1
+            self.spans.append(span)
+
+    def names(self):
+        return [(span.depth, span.name) for span in self.spans]
+
+
+class DjrillTracingSetupTests(TestCase):
+
+    def test_off_by_default(self):
+        self.assertIs(get_tracer(False), null_tracer)
+        with null_tracer.span("anything", {"a": 1}) as span:
+            span.set_attribute("b", 2)
+
+    def test_invalid_tracer(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_tracer("not a tracer")
+
+    @unittest.skipIf(opentelemetry is not None, "opentelemetry is installed")
+    def test_opentelemetry_missing(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "opentelemetry-api"):
+            get_tracer(True)
+
+
+class DjrillSendTracingTests(DjrillBackendMockAPITestCase):
+
+    def test_send_spans(self):
+        tracer = RecordingTracer()
+        with self.settings(MANDRILL_TRACING=tracer):
+            mail.send_mail('Subject', 'Message', 'from@example.com', ['to@example.com'])
+        self.assertEqual(tracer.names(), [
+            (2, "djrill.build_payload"),
+            (2, "djrill.serialize"),
+            (2, "djrill.http_post"),
+            (2, "djrill.parse_response"),
+            (2, "djrill.validate_response"),
+            (1, "djrill.send"),
+            (0, "djrill.send_messages"),
+        ])
+        http_post = tracer.spans[2]
+        self.assertEqual(http_post.attributes, {"http.url": "https://mandrillapp.com/api/1.0/messages/send.json",
+                                                "http.status_code": 200})
+        self.assertEqual(tracer.spans[-1].attributes, {"djrill.messages": 1})
+
+
+@override_settings(DJRILL_WEBHOOK_SECRET='abc123')
+class DjrillWebhookTracingTests(TestCase):
+
+    def test_webhook_spans(self):
+        tracer = RecordingTracer()
+        with self.settings(MANDRILL_TRACING=tracer, DJRILL_WEBHOOK_SIGNATURE_KEY="signature",
+                           DJRILL_WEBHOOK_URL="/webhook/?secret=abc123"):
+            data = json.dumps([{"event": "send", "msg": {}}, {"event": "open", "msg": {}}])
+            signature = calculate_signature("signature", "/webhook/?secret=abc123", [("mandrill_events", [data])])
+            response = self.client.post('/webhook/?secret=abc123', {'mandrill_events': data},
+                                        HTTP_X_MANDRILL_SIGNATURE=signature)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([span.name for span in tracer.spans],
+                         ["djrill.webhook.verify_signature", "djrill.webhook.event", "djrill.webhook.event"])
+        self.assertEqual([span.attributes for span in tracer.spans[1:]],
+                         [{"djrill.event_type": "send"}, {"djrill.event_type": "open"}])
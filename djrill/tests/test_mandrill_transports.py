@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import socket
+from unittest import skipIf, skipUnless
+
+import requests
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djrill import MandrillAPIError
+from djrill.fake_mandrill import FakeMandrill, FakeMandrillServer, fake_mandrill
+from djrill.mail.backends.djrill import DjrillBackend
+from djrill.transports import Http2Session, Urllib3Session, benchmark_transports
+
+try:
+    Http2Session().close()
+    HAS_HTTP2 = True
+except ImproperlyConfigured:
+    HAS_HTTP2 = False
+
+
+class RecordingSession(requests.Session):
+    pass
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@override_settings(MANDRILL_API_KEY="FAKE_API_KEY_FOR_TESTING",
+                   EMAIL_BACKEND="djrill.mail.backends.djrill.DjrillBackend")
+class DjrillTransportTests(TestCase):
+    """Test sending through the MANDRILL_TRANSPORT sessions, to a local fake Mandrill server"""
+
+    def setUp(self):
+        self.fake = FakeMandrill(api_key="FAKE_API_KEY_FOR_TESTING")
+        self.server = FakeMandrillServer(self.fake).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def send_with_transport(self, transport):
+        with self.settings(MANDRILL_API_URL=self.server.api_url, MANDRILL_TRANSPORT=transport):
+            connection = mail.get_connection()
+            messages = [mail.EmailMessage('Subject ♥', 'Body', 'from@example.com', ['to%d@example.com' % i])
+                        for i in range(3)]
+            self.assertEqual(connection.send_messages(messages), 3)
+            self.assertEqual(messages[2].mandrill_response[0]['email'], "to2@example.com")
+            self.assertEqual(messages[2].mandrill_response[0]['status'], "sent")
+
+            with self.settings(MANDRILL_API_KEY="WRONG_KEY"):
+                with self.assertRaisesMessage(MandrillAPIError, "Invalid_Key") as cm:
+                    mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            self.assertEqual(cm.exception.status_code, 500)
+        self.assertEqual(self.fake.call_counts, {"messages/send.json": 4})
+
+    def test_requests(self):
+        self.send_with_transport("requests")
+
+    def test_urllib3(self):
+        self.send_with_transport("urllib3")
+
+    @skipUnless(HAS_HTTP2, "httpx with HTTP/2 support isn't installed")
+    def test_http2(self):
+        self.send_with_transport("http2")
+
+    @skipIf(HAS_HTTP2, "httpx with HTTP/2 support is installed")
+    def test_http2_not_installed(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "httpx"):
+            Http2Session()
+
+    def test_custom_session_class(self):
+        with self.settings(MANDRILL_TRANSPORT="djrill.tests.test_mandrill_transports.RecordingSession"):
+            connection = DjrillBackend()
+            connection.open()
+            self.assertIsInstance(connection.session, RecordingSession)
+            self.assertTrue(connection.session.headers["User-Agent"].startswith("Djrill/"))
+            connection.close()
+
+    def test_unknown_transport(self):
+        with self.settings(MANDRILL_TRANSPORT="carrier_pigeon"):
+            with self.assertRaises(ImproperlyConfigured):
+                DjrillBackend()
+
+    def test_fake_backend_ignores_transport(self):
+        with self.settings(MANDRILL_TRANSPORT="urllib3", EMAIL_BACKEND="djrill.fake_mandrill.FakeMandrillBackend"):
+            fake_mandrill.reset()
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            self.assertEqual(fake_mandrill.call_counts, {"messages/send.json": 1})
+
+    def test_urllib3_errors(self):
+        session = Urllib3Session()
+        try:
+            with self.assertRaises(requests.ConnectionError):
+                session.post("http://127.0.0.1:%d/api/1.0/users/ping.json" % unused_port(), data="{}")
+            self.fake.configure(latency=0.5)
+            with self.assertRaises(requests.Timeout):
+                session.post(self.server.api_url + "/users/ping.json", data="{}", timeout=(1, 0.05))
+        finally:
+            session.close()
+
+    def test_urllib3_verifies_certificates(self):
+        session = Urllib3Session()
+        try:
+            self.assertEqual(session.pool_manager.connection_pool_kw['cert_reqs'], 'CERT_REQUIRED')
+            self.assertEqual(session.pool_manager.connection_pool_kw['ca_certs'], requests.certs.where())
+        finally:
+            session.close()
+
+    def test_benchmark(self):
+        results = benchmark_transports(("requests", "urllib3"), calls=3, api_url=self.server.api_url)
+        self.assertEqual(sorted(results), ["requests", "urllib3"])
+        self.assertEqual(self.fake.call_counts, {"users/ping.json": 8})
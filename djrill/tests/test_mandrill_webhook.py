@@ -10,6 +10,7 @@ from django.test.utils import override_settings
 
 from djrill.compat import b
 from djrill.signals import webhook_event
+from djrill.views import calculate_signature
 
 
 class DjrillWebhookSecretMixinTests(TestCase):
@@ -64,6 +65,15 @@ class DjrillWebhookSignatureMixinTests(TestCase):
                                     **{"HTTP_X_MANDRILL_SIGNATURE": hash_string})
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(DJRILL_WEBHOOK_URL="/webhook/?secret=abc123")
+    def test_signature_header_str(self):
+        # (as it arrives from a real python 3 server)
+        hash_string = calculate_signature(settings.DJRILL_WEBHOOK_SIGNATURE_KEY, settings.DJRILL_WEBHOOK_URL,
+                                          [("mandrill_events", ["[]"])])
+        response = self.client.post('/webhook/?secret=abc123', data={"mandrill_events": "[]"},
+                                    **{"HTTP_X_MANDRILL_SIGNATURE": hash_string.decode('ascii')})
+        self.assertEqual(response.status_code, 200)
+
 
 @override_settings(DJRILL_WEBHOOK_SECRET='abc123')
 class DjrillWebhookViewTests(TestCase):
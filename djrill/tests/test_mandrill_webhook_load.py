@@ -0,0 +1,74 @@
+import json
+
+import six
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djrill.signals import webhook_event
+from djrill.views import DjrillWebhookView
+from djrill.webhook_load import DEFAULT_EVENT_MIX, WebhookEventFactory, WebhookLoadGenerator
+
+
+class WebhookEventFactoryTests(TestCase):
+
+    def test_event_types(self):
+        factory = WebhookEventFactory(seed=1)
+        view = DjrillWebhookView()
+        for event_type in DEFAULT_EVENT_MIX:
+            event = factory.make(event_type)
+            self.assertEqual(view.get_event_type(event), event_type)
+        self.assertIn("@example.com", factory.make("hard_bounce")['msg']['email'])
+        self.assertIn("url", factory.make("click"))
+        self.assertIn("raw_msg", factory.make("inbound")['msg'])
+
+    def test_batch(self):
+        batch = WebhookEventFactory(seed=1).batch(50, event_types=["open", "blacklist_add"])
+        self.assertEqual(len(batch), 50)
+        self.assertEqual(set(event.get('event', 'blacklist_add') for event in batch), {"open", "blacklist_add"})
+        self.assertEqual(batch, WebhookEventFactory(seed=1).batch(50, event_types=["open", "blacklist_add"]))
+        with self.assertRaises(ValueError):
+            WebhookEventFactory().batch(1, event_types=["unknown"])
+
+
+@override_settings(DJRILL_WEBHOOK_SECRET='abc123',
+                   DJRILL_WEBHOOK_SIGNATURE_KEY="signature",
+                   DJRILL_WEBHOOK_URL="https://example.com/webhook/?secret=abc123")
+class WebhookLoadGeneratorTests(TestCase):
+
+    def setUp(self):
+        self.received = []
+        webhook_event.connect(self.receive)
+
+    def tearDown(self):
+        webhook_event.disconnect(self.receive)
+
+    def receive(self, sender, event_type, data, **kwargs):
+        self.received.append(event_type)
+
+    def test_run(self):
+        generator = WebhookLoadGenerator('/webhook/?secret=abc123', factory=WebhookEventFactory(seed=1))
+        report = generator.run(events=25, batch_size=10, trace_memory=True)
+        self.assertEqual(report['events'], 25)
+        self.assertEqual(report['batches'], 3)
+        self.assertEqual(report['status_codes'], {200: 3})  # signed correctly
+        self.assertEqual(sorted(report['latency_ms']), ['max', 'p50', 'p90', 'p99'])
+        self.assertGreater(report['events_per_second'], 0)
+        self.assertEqual(len(self.received), 25)
+
+    def test_bad_signature(self):
+        generator = WebhookLoadGenerator('/webhook/?secret=abc123', signature_key="wrong")
+        self.assertEqual(generator.post_batch([]), 403)
+
+    def test_rate(self):
+        generator = WebhookLoadGenerator('/webhook/?secret=abc123')
+        report = generator.run(events=4, batch_size=1, rate=100)
+        self.assertGreaterEqual(report['seconds'], 0.03)
+
+    def test_command(self):
+        out = six.StringIO()
+        call_command('djrill_webhook_load', events=5, batch_size=5, event_types="send,open", seed=1,
+                     stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['status_codes'], {"200": 1})
+        self.assertEqual(sorted(set(self.received)), ["open", "send"])
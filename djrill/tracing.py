@@ -0,0 +1,74 @@
+"""Optional tracing spans around Djrill's send and webhook paths
+
+Tracing is off unless the MANDRILL_TRACING setting is True (to use the
+OpenTelemetry API's global tracer provider) or an OpenTelemetry-compatible
+tracer (an object with a start_as_current_span(name, attributes=...) method).
+
+While it's off, every span is the same do-nothing context manager, so the
+instrumentation costs no more than an empty with block.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+
+from ._version import __version__
+
+
+class NullSpan(object):
+    """Span that records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_exception(self, exception, attributes=None):
+        pass
+
+
+class NullTracer(object):
+    """Tracer used while tracing is off"""
+
+    enabled = False
+    _span = NullSpan()
+
+    def span(self, name, attributes=None):
+        return self._span
+
+
+class Tracer(object):
+    """Adapts an OpenTelemetry tracer for Djrill's spans"""
+
+    enabled = True
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def span(self, name, attributes=None):
+        """Return a context manager for a span called name, which is current while it's open"""
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+
+null_tracer = NullTracer()
+_opentelemetry_tracer = None
+
+
+def get_tracer(option):
+    """Return the Tracer (or NullTracer) for a MANDRILL_TRACING setting value"""
+    global _opentelemetry_tracer
+    if not option:
+        return null_tracer
+    if option is True:
+        if _opentelemetry_tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                raise ImproperlyConfigured("MANDRILL_TRACING requires the opentelemetry-api package")
+            _opentelemetry_tracer = Tracer(trace.get_tracer("djrill", __version__))
+        return _opentelemetry_tracer
+    if not hasattr(option, "start_as_current_span"):
+        raise ImproperlyConfigured("MANDRILL_TRACING must be True or an OpenTelemetry tracer")
+    return Tracer(option)
@@ -1,6 +1,7 @@
 import hashlib
 import hmac
 import json
+import time
 from base64 import b64encode
 
 from django.conf import settings
@@ -10,8 +11,26 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from . import rejects  # (connects the local reject list's webhook_event receiver)
 from .compat import b
+from .metrics import metrics
+from .send_records import event_mandrill_id, get_send_record_writer, lookup_send_records
 from .signals import webhook_event
+from .tracing import get_tracer
+
+
+def calculate_signature(signature_key, url, post_lists):
+    """Return the X-Mandrill-Signature for a webhook POST of post_lists to url
+
+    post_lists is a list of (key, [values]) pairs, like QueryDict.lists()
+    """
+    # The querydict is a bit special, see https://docs.djangoproject.com/en/dev/ref/request-response/#querydict-objects
+    # Mandrill needs it to be sorted and added to the hash
+    post_string = url
+    for key, values in sorted(post_lists):
+        for item in values:
+            post_string += "%s%s" % (key, item)
+    return b64encode(hmac.new(key=b(signature_key), msg=b(post_string), digestmod=hashlib.sha1).digest())
 
 
 class DjrillWebhookSecretMixin(object):
@@ -52,14 +71,10 @@ class DjrillWebhookSignatureMixin(object):
             if not signature:
                 return HttpResponse(status=403, content="X-Mandrill-Signature not set")
 
-            # The querydict is a bit special, see https://docs.djangoproject.com/en/dev/ref/request-response/#querydict-objects
-            # Mandrill needs it to be sorted and added to the hash
-            post_lists = sorted(request.POST.lists())
-            for value_list in post_lists:
-                for item in value_list[1]:
-                    post_string += "%s%s" % (value_list[0], item)
-
-            hash_string = b64encode(hmac.new(key=b(signature_key), msg=b(post_string), digestmod=hashlib.sha1).digest())
+            with get_tracer(getattr(settings, "MANDRILL_TRACING", False)).span("djrill.webhook.verify_signature"):
+                hash_string = calculate_signature(signature_key, post_string, request.POST.lists())
+            if not isinstance(signature, bytes):
+                signature = b(signature)  # (python 3 server)
             if signature != hash_string:
                 return HttpResponse(status=403, content="Signature doesn't match")
 
@@ -72,17 +87,33 @@ class DjrillWebhookView(DjrillWebhookSecretMixin, DjrillWebhookSignatureMixin, V
         return HttpResponse()
 
     def post(self, request, *args, **kwargs):
+        started = time.time()
         try:
             data = json.loads(request.POST.get('mandrill_events'))
         except TypeError:
             return HttpResponse(status=400)
 
+        tracer = get_tracer(getattr(settings, "MANDRILL_TRACING", False))
+        send_records = self.get_send_records(data)
         for event in data:
-            webhook_event.send(
-                sender=None, event_type=self.get_event_type(event), data=event)
-
+            event_type = self.get_event_type(event)
+            metrics.inc("djrill_webhook_events_total", event_type=event_type or "unknown")
+            send_record = send_records.get(event_mandrill_id(event)) if send_records else None
+            with tracer.span("djrill.webhook.event", {"djrill.event_type": event_type or "unknown"}):
+                webhook_event.send(
+                    sender=None, event_type=event_type, data=event, send_record=send_record)
+
+        metrics.observe("djrill_webhook_batch_seconds", time.time() - started)
         return HttpResponse()
 
+    def get_send_records(self, events):
+        """Return {Mandrill _id: MandrillSend} for events (if MANDRILL_RECORD_SENDS is enabled)"""
+        record_sends = getattr(settings, "MANDRILL_RECORD_SENDS", False)
+        if not record_sends:
+            return {}
+        writer = get_send_record_writer(record_sends if isinstance(record_sends, dict) else {})
+        return lookup_send_records(events, writer)
+
     def get_event_type(self, event):
         try:
             # Message event: https://mandrill.zendesk.com/hc/en-us/articles/205583307
@@ -97,3 +128,13 @@ class DjrillWebhookView(DjrillWebhookSecretMixin, DjrillWebhookSignatureMixin, V
                 # Unknown future event format
                 event_type = None
         return event_type
+
+
+class DjrillMetricsView(View):
+    """Djrill's metrics, in Prometheus text format
+
+    (Not included in djrill.urls: add it to your own urls, where only your monitoring can reach it.)
+    """
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
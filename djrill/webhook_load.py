@@ -0,0 +1,291 @@
+"""Synthetic Mandrill webhook traffic, for load testing DjrillWebhookView and webhook_event receivers
+
+WebhookEventFactory makes realistic Mandrill webhook events (message events like
+send, open, click and hard_bounce; rejection sync events; and inbound messages).
+WebhookLoadGenerator posts batches of them to the webhook view, signed like Mandrill
+would (if DJRILL_WEBHOOK_SIGNATURE_KEY is set), at a target rate, and reports the
+throughput, latency percentiles and memory use.
+
+The djrill_webhook_load management command runs a WebhookLoadGenerator.
+"""
+
+import itertools
+import json
+import random
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None  # (Windows)
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # python 2
+
+from django.conf import settings
+
+from .views import calculate_signature
+
+
+# Relative frequency of each event type in a batch (roughly what a busy sender sees)
+DEFAULT_EVENT_MIX = {
+    "send": 40,
+    "deferral": 2,
+    "soft_bounce": 2,
+    "hard_bounce": 2,
+    "open": 25,
+    "click": 10,
+    "spam": 1,
+    "unsub": 1,
+    "reject": 2,
+    "blacklist_add": 1,
+    "blacklist_remove": 1,
+    "whitelist_add": 1,
+    "inbound": 12,
+}
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 9_2 like Mac OS X) AppleWebKit/601.1.46 (KHTML, like Gecko) Mobile/13C75",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko",
+]
+
+
+class WebhookEventFactory(object):
+    """Makes Mandrill webhook events, with recipients drawn from a pool of recipient addresses"""
+
+    def __init__(self, recipients=10000, domain="example.com", event_mix=None, seed=None):
+        self.recipients = recipients
+        self.domain = domain
+        self.event_mix = event_mix or DEFAULT_EVENT_MIX
+        self.random = random.Random(seed)
+        self._ids = itertools.count(1)
+
+    def batch(self, size, event_types=None):
+        """Return a list of size events, of event_types (default all) in proportion to the event mix"""
+        mix = [(event_type, weight) for event_type, weight in sorted(self.event_mix.items())
+               if event_types is None or event_type in event_types]
+        if not mix:
+            raise ValueError("No events of types %r" % (event_types,))
+        total = float(sum(weight for event_type, weight in mix))
+        events = []
+        for i in range(size):
+            choice = self.random.random() * total
+            for event_type, weight in mix:
+                choice -= weight
+                if choice < 0:
+                    break
+            events.append(self.make(event_type))
+        return events
+
+    def make(self, event_type):
+        """Return one event of event_type (a Mandrill event name, "blacklist_add"-style sync event, or "inbound")"""
+        now = int(time.time())
+        if event_type == "inbound":
+            return self._inbound_event(now)
+        if "_" in event_type and event_type.split("_")[0] in ("blacklist", "whitelist"):
+            return self._sync_event(now, *event_type.split("_", 1))
+        return self._message_event(now, event_type)
+
+    def _email(self):
+        return "user%d@%s" % (self.random.randrange(self.recipients), self.domain)
+
+    def _message_event(self, now, event_type):
+        message_id = "%032x" % next(self._ids)
+        email = self._email()
+        sent_at = now - self.random.randrange(86400)
+        state = {"soft_bounce": "soft-bounced", "hard_bounce": "bounced", "reject": "rejected",
+                 "deferral": "deferred", "spam": "spam", "unsub": "sent"}.get(event_type, "sent")
+        msg = {
+            "ts": sent_at,
+            "_id": message_id,
+            "_version": "exampleaaaaaaaaaaaaaaa",
+            "state": state,
+            "subject": "Your order #%d has shipped" % self.random.randrange(100000),
+            "email": email,
+            "sender": "orders@%s" % self.domain,
+            "tags": ["order-shipped"],
+            "metadata": {"user_id": self.random.randrange(1000000)},
+            "subaccount": None,
+            "opens": [],
+            "clicks": [],
+            "smtp_events": [],
+            "resends": [],
+        }
+        event = {"event": event_type, "_id": message_id, "msg": msg, "ts": now}
+        if event_type in ("open", "click"):
+            user_agent = self.random.choice(USER_AGENTS)
+            msg["opens"] = [{"ts": now - 60, "ip": "192.0.2.1", "location": "Chicago, US", "ua": user_agent}]
+            event.update({
+                "ip": "192.0.2.%d" % self.random.randrange(1, 255),
+                "user_agent": user_agent,
+                "location": {"country_short": "US", "country": "United States", "region": "Illinois",
+                             "city": "Chicago", "postal_code": "60601", "timezone": "-05:00",
+                             "latitude": 41.88, "longitude": -87.62},
+                "user_agent_parsed": {"type": "Browser", "ua_family": "Chrome", "ua_name": "Chrome 47.0",
+                                      "ua_version": "47.0", "os_family": "Windows", "os_name": "Windows 10",
+                                      "mobile": False},
+            })
+        if event_type == "click":
+            event["url"] = "https://www.%s/orders/%d?utm_source=email" % (self.domain, self.random.randrange(100000))
+            msg["clicks"] = [{"ts": now, "url": event["url"]}]
+        if event_type in ("soft_bounce", "hard_bounce"):
+            msg.update({"bounce_description": "bad_mailbox" if event_type == "hard_bounce" else "mailbox_full",
+                        "diag": "smtp;550 5.1.1 The email account that you tried to reach does not exist."})
+        if event_type == "deferral":
+            msg["smtp_events"] = [{"ts": now, "type": "deferred", "diag": "451 4.3.5 Temporarily unavailable",
+                                   "source_ip": "198.51.100.1", "destination_ip": "203.0.113.1", "size": 0}]
+        return event
+
+    def _sync_event(self, now, list_type, action):
+        email = self._email()
+        entry = {
+            "email": email,
+            "detail": "Added manually",
+            "created_at": "2015-12-01 12:00:00",
+            "last_event_at": "2015-12-01 12:00:00",
+            "expires_at": "2016-12-01 12:00:00",
+            "expired": False,
+            "subaccount": None,
+            "sender": None,
+        }
+        if list_type == "blacklist":
+            entry["reason"] = "hard-bounce"
+        return {"type": list_type, "action": action, "reject": entry, "ts": now}
+
+    def _inbound_event(self, now):
+        sender = self._email()
+        recipient = "support@inbound.%s" % self.domain
+        subject = "Question about order #%d" % self.random.randrange(100000)
+        text = "Hi,\n\nWhere is my order?\n\nThanks\n"
+        raw_msg = ("Received: from mail.example.org\nFrom: <%s>\nTo: <%s>\nSubject: %s\n"
+                   "Content-Type: text/plain; charset=utf-8\n\n%s" % (sender, recipient, subject, text))
+        return {
+            "event": "inbound",
+            "ts": now,
+            "msg": {
+                "raw_msg": raw_msg,
+                "headers": {"From": "<%s>" % sender, "To": "<%s>" % recipient, "Subject": subject,
+                            "Content-Type": "text/plain; charset=utf-8"},
+                "text": text,
+                "html": None,
+                "from_email": sender,
+                "from_name": None,
+                "to": [[recipient, None]],
+                "email": recipient,
+                "subject": subject,
+                "tags": [],
+                "sender": None,
+                "spam_report": {"score": 0.5, "matched_rules": []},
+                "dkim": {"signed": True, "valid": True},
+                "spf": {"result": "pass", "detail": "sender SPF authorized"},
+            },
+        }
+
+
+class WebhookLoadGenerator(object):
+    """Posts batches of synthetic events to the Djrill webhook, and measures the results.
+
+    url is where to post: a path (like "/djrill/webhook/?secret=abc123") is
+    posted with Django's test Client, in this process; a full "http://..." url
+    is posted with requests (e.g., to a local runserver or gunicorn).
+
+    If the DJRILL_WEBHOOK_SIGNATURE_KEY setting is set, each batch is signed
+    for the DJRILL_WEBHOOK_URL setting (or signature_url).
+    """
+
+    def __init__(self, url, factory=None, signature_key=None, signature_url=None, host="testserver"):
+        self.url = url
+        self.factory = factory or WebhookEventFactory()
+        self.signature_key = signature_key or getattr(settings, 'DJRILL_WEBHOOK_SIGNATURE_KEY', None)
+        self.signature_url = signature_url or getattr(settings, 'DJRILL_WEBHOOK_URL', None) or url
+        if url.startswith("http:") or url.startswith("https:"):
+            import requests
+            self._session = requests.Session()
+            self._post = self._post_http
+        else:
+            from django.test import Client
+            self._client = Client(HTTP_HOST=host)
+            self._post = self._post_test_client
+
+    def post_batch(self, events):
+        """Post events to the webhook, and return the response status code"""
+        data = json.dumps(events)
+        headers = {}
+        if self.signature_key:
+            headers["X-Mandrill-Signature"] = calculate_signature(
+                self.signature_key, self.signature_url, [("mandrill_events", [data])])
+        return self._post({"mandrill_events": data}, headers)
+
+    def _post_http(self, data, headers):
+        return self._session.post(self.url, data=data, headers=headers).status_code
+
+    def _post_test_client(self, data, headers):
+        extra = dict(("HTTP_" + name.upper().replace("-", "_"), value) for name, value in headers.items())
+        return self._client.post(self.url, data, **extra).status_code
+
+    def run(self, events=10000, batch_size=100, rate=None, event_types=None, trace_memory=False):
+        """Post events in batches of batch_size, at up to rate events per second, and return a report dict.
+
+        Each batch is generated before it's due, outside the timing. With a rate,
+        each batch's latency is measured from when it was due to be posted, so
+        it includes any time spent waiting behind slow earlier batches.
+        trace_memory (python 3 only) also reports the peak memory allocated
+        during the run (which slows things down).
+        """
+        if trace_memory and tracemalloc is not None:
+            tracemalloc.start()
+        latencies = []
+        status_codes = {}
+        posted = 0
+        started = time.time()
+        try:
+            while posted < events:
+                batch = self.factory.batch(min(batch_size, events - posted), event_types)
+                due = started + posted / float(rate) if rate else time.time()
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                status_code = self.post_batch(batch)
+                latencies.append(time.time() - due)
+                status_codes[status_code] = status_codes.get(status_code, 0) + 1
+                posted += len(batch)
+            elapsed = time.time() - started
+            report = {
+                "events": posted,
+                "batches": len(latencies),
+                "seconds": elapsed,
+                "events_per_second": posted / elapsed if elapsed else 0.0,
+                "latency_ms": latency_percentiles(latencies),
+                "status_codes": status_codes,
+                "max_rss_mb": max_rss_mb(),
+            }
+            if trace_memory and tracemalloc is not None:
+                report["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1048576.0
+        finally:
+            if trace_memory and tracemalloc is not None:
+                tracemalloc.stop()
+        return report
+
+
+def latency_percentiles(latencies):
+    """Return a dict of the p50, p90, p99 and max of latencies (seconds), in milliseconds"""
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+    return {"p50": percentile(0.50), "p90": percentile(0.90), "p99": percentile(0.99), "max": latencies[-1] * 1000}
+
+
+def max_rss_mb():
+    """Return this process's peak resident memory, in MB (or None if unknown)"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return max_rss / 1048576.0  # bytes
+    return max_rss / 1024.0  # kilobytes
@@ -21,6 +21,7 @@ settings.configure(
         'django.contrib.sessions',
         'django.contrib.admin',
         APP,
+        APP+'.send_records',
     ),
     MIDDLEWARE_CLASSES=(
         'django.middleware.common.CommonMiddleware',